@@ -1,8 +1,19 @@
+import sys
+from pathlib import Path
 import streamlit as st
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.session_memory import track_session_memory
+from common.chat_history import get_chat_history_store, get_conversation_id, display_history
+
+# 会話履歴の保存(common.chat_history)で使うアプリ名
+APP_NAME = "chapter_002"
+
 def main():
     st.set_page_config(
         page_title="My Great ChatGPT",
@@ -10,11 +21,17 @@ def main():
     )
     st.header("My Great ChatGPT 😭")
 
-    # チャットの履歴の初期化 : message_historyがなければ作成
-    if "message_history" not in st.session_state:
+    # 会話ID (URLのクエリパラメータに入っているので、再読み込みしても同じ会話になる)
+    conversation_id = get_conversation_id(APP_NAME)
+    store = get_chat_history_store()
+
+    # チャットの履歴の初期化 : message_historyがなければ作成 (保存済みの会話があれば読み込む)
+    if st.session_state.get("conversation_id") != conversation_id:
+        st.session_state.conversation_id = conversation_id
         st.session_state.message_history = [
             # Syte Prompt を設定 ('system' はSystem Pronmptを意味する )
             ("system", "You are a helpful assistant."),
+            *store.load(conversation_id),
         ]
     
 
@@ -48,14 +65,16 @@ def main():
 
         # ユーザーの質問を履歴に追加 
         st.session_state.message_history.append(("user", user_input))
+        store.append(conversation_id, "user", user_input)
 
         # ChatGPTの回答を履歴に追加 ('assistant' はChatGPTの回答を意味する)
         st.session_state.message_history.append(("assistant", response))
+        store.append(conversation_id, "assistant", response)
     
-    # チャット履歴の表示
-    for role, message in st.session_state.get("message_history", []):
-        with st.chat_message(role):
-            st.markdown(message)
+    # チャット履歴の表示 (直近のメッセージだけを表示し、それより前は必要なときに読み込む)
+    display_history(conversation_id)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 長い会話履歴は、操作されていない間ディスクに退避できるようにする
+    with track_session_memory(["message_history"]):
+        main()
\ No newline at end of file
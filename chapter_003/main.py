@@ -1,11 +1,24 @@
-import tiktoken
+import sys
+from pathlib import Path
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
 # models
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
+from common.models import MODELS, create_chat_model
+from common.routing import select_fallback
+from common.rate_limit import display_rate_limit_metrics
+from common.streaming import cancellable_stream, write_stream
+from common.metering import get_usage_store
+from common.session import get_session_id
+from common.session_memory import track_session_memory, display_memory_metrics
+from common.chat_history import get_chat_history_store, get_conversation_id, display_history
+
+# 使用量の計測(common.metering)・会話履歴の保存(common.chat_history)で使うアプリ名
+APP_NAME = "chapter_003"
 
 MODEL_PRICES = {
     "input": {
@@ -28,10 +41,15 @@ def init_page():
 
 def init_messages():
     clear_button = st.sidebar.button("Clear Conversation", key="clear")
-    # clear_buttonが押された場合や message_historyがまだ存在しない場合に初期化
-    if clear_button or "message_history" not in st.session_state:
+    # 会話ID (URLのクエリパラメータに入っているので、再読み込みしても同じ会話になる)
+    # clear_buttonが押された場合は新しい会話を始める
+    conversation_id = get_conversation_id(APP_NAME, new=clear_button)
+    # 会話が切り替わった場合や message_historyがまだ存在しない場合に、保存済みの会話から初期化
+    if st.session_state.get("conversation_id") != conversation_id:
+        st.session_state.conversation_id = conversation_id
         st.session_state.message_history = [
             ("system", "You are a helpful assistant."),
+            *get_chat_history_store().load(conversation_id),
         ]
 
 def select_model():
@@ -40,20 +58,15 @@ def select_model():
     temperature = st.sidebar.slider(
         "Temperature", min_value=0.0, max_value=2.0, value=0.0, step=0.01)
     
-    models = ["gpt-4o-mini", "claude-3-5-sonnet-20240620"]
-    model = st.sidebar.selectbox("Choose a Model", models)
-    if model == "gpt-4o-mini":
-        st.session_state.model_name = "gpt-4o-mini"
-        return ChatOpenAI(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
-    elif model == "claude-3-5-sonnet-20240620":
-        st.session_state.model_name = "claude-3-5-sonnet-20240620"
-        return ChatAnthropic(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
+    model = st.sidebar.selectbox("Choose a Model", MODELS)
+    st.session_state.model_name = model
+    # 応答が遅い・エラーの場合に別プロバイダのモデルへ切り替える設定
+    fallback_model, hedge_delay = select_fallback(model, MODELS)
+    # 同じプロセスの全アプリで共有しているレート制限の待ち状況
+    display_rate_limit_metrics()
+    return create_chat_model(
+        model, temperature, app=APP_NAME,
+        fallback_model=fallback_model, hedge_delay=hedge_delay)
 
 def init_chain():
     st.session_state.llm = select_model()
@@ -64,46 +77,41 @@ def init_chain():
     output_paper = StrOutputParser()
     return prompt | st.session_state.llm | output_paper
 
-def get_message_counts(text):
-    if "gpt" in st.session_state.model_name:
-        encoding = tiktoken.encoding_for_model(st.session_state.model_name)
-    else:
-        encoding = tiktoken.encoding_for_model("gpt-4o-mini")
-    return len(encoding.encode(text))
-
 def calc_and_display_costs():
-    output_count = 0
-    input_count = 0
-    for role, message in st.session_state.message_history:
-        # tiktoken でトークン数をカウント
-        token_count = get_message_counts(message)
-        if role == "ai":
-            output_count += token_count
-        else:
-            input_count += token_count
-    
-    # 初期状態で System Message のみが履歴に入っている場合はまだAPIコールが行われていない
-    if len(st.session_state.message_history) == 1:
+    # tiktoken による推定ではなく、各プロバイダが返した実際の使用量を集計する
+    # (Claude のトークン数も正しく数えられる)
+    totals = get_usage_store().session_totals(get_session_id())
+    if not totals:
+        # まだAPIコールが行われていない
         return
-    
-    input_cost = MODEL_PRICES['input'][st.session_state.model_name] * input_count
-    output_cost = MODEL_PRICES['output'][st.session_state.model_name] * output_count
+
+    input_cost = 0
+    output_cost = 0
+    input_count = 0
+    output_count = 0
+    for row in totals:
+        price_key = next((m for m in MODEL_PRICES['input'] if row['model'] and row['model'].startswith(m)), None)
+        input_count += row['input_tokens'] or 0
+        output_count += row['output_tokens'] or 0
+        if price_key is None:
+            continue
+        input_cost += MODEL_PRICES['input'][price_key] * (row['input_tokens'] or 0)
+        output_cost += MODEL_PRICES['output'][price_key] * (row['output_tokens'] or 0)
 
     cost = output_cost + input_cost
 
     st.sidebar.markdown("## Costs")
     st.sidebar.markdown(f"**Total cost: ${cost: .5f}**")
-    st.sidebar.markdown(f"- Input cost: ${input_cost:.5f}")
-    st.sidebar.markdown(f"- Output cost: ${output_cost:.5f}")
+    st.sidebar.markdown(f"- Input cost: ${input_cost:.5f} ({input_count} tokens)")
+    st.sidebar.markdown(f"- Output cost: ${output_cost:.5f} ({output_count} tokens)")
 
 def main():
     init_page()
     init_messages()
     chain = init_chain()
 
-    # チャット履歴の表示 
-    for role,message in st.session_state.get("message_history",[]):
-        st.chat_message(role).markdown(message)
+    # チャット履歴の表示 (直近のメッセージだけを表示し、それより前は必要なときに読み込む)
+    display_history(st.session_state.conversation_id)
     
     # ユーザーの入力を監視
     if user_input := st.chat_input("聞きたいことを入力してね！"):
@@ -113,7 +121,8 @@ def main():
         with st.chat_message("ai"):
             # invoke()は回答の一括取得 stream()はストリーミング(リアルタイム)表示ということらしい
             # 他にもbatch()という複数の質問を並列処理できる関数もあるらしい APIならでは
-            response = st.write_stream(chain.stream({"user_input": user_input}))
+            # 返答中に次の入力が来た場合は、この生成を中断する
+            response = write_stream(cancellable_stream(chain, {"user_input": user_input}))
             # invoke()を使って一括でレスポンスを取得
             # response = chain.invoke({"user_input": user_input})
             # st.markdown(response) 
@@ -121,9 +130,15 @@ def main():
         # チャット履歴に追加
         st.session_state.message_history.append(("user", user_input))
         st.session_state.message_history.append(("ai", response))
+        store = get_chat_history_store()
+        store.append(st.session_state.conversation_id, "user", user_input)
+        store.append(st.session_state.conversation_id, "ai", response)
 
     # コストを計算して表示
     calc_and_display_costs()
+    display_memory_metrics()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # 長い会話履歴は、操作されていない間ディスクに退避できるようにする
+    with track_session_memory(["message_history"]):
+        main()
\ No newline at end of file
@@ -1,11 +1,24 @@
+import sys
+from pathlib import Path
 import traceback
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
 # models
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
+from common.models import MODELS, create_chat_model
+from common.routing import select_fallback
+from common.rate_limit import display_rate_limit_metrics
+from common.jobs import POLL_INTERVAL, get_job_queue, job_key, stream_to_job
+
+# 使用量の計測(common.metering)で使うアプリ名
+APP_NAME = "chapter_005-1"
+# 要約を表示しているページがなくなってから、生成を中断するまでの秒数
+# (別のURLを入力したりタブを閉じたりした後も、古い要約がトークンを使い続けないように)
+SUMMARY_ABANDON_AFTER = 10
 
 
 import requests
@@ -38,20 +51,16 @@ def select_model():
     temperature = st.sidebar.slider(
         "Temperature", min_value=0.0, max_value=2.0, value=0.0, step=0.01)
     
-    models = ["gpt-4o-mini", "claude-3-5-sonnet-20240620"]
-    model = st.sidebar.selectbox("Choose a Model", models)
-    if model == "gpt-4o-mini":
-        st.session_state.model_name = "gpt-4o-mini"
-        return ChatOpenAI(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
-    elif model == "claude-3-5-sonnet-20240620":
-        st.session_state.model_name = "claude-3-5-sonnet-20240620"
-        return ChatAnthropic(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
+    model = st.sidebar.selectbox("Choose a Model", MODELS)
+    st.session_state.model_name = model
+    st.session_state.temperature = temperature
+    # 応答が遅い・エラーの場合に別プロバイダのモデルへ切り替える設定
+    fallback_model, hedge_delay = select_fallback(model, MODELS)
+    # 同じプロセスの全アプリで共有しているレート制限の待ち状況
+    display_rate_limit_metrics()
+    return create_chat_model(
+        model, temperature, app=APP_NAME,
+        fallback_model=fallback_model, hedge_delay=hedge_delay)
     
 def init_chain():
     llm = select_model()
@@ -62,6 +71,37 @@ def init_chain():
     chain = prompt | llm | output_parser
     return chain
 
+def summarize(chain, content):
+    """
+    要約をバックグラウンドのジョブとして投入する
+
+    同じ内容・モデル・temperature の要約は実行中・完了済みのジョブが返るので、
+    再実行しても要約し直さず、他のセッションの結果も再利用される。
+    どのセッションも表示しなくなった要約は SUMMARY_ABANDON_AFTER 秒後に中断する
+    """
+    key = job_key(APP_NAME, SUMMARISE_PROMPT, st.session_state.model_name, st.session_state.temperature, content)
+    return get_job_queue().submit(key, stream_to_job, chain, {"content": content}, label="Summary",
+                                  abandon_after=SUMMARY_ABANDON_AFTER)
+
+def display_summary(job):
+    if job.error is not None:
+        st.error(f"要約に失敗しました: {job.error}")
+    elif job.done:
+        st.markdown(job.result)
+    else:
+        poll_summary(job)
+
+@st.experimental_fragment(run_every=POLL_INTERVAL)
+def poll_summary(job):
+    """ 要約の途中経過を表示する (この部分だけを定期的に再実行する) """
+    # 表示している間は、要約を中断させない
+    job.touch()
+    # 完了してもページ全体は再実行しない (コンテンツを取得し直すことになるため)
+    if job.done:
+        display_summary(job)
+    else:
+        st.markdown(job.partial or "要約しています...")
+
 def validate_url(url):
     """ URLが有効かどうかを判定する関数 """
     try:
@@ -100,7 +140,8 @@ def main():
         else:
             if content := get_content(url):
                 st.markdown("## Summary")
-                st.write_stream(chain.stream({"content": content}))
+                # 要約中も画面は操作でき、再実行しても要約は続く
+                display_summary(summarize(chain, content))
                 st.markdown("---")
                 st.markdown("## Original Text")
                 st.write(content)
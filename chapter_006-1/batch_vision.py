@@ -0,0 +1,213 @@
+"""
+複数の画像に同じ質問をする一括解析 (main.py の一括モードから使う)
+
+数百枚の画像を1枚ずつ順番に送ると、待ち時間の合計がそのまま画像の枚数倍になる。ここでは
+- 画像は最初に一度だけ縮小・再エンコードして data URL にしておく (prepare_images)
+- リクエストは同時実行数を制限して並列に送る (analyze_images の max_concurrency)
+- 質問が画像ごとに独立している場合は、複数枚を1つのリクエストにまとめる (images_per_request)
+  まとめると質問文の分の入力トークンとリクエスト数が減る。回答は JSON で画像ごとに返してもらい、
+  読み取れなかった場合は1枚ずつ送り直す
+ことで全体の時間を短くする。結果は終わったリクエストの分から順に返すので、表に逐次追加できる。
+
+まとめたリクエストのトークン数は画像ごとには分からないので、枚数で均等に割ったものを使う。
+1枚ずつ聞き直した画像には、失敗したまとめたリクエストの時間と (均等に割った) トークン数も足す。
+"""
+import base64
+import hashlib
+import io
+import json
+import re
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import PurePosixPath
+
+from PIL import Image
+
+from common.streaming import chunk_to_text
+
+# GPT-4o などが処理できる画像の拡張子
+IMAGE_TYPES = ["png", "jpg", "jpeg", "webp", "gif"]
+# 送る前に長辺をこの大きさまで縮小する (API 側でもこれ以上は縮小されるので、送っても無駄になる)
+MAX_SIDE = 1024
+JPEG_QUALITY = 85
+# 同時に送るリクエストの数の初期値 (実際の流量は common.rate_limit でも制限される)
+MAX_CONCURRENCY = 4
+# 1リクエストの出力トークン数の上限 (まとめて送る場合は枚数倍にする)
+MAX_TOKENS_PER_IMAGE = 512
+
+PACKED_PROMPT = """これから {count} 枚の画像を「画像1」「画像2」... の順に示します。
+それぞれの画像について、次の質問に個別に答えてください。
+
+質問: {question}
+
+回答は、次の形式の JSON 配列だけを返してください (画像ごとに1要素、画像の順番どおり):
+[{{"image": 1, "answer": "..."}}, {{"image": 2, "answer": "..."}}]
+"""
+
+COLUMNS = ["image", "answer", "latency_ms", "input_tokens", "output_tokens", "images_in_request", "error"]
+
+
+def _is_image(name):
+    return PurePosixPath(name).suffix.lower().lstrip(".") in IMAGE_TYPES
+
+def expand_uploads(files):
+    """ (ファイル名, bytes) のリストから、zip の中身も展開した画像の (ファイル名, bytes) のリストを返す """
+    images = []
+    for name, data in files:
+        if name.lower().endswith(".zip"):
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for info in archive.infolist():
+                    # フォルダや macOS が作る隠しファイルは除く
+                    if info.is_dir() or "__MACOSX" in info.filename or not _is_image(info.filename):
+                        continue
+                    images.append((info.filename, archive.read(info)))
+        elif _is_image(name):
+            images.append((name, data))
+    return images
+
+
+def prepare_image(name, data, max_side=MAX_SIDE):
+    """ 画像を縮小して data URL にする (透過のある画像は PNG、それ以外は JPEG) """
+    with Image.open(io.BytesIO(data)) as image:
+        # アニメーション GIF は最初のフレームだけを使う
+        image.seek(0)
+        image.thumbnail((max_side, max_side))
+        if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+            image = image.convert("RGBA")
+            format, mime = "PNG", "image/png"
+        else:
+            image = image.convert("RGB")
+            format, mime = "JPEG", "image/jpeg"
+        buffer = io.BytesIO()
+        image.save(buffer, format=format, **({"quality": JPEG_QUALITY} if format == "JPEG" else {}))
+        width, height = image.size
+    encoded = buffer.getvalue()
+    return {
+        "name": name,
+        "url": f"data:{mime};base64,{base64.b64encode(encoded).decode()}",
+        "size": (width, height),
+        "bytes": len(encoded),
+    }
+
+def prepare_images(files, max_side=MAX_SIDE, max_workers=MAX_CONCURRENCY, cache=None):
+    """
+    画像をまとめて prepare_image する (元の順番のリストを返す)
+
+    cache (dict) を渡すと、同じ内容の画像は前回の結果を使う (質問を変えて再実行しても作り直さない)。
+    cache には今回の画像の分だけを残す (アップロードし直すたびに古い画像の分がたまらないように)
+    """
+    used = set()
+
+    def prepare(item):
+        name, data = item
+        key = (hashlib.sha256(data).hexdigest(), max_side)
+        used.add(key)
+        if cache is not None and key in cache:
+            return {**cache[key], "name": name}
+        prepared = prepare_image(name, data, max_side)
+        if cache is not None:
+            cache[key] = prepared
+        return prepared
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        prepared = list(executor.map(prepare, files))
+    if cache is not None:
+        for key in set(cache) - used:
+            del cache[key]
+    return prepared
+
+
+def _image_block(image):
+    return {"type": "image_url", "image_url": {"url": image["url"], "detail": "auto"}}
+
+def build_query(question, images):
+    """ 1リクエスト分のメッセージを作る (2枚以上なら JSON で画像ごとに答えてもらう) """
+    if len(images) == 1:
+        content = [{"type": "text", "text": question}, _image_block(images[0])]
+    else:
+        content = [{"type": "text", "text": PACKED_PROMPT.format(count=len(images), question=question)}]
+        for number, image in enumerate(images, start=1):
+            content += [{"type": "text", "text": f"画像{number}"}, _image_block(image)]
+    return [("user", content)]
+
+def parse_packed_answers(text, count):
+    """ まとめたリクエストの回答を画像ごとに分ける (読み取れない・足りない場合は None) """
+    match = re.search(r"\[.*\]", text, re.DOTALL)
+    if match is None:
+        return None
+    try:
+        items = json.loads(match.group(0))
+    except json.JSONDecodeError:
+        return None
+    answers = {}
+    for item in items if isinstance(items, list) else []:
+        if isinstance(item, dict) and "image" in item and "answer" in item:
+            try:
+                answers[int(item["image"])] = str(item["answer"])
+            except (TypeError, ValueError):
+                continue
+    if any(number not in answers for number in range(1, count + 1)):
+        return None
+    return [answers[number] for number in range(1, count + 1)]
+
+
+def analyze_group(llm, question, images):
+    """ 1リクエスト分の画像を解析し、画像ごとの結果 (表の行) のリストを返す """
+    started = time.perf_counter()
+    response = llm.invoke(build_query(question, images))
+    latency_ms = round((time.perf_counter() - started) * 1000)
+    text = chunk_to_text(response)
+    usage = getattr(response, "usage_metadata", None) or {}
+    count = len(images)
+    input_tokens = round(usage.get("input_tokens", 0) / count)
+    output_tokens = round(usage.get("output_tokens", 0) / count)
+    if count == 1:
+        answers = [text]
+    else:
+        answers = parse_packed_answers(text, count)
+        if answers is None:
+            # 形式どおりに答えてもらえなかったので、1枚ずつ聞き直す
+            # (まとめたリクエストの時間とトークンも、その画像の結果を得るのにかかった分として足す)
+            rows = [row for image in images for row in analyze_group(llm, question, [image])]
+            for row in rows:
+                row["latency_ms"] += latency_ms
+                row["input_tokens"] += input_tokens
+                row["output_tokens"] += output_tokens
+            return rows
+    return [
+        {
+            "image": image["name"],
+            "answer": answer,
+            "latency_ms": latency_ms,
+            "input_tokens": input_tokens,
+            "output_tokens": output_tokens,
+            "images_in_request": count,
+            "error": None,
+        }
+        for image, answer in zip(images, answers)
+    ]
+
+def analyze_images(llm, question, images, images_per_request=1, max_concurrency=MAX_CONCURRENCY):
+    """
+    画像を images_per_request 枚ずつのリクエストにして並列に解析し、終わったものから行を返す
+
+    失敗したリクエストの画像は error を入れた行として返す (残りの画像の解析は続ける)
+    """
+    groups = [images[i:i + images_per_request] for i in range(0, len(images), images_per_request)]
+    executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="vision")
+    try:
+        futures = {executor.submit(analyze_group, llm, question, group): group for group in groups}
+        for future in as_completed(futures):
+            try:
+                rows = future.result()
+            except Exception as e:
+                rows = [
+                    {**dict.fromkeys(COLUMNS), "image": image["name"],
+                     "images_in_request": len(futures[future]), "error": f"{type(e).__name__}: {e}"}
+                    for image in futures[future]
+                ]
+            yield from rows
+    finally:
+        # 途中で中断された場合 (再実行など) は、まだ送っていないリクエストを取り消す
+        executor.shutdown(wait=False, cancel_futures=True)
@@ -1,6 +1,25 @@
+import sys
+import csv
+import io
+import time
 import base64
+from pathlib import Path
 import streamlit as st
-from langchain_openai import ChatOpenAI
+
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.models import create_chat_model
+from common.streaming import cancellable_stream, write_stream
+from common.rate_limit import display_rate_limit_metrics
+
+from batch_vision import (
+    IMAGE_TYPES, MAX_CONCURRENCY, MAX_TOKENS_PER_IMAGE, COLUMNS,
+    expand_uploads, prepare_images, analyze_images,
+)
+
+# 使用量の計測(common.metering)で使うアプリ名
+APP_NAME = "chapter_006-1"
 
 def init_page():
     st.set_page_config(
@@ -10,12 +29,108 @@ def init_page():
     st.header("Image Recognizer😭")
     st.sidebar.title("Options")
 
+def select_mode():
+    return st.sidebar.radio(
+        "モード", ["1枚ずつ", "一括解析"],
+        help="一括解析では、複数の画像 (zip も可) に同じ質問をして、結果を表にまとめます")
+
+def select_batch_options():
+    max_concurrency = st.sidebar.slider(
+        "同時に送るリクエスト数", min_value=1, max_value=16, value=MAX_CONCURRENCY)
+    images_per_request = st.sidebar.slider(
+        "1リクエストにまとめる画像の数", min_value=1, max_value=8, value=1,
+        help="質問が画像ごとに独立している場合 (「何が写っているか」など) は、まとめるとリクエスト数と入力トークンが減ります。"
+             "画像を比べるような質問では 1 にしてください")
+    # 同じプロセスの全アプリで共有しているレート制限の待ち状況
+    display_rate_limit_metrics()
+    return max_concurrency, images_per_request
+
+def to_csv(rows):
+    """ 結果の表を CSV にする (Excel で文字化けしないよう BOM を付ける) """
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=COLUMNS)
+    writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode("utf-8-sig")
+
+def display_batch_results(results):
+    rows = results["rows"]
+    st.dataframe(rows, use_container_width=True)
+    succeeded = [row for row in rows if row["error"] is None]
+    input_tokens = sum(row["input_tokens"] for row in succeeded)
+    output_tokens = sum(row["output_tokens"] for row in succeeded)
+    average_latency = sum(row["latency_ms"] for row in succeeded) / len(succeeded) if succeeded else 0
+    st.caption(
+        f"{len(succeeded)}/{len(rows)}枚 成功 / 全体 {results['elapsed']:.1f}秒 / "
+        f"リクエストあたり平均 {average_latency / 1000:.1f}秒 / "
+        f"入力 {input_tokens}トークン・出力 {output_tokens}トークン")
+    st.download_button(
+        "結果をダウンロード (CSV)", to_csv(rows),
+        file_name="image_analysis.csv", mime="text/csv")
+
+def run_batch(uploaded_files):
+    max_concurrency, images_per_request = select_batch_options()
+    # まとめて送る場合は、画像の枚数分の回答が入るように出力の上限を増やす
+    llm = create_chat_model(
+        "gpt-4o-mini", temperature=0, app=APP_NAME,
+        max_tokens=MAX_TOKENS_PER_IMAGE * images_per_request)
+
+    if not uploaded_files:
+        st.write("まずは画像 (または画像の入った zip) をアップロードしてください")
+        return
+    files = expand_uploads([(file.name, file.getvalue()) for file in uploaded_files])
+    st.caption(f"画像 {len(files)}枚")
+    if not files:
+        return
+
+    if question := st.chat_input("全ての画像に聞きたいことを入力してください"):
+        st.markdown("### Question")
+        st.write(question)
+        started = time.perf_counter()
+        # 画像の縮小・エンコードは一度だけ行い、質問を変えて再実行したときも使い回す
+        with st.spinner("画像を準備しています..."):
+            images = prepare_images(
+                files, max_workers=max_concurrency,
+                cache=st.session_state.setdefault("prepared_images", {}))
+
+        st.markdown("### Answers")
+        progress = st.progress(0.0)
+        table = st.empty()
+        rows = []
+        for row in analyze_images(
+                llm, question, images,
+                images_per_request=images_per_request, max_concurrency=max_concurrency):
+            rows.append(row)
+            progress.progress(len(rows) / len(images), text=f"{len(rows)}/{len(images)}枚")
+            table.dataframe(rows, use_container_width=True)
+        progress.empty()
+        table.empty()
+        st.session_state.batch_results = {
+            "question": question, "rows": rows, "elapsed": time.perf_counter() - started}
+
+    # ダウンロードボタンを押した後の再実行でも、直前の結果を表示する
+    if results := st.session_state.get("batch_results"):
+        if not question:
+            st.markdown("### Question")
+            st.write(results["question"])
+            st.markdown("### Answers")
+        display_batch_results(results)
+
 def main():
     init_page()
 
-    llm = ChatOpenAI(
-        model="gpt-4o-mini",
+    if select_mode() == "一括解析":
+        run_batch(st.file_uploader(
+            label="Upload your images here",
+            type=IMAGE_TYPES + ["zip"],
+            accept_multiple_files=True,
+        ))
+        return
+
+    llm = create_chat_model(
+        "gpt-4o-mini",
         temperature=0,
+        app=APP_NAME,
         # 何故かmax_tokensを指定しないとエラーが出る
         # 著しく短い回答になったり、途中で回答が途切れたりする
         max_tokens=512
@@ -54,7 +169,7 @@ def main():
             st.write(user_print) # ユーザーの質問
             st.image(uploaded_file) # アップロードした画像を表示
             st.markdown("### Answer")
-            st.write_stream(llm.stream(query))
+            write_stream(cancellable_stream(llm, query))
 
     else:
         st.write("まずは画像をアップロードしてください")
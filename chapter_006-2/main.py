@@ -1,9 +1,19 @@
+import sys
 import base64
+from pathlib import Path
 import streamlit as st
-from langchain_openai import ChatOpenAI
 import openai
 import os
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+from common.models import create_chat_model
+from common.streaming import cancellable_stream, write_stream
+
+# 使用量の計測(common.metering)で使うアプリ名
+APP_NAME = "chapter_006-2"
+
 GPT4V_PROMPT = """
 まず、以下のユーザーのリクエストとアップロードされた画像を注意深く読んでください。
 
@@ -30,9 +40,10 @@ def init_page():
 def main():
     init_page()
 
-    llm = ChatOpenAI(
+    llm = create_chat_model(
+        "gpt-4o",
         temperature=0,
-        model="gpt-4o",
+        app=APP_NAME,
         # 何故かmax_tokensを指定しないとエラーが出る
         max_tokens=512
     )
@@ -73,7 +84,7 @@ def main():
 
             # GPT-4Vに DALL-E 3 用の画像生成プロンプトを書いてもらう
             st.markdown("### Image Prompt")
-            image_prompt = st.write_stream(llm.stream(query))
+            image_prompt = write_stream(cancellable_stream(llm, query))
 
             # DALL-E 3 による画像生成（OpenAI APIを直接使用）
             with st.spinner("DALL-E 3 による画像生成中..."):
@@ -0,0 +1,193 @@
+"""
+チャンクの重複除去 (分割と埋め込みの間で使う)
+
+PDFのヘッダー・フッターや定型文、版違いの同じ章などはほぼ同じ内容のチャンクになり、
+そのまま入れるとインデックスも埋め込みコストも増え、検索結果の k 枠も重複で埋まってしまう。
+
+- 完全一致: 正規化したテキストのハッシュで判定
+- ほぼ一致: 文字 n-gram の MinHash + LSH で候補を探し、推定 Jaccard 係数が閾値以上なら重複とする
+
+重複はドキュメントをまたいで判定する。除去したチャンクは、どのチャンクの重複だったかを覚えておき、
+そのチャンクのドキュメントが削除されたら代わりに残すチャンクとして返す (remove)。
+呼び出し側は除去したチャンクのテキストとベクトルを取っておき、返されたものをインデックスに戻す。
+"""
+import hashlib
+import re
+import threading
+import unicodedata
+import zlib
+
+import numpy as np
+
+# MinHash のハッシュ関数の数
+NUM_PERM = 128
+# 文字 n-gram の n (日本語のように空白で区切られないテキストも扱えるよう文字単位にする)
+SHINGLE_SIZE = 5
+# ハッシュ値を取る素数 (2^32 より大きい最小の素数)
+HASH_PRIME = 4294967311
+
+
+def normalize(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    return re.sub(r"\s+", " ", text).strip()
+
+def text_hash(text):
+    return hashlib.sha1(normalize(text).encode("utf-8")).hexdigest()
+
+def shingles(text, size=SHINGLE_SIZE):
+    text = normalize(text)
+    if len(text) <= size:
+        return {text}
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+
+def optimal_bands(threshold, num_perm):
+    """
+    閾値に合わせて LSH のバンド数 b と1バンドあたりの行数 r を決める
+
+    偽陽性(閾値未満なのに候補になる)と偽陰性(閾値以上なのに候補にならない)の
+    確率の和が最小になる組み合わせを選ぶ
+    """
+    # 区間 [0, 1] の積分は等間隔の点での平均で近似する
+    xs = np.linspace(0, 1, 201)
+    best, best_error = (1, num_perm), float("inf")
+    for b in range(1, num_perm + 1):
+        r = num_perm // b
+        probability = 1 - (1 - xs ** r) ** b
+        false_positive = np.mean(np.where(xs < threshold, probability, 0))
+        false_negative = np.mean(np.where(xs >= threshold, 1 - probability, 0))
+        error = false_positive + false_negative
+        if error < best_error:
+            best, best_error = (b, r), error
+    return best
+
+
+class ChunkDeduplicator:
+    """
+    インデックス済みのチャンクを覚えておき、新しいチャンクのうち重複していないものだけを返す
+
+    複数のドキュメントを並列に処理するため、スレッドセーフにしてある
+    """
+
+    def __init__(self, threshold=0.8, num_perm=NUM_PERM, seed=1):
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands, self.rows = optimal_bands(threshold, num_perm)
+        rng = np.random.default_rng(seed)
+        # a は 2^31 未満にして、a * x (x < 2^32) が uint64 に収まるようにする
+        self._a = rng.integers(1, 2**31, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, 2**31, size=num_perm, dtype=np.uint64)
+        self._lock = threading.Lock()
+        self._hashes = {}      # text_hash -> (doc_id, index)
+        self._signatures = {}  # (doc_id, index) -> MinHash signature
+        self._buckets = [{} for _ in range(self.bands)]  # band -> {band_key: set((doc_id, index))}
+        # 残したチャンク -> そのチャンクの重複として除去したチャンク {(doc_id, index): (text_hash, signature)}
+        self._dropped = {}
+
+    def signature(self, text):
+        values = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles(text)), dtype=np.uint64)
+        hashed = (np.outer(values, self._a) + self._b) % np.uint64(HASH_PRIME)
+        return hashed.min(axis=0)
+
+    def _band_keys(self, signature):
+        for band in range(self.bands):
+            yield band, signature[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def _find_near_duplicate(self, signature):
+        candidates = set()
+        for band, key in self._band_keys(signature):
+            candidates |= self._buckets[band].get(key, set())
+        for candidate in candidates:
+            similarity = np.mean(self._signatures[candidate] == signature)
+            if similarity >= self.threshold:
+                return candidate
+        return None
+
+    def _register(self, key, digest, signature):
+        self._hashes[digest] = key
+        self._signatures[key] = signature
+        for band, band_key in self._band_keys(signature):
+            self._buckets[band].setdefault(band_key, set()).add(key)
+
+    def _unregister(self, key):
+        signature = self._signatures.pop(key)
+        for band, band_key in self._band_keys(signature):
+            bucket = self._buckets[band].get(band_key)
+            if bucket:
+                bucket.discard(key)
+                if not bucket:
+                    del self._buckets[band][band_key]
+
+    def _find_duplicate(self, digest, signature):
+        """ 重複しているチャンクがあれば (種類, そのチャンクのキー) を返す """
+        if digest in self._hashes:
+            return "exact", self._hashes[digest]
+        owner = self._find_near_duplicate(signature)
+        if owner is not None:
+            return "near", owner
+        return None, None
+
+    def add(self, doc_id, texts, indices=None):
+        """
+        texts のうち残すチャンクの index のリストと、除去数の集計を返す
+
+        残したチャンクは以降の重複判定の対象になる (同じドキュメント内の重複も除去する)。
+        indices を渡すと、texts の各チャンクの index としてそれを使う (既定は 0, 1, 2, ...)。
+        集計の "dropped" は、除去したチャンクの index -> 種類 ("exact" / "near")
+        """
+        if indices is None:
+            indices = range(len(texts))
+        keep = []
+        stats = {"total": len(texts), "exact": 0, "near": 0, "dropped": {}}
+        # MinHash の計算は重いのでロックの外で行う
+        prepared = [(text_hash(text), self.signature(text)) for text in texts]
+        with self._lock:
+            for index, (digest, signature) in zip(indices, prepared):
+                key = (doc_id, index)
+                kind, owner = self._find_duplicate(digest, signature)
+                if kind is not None:
+                    stats[kind] += 1
+                    stats["dropped"][index] = kind
+                    self._dropped.setdefault(owner, {})[key] = (digest, signature)
+                    continue
+                self._register(key, digest, signature)
+                keep.append(index)
+        stats["kept"] = len(keep)
+        return keep, stats
+
+    def remove(self, doc_id):
+        """
+        ドキュメントを削除したときに、そのチャンクを重複判定の対象から外す
+
+        そのチャンクの重複として除去していた他のドキュメントのチャンクは、まだ残っている別のチャンクの
+        重複でなければ代わりに残すことにして、その (doc_id, index) のリストを返す
+        (呼び出し側でインデックスに戻す。戻さないと、その内容が検索できなくなる)
+        """
+        with self._lock:
+            orphans = {}
+            for key in [key for key in self._signatures if key[0] == doc_id]:
+                self._unregister(key)
+                orphans.update(self._dropped.pop(key, {}))
+            self._hashes = {
+                digest: key for digest, key in self._hashes.items() if key[0] != doc_id}
+            # 削除するドキュメント自身の、除去済みのチャンクの記録も消す
+            for owner in list(self._dropped):
+                duplicates = self._dropped[owner]
+                for key in [key for key in duplicates if key[0] == doc_id]:
+                    del duplicates[key]
+                if not duplicates:
+                    del self._dropped[owner]
+
+            restored = []
+            for key, (digest, signature) in sorted(orphans.items()):
+                if key[0] == doc_id:
+                    continue
+                kind, owner = self._find_duplicate(digest, signature)
+                if kind is not None:
+                    # まだ他に同じ内容のチャンクがある (今度はそのチャンクの重複として覚えておく)
+                    self._dropped.setdefault(owner, {})[key] = (digest, signature)
+                    continue
+                self._register(key, digest, signature)
+                restored.append(key)
+            return restored
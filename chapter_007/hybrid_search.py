@@ -0,0 +1,88 @@
+"""
+BM25 とベクトル検索のハイブリッド検索 (1_Upload_PDF.py / 2_Ask_My_PDF.py から利用)
+
+型番・エラーコード・条項番号のような識別子は、埋め込みでは近さが表れにくく、ベクトル検索だけだと取りこぼしやすい。
+チャンクをベクトルストアに追加するときに BM25 の転置インデックス (common.bm25.InvertedIndex) にも追加しておき、
+質問時は両方の検索結果を Reciprocal Rank Fusion (RRF) で1つの順位にまとめる。
+RRF はスコアの尺度が違う検索結果を順位だけで統合できるので、どちらかで上位に来たチャンク、
+特に両方で上位に来たチャンクが優先され、少ない k でも必要なチャンクが入りやすくなる。
+"""
+import time
+from typing import Any, Optional
+
+from langchain_core.retrievers import BaseRetriever
+
+from common.bm25 import InvertedIndex
+
+# RRF の定数 (大きいほど下位の順位との差が小さくなる。元論文の 60 を使う)
+RRF_K = 60
+# それぞれの検索で取ってくる候補の数
+CANDIDATES = 20
+
+
+def build_keyword_index(vectorstore):
+    """ ベクトルストアに入っている全ての文書から転置インデックスを作る """
+    index = InvertedIndex()
+    if vectorstore is not None:
+        ids = list(vectorstore.index_to_docstore_id.values())
+        index.add(ids, [vectorstore.docstore.search(id_).page_content for id_ in ids])
+    return index
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """ 複数の順位付けのリスト (キーのリスト) を統合し、(キー, スコア) をスコアの高い順に返す """
+    scores = {}
+    for ranking in rankings:
+        for rank, key in enumerate(ranking, start=1):
+            scores[key] = scores.get(key, 0.0) + 1.0 / (k + rank)
+    return sorted(scores.items(), key=lambda item: -item[1])
+
+
+class HybridRetriever(BaseRetriever):
+    """
+    BM25 とベクトル検索の結果を RRF で統合して上位 k 件を返す
+
+    keyword_index が None の場合はベクトル検索だけを行う (比較用)
+    直前の検索にかかった時間 (ms) は timings に入る
+    """
+
+    vectorstore: Any
+    keyword_index: Any = None
+    k: int = 5
+    candidates: int = CANDIDATES
+    # FAISS の filter と同じ形式 ({"doc_id": [...], "tier": [...]})
+    search_filter: Optional[dict] = None
+    timings: dict = {}
+
+    def _keyword_search(self, query):
+        docstore = self.vectorstore.docstore
+        filter_func = None
+        if self.search_filter:
+            # FAISS と同じ条件で絞り込む
+            match = self.vectorstore._create_filter_func(self.search_filter)
+            filter_func = lambda id_: match(docstore.search(id_).metadata)
+        hits = self.keyword_index.search(query, k=self.candidates, filter=filter_func)
+        return [docstore.search(id_) for id_, _ in hits]
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        self.timings.clear()
+        started = time.perf_counter()
+        # フィルタで除外される分を見越して多めに候補を取る
+        vector_docs = self.vectorstore.similarity_search(
+            query, k=self.candidates, filter=self.search_filter, fetch_k=100)
+        self.timings["vector"] = (time.perf_counter() - started) * 1000
+        if self.keyword_index is None:
+            return vector_docs[:self.k]
+
+        started = time.perf_counter()
+        keyword_docs = self._keyword_search(query)
+        self.timings["bm25"] = (time.perf_counter() - started) * 1000
+
+        started = time.perf_counter()
+        # どちらの検索も同じ docstore の Document を返すので、オブジェクトの同一性で突き合わせる
+        docs = {id(doc): doc for doc in vector_docs + keyword_docs}
+        fused = reciprocal_rank_fusion([
+            [id(doc) for doc in vector_docs],
+            [id(doc) for doc in keyword_docs],
+        ])
+        self.timings["fusion"] = (time.perf_counter() - started) * 1000
+        return [docs[key] for key, _ in fused[:self.k]]
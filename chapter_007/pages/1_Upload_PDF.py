@@ -1,8 +1,27 @@
-import fitz # PyMuPDF
+import sys
+import time
+from pathlib import Path
 import streamlit as st
-from langchain_community.vectorstores import FAISS
-from langchain_openai import OpenAIEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+# chapter_007 直下の pdf_index と、リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from common.jobs import POLL_INTERVAL, display_job_progress, get_job_queue
+from common.models import create_chat_model, create_embeddings
+from common.session_memory import track_session_memory, display_memory_metrics
+from dedup import ChunkDeduplicator
+from hybrid_search import build_keyword_index
+from pdf_index import (
+    EMBEDDING_MODEL, document_id, index_document, index_job_key, prepare_document, add_document, delete_document,
+    restore_chunks)
+from summary_index import CHUNK_TIER, SUMMARY_MODEL
+from vector_compression import (
+    COMPRESSION_MODES, compare_compression, convert_vector_store, index_memory_bytes, pq_train_size,
+    stored_vectors)
+
+# 使用量の計測(common.metering)で使うアプリ名
+APP_NAME = "chapter_007"
 
 def init_page():
     st.set_page_config(
@@ -15,56 +34,258 @@ def init_messages():
     clear_button = st.sidebar.button("Clear DB", key="clear")
     if clear_button and "vectorstore" in st.session_state:
         del st.session_state.vectorstore
+        st.session_state.pop("keyword_index", None)
+    # アップロード済みのドキュメント (doc_id -> name, ids, chunks, summaries)
+    if clear_button or "documents" not in st.session_state:
+        st.session_state.documents = {}
+        # 削除・差し替えたドキュメント (アップローダーに残っていても再追加しない)
+        st.session_state.deleted_documents = set()
+        st.session_state.deduplicator = None
+    # 追加するテキストがなかったドキュメント (再実行のたびに読み込み直さない)
+    if clear_button or "skipped_documents" not in st.session_state:
+        st.session_state.skipped_documents = set()
+    # 読み込みに失敗したドキュメント (doc_id -> name, error)
+    # 再実行のたびに投入し直さず、再試行ボタンか、アップロードし直したときだけ再度投入する
+    if clear_button or "failed_documents" not in st.session_state:
+        st.session_state.failed_documents = {}
+        # 次に投入するときに、失敗したジョブをすぐに再実行させるドキュメント
+        st.session_state.retry_documents = set()
+    # インデックス作成中のドキュメント (doc_id -> name, job)
+    if clear_button or "index_jobs" not in st.session_state:
+        st.session_state.index_jobs = {}
+
+def select_deduplicator():
+    """
+    重複チャンク除去の設定 (閾値を変えた場合はインデックス済みのチャンクから作り直す)
+
+    除去をやめた場合や、閾値を変えて重複ではなくなったチャンクは、インデックスに戻す
+    """
+    documents = st.session_state.documents
+    vectorstore = st.session_state.get("vectorstore")
+    keyword_index = st.session_state.get("keyword_index")
+    if not st.sidebar.checkbox("重複チャンクを除去する", value=True):
+        st.session_state.deduplicator = None
+        dropped = [(doc_id, i) for doc_id, document in documents.items() for i in document.get("dropped", {})]
+        if dropped:
+            restore_chunks(vectorstore, documents, dropped, keyword_index)
+        return None
+    threshold = st.sidebar.slider(
+        "重複とみなす類似度 (Jaccard)", min_value=0.5, max_value=1.0, value=0.8, step=0.05)
+    deduplicator = st.session_state.get("deduplicator")
+    if deduplicator is None or deduplicator.threshold != threshold:
+        deduplicator = ChunkDeduplicator(threshold=threshold)
+        # インデックスにあるチャンクを先に登録してから、除去していたチャンクを判定し直す
+        for doc_id, document in documents.items():
+            # 要約は重複判定の対象にしない
+            docs = [vectorstore.docstore.search(id_) for id_ in document["ids"]]
+            chunks = [doc for doc in docs if doc.metadata.get("tier", CHUNK_TIER) == CHUNK_TIER]
+            deduplicator.add(
+                doc_id, [doc.page_content for doc in chunks], [doc.metadata["chunk"] for doc in chunks])
+        restored = []
+        for doc_id, document in documents.items():
+            dropped = document.get("dropped", {})
+            indices = sorted(dropped)
+            keep, _ = deduplicator.add(doc_id, [dropped[i]["text"] for i in indices], indices)
+            restored += [(doc_id, i) for i in keep]
+        if restored:
+            restore_chunks(vectorstore, documents, restored, keyword_index)
+        st.session_state.deduplicator = deduplicator
+    return deduplicator
 
-def get_pdf_text():
-    pdf_file = st.file_uploader(
-        label="Upload your PDF here",
-        type="pdf"
+def select_compression():
+    """ ベクトルの保存形式を選ばせる (変更した場合は既存のインデックスを作り直す) """
+    compression = st.sidebar.selectbox(
+        "ベクトルの保存形式",
+        COMPRESSION_MODES,
+        help="float16 / int8 / pq はメモリ上のインデックスを圧縮し、検索時に元のベクトルで再計算します",
     )
-    if pdf_file:
-        pdf_text = ""
-        with st.spinner("Loading PDF..."):
-            pdf_doc = fitz.open(stream=pdf_file.read(), filetype="pdf")
-            for page in pdf_doc:
-                pdf_text += page.get_text()
-        text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
-            model_name="text-embedding-3-small",
-            # 適切な chunk_size は質問対象のPDFによって変わるため調整が必要
-            # 大きくしすぎると質問回答時に色々な個所の情報を参照することができない
-            # 逆に小さくしすぎると、一つのchunkに十分なサイズの文脈が入らない
-            chunk_size=500,
-            chunk_overlap=0,
-        )
-        return text_splitter.split_text(pdf_text)
-    else:
+    vectorstore = st.session_state.get("vectorstore")
+    if vectorstore is not None and getattr(vectorstore, "compression", "none") != compression:
+        with st.spinner("Converting vector store..."):
+            st.session_state.vectorstore = convert_vector_store(vectorstore, compression)
+    return compression
+
+def select_summarizer():
+    """ 要約インデックスを作るかどうか (作る場合は要約に使うモデルを返す) """
+    if not st.sidebar.checkbox(
+            "要約インデックスを作成する", value=False,
+            help="ページ・セクション・全体の要約を作り、「要約して」のような全体的な質問に使います (ページ数に応じてAPIを呼び出します)"):
         return None
-    
-def build_vector_store(pdf_text):
-    with st.spinner("Saving to vector store..."):
-        if 'vectorstore' in st.session_state:
-            st.session_state.vectorstore.add_texts(pdf_text)
-        else:
-            # ベクトルDBの初期化と文書の追加を同時に行う
-            # LangChain の Document Loader を利用した場合は `from_documents` にする
-            st.session_state.vectorstore = FAISS.from_texts(
-                pdf_text,
-                OpenAIEmbeddings(model="text-embedding-3-small"),
-            )
-
-            # FAISSのデフォルト設定はL2距離となっている
-            # コサイン類似度にしたい場合は以下のようにする
-            # from langchain_community.vectorstores.utils import DistanceStrategy
-            # st.session_state.vectorstore = FAISS.from_texts(
-            #     pdf_text,
-            #     OpenAIEmbeddings(model="text-embedding-3-small"),
-            #     distance_strategy=DistanceStrategy.COSINE
-            # )
+    return create_chat_model(SUMMARY_MODEL, temperature=0, app=APP_NAME)
+
+def display_memory_report():
+    """ 現在のインデックスのメモリ使用量と、圧縮方式ごとのメモリ/recall の比較を表示する """
+    vectorstore = st.session_state.get("vectorstore")
+    if vectorstore is None:
+        return
+    with st.sidebar.expander("メモリと検索精度"):
+        index_bytes = index_memory_bytes(vectorstore.index)
+        st.write(f"{vectorstore.index.ntotal} vectors / index {index_bytes / 1024:.1f} KB")
+        if getattr(vectorstore, "pq_pending", False):
+            st.caption(f"pq は {pq_train_size(vectorstore.index.d)} vectors 以上になるまで圧縮せずに持ちます")
+        if st.button("圧縮方式を比較する"):
+            st.dataframe(compare_compression(stored_vectors(vectorstore)))
+
+def get_pdf_files():
+    pdf_files = st.file_uploader(
+        label="Upload your PDF(s) here",
+        type="pdf",
+        accept_multiple_files=True,
+    )
+    files = []
+    uploaded = set()
+    for pdf_file in pdf_files or []:
+        data = pdf_file.getvalue()
+        # 同じ内容のPDFはインデックス済みなのでスキップする (再実行のたびに追加されないように)
+        doc_id = document_id(data)
+        uploaded.add(doc_id)
+        if (doc_id not in st.session_state.documents and doc_id not in st.session_state.deleted_documents
+                and doc_id not in st.session_state.skipped_documents
+                and doc_id not in st.session_state.failed_documents
+                and doc_id not in st.session_state.index_jobs):
+            files.append((pdf_file.name, data))
+    # アップローダーから外されたものは失敗の記録を消し、アップロードし直したときに再度投入する
+    for doc_id in list(st.session_state.failed_documents):
+        if doc_id not in uploaded:
+            del st.session_state.failed_documents[doc_id]
+            st.session_state.retry_documents.add(doc_id)
+    return files
+
+def submit_index_jobs(files, embeddings, summarizer=None):
+    """
+    抽出・分割・要約・埋め込みをバックグラウンドのジョブとして投入する
+
+    ジョブは内容で識別されるので、再実行や他のセッションで同じPDFを投入しても二重には実行されず、
+    完了済みならキャッシュした結果がすぐに返る
+    """
+    queue = get_job_queue()
+    for name, data in files:
+        doc_id = document_id(data)
+        key = index_job_key(name, data, summarize=summarizer is not None)
+        # 再試行・アップロードし直したものは、失敗したジョブを返さずにすぐ実行し直す
+        retry = doc_id in st.session_state.retry_documents
+        st.session_state.retry_documents.discard(doc_id)
+        job = queue.submit(key, index_document, name, data, embeddings, summarizer, label=name, retry=retry)
+        st.session_state.index_jobs[doc_id] = {"name": name, "job": job}
+
+@st.experimental_fragment(run_every=POLL_INTERVAL)
+def poll_index_jobs():
+    """ ジョブの進捗を表示し、全て終わったらページ全体を再実行して結果を追加させる """
+    jobs = [entry["job"] for entry in st.session_state.index_jobs.values()]
+    if not display_job_progress(jobs):
+        st.rerun()
+
+def add_finished_documents(embeddings, deduplicator=None, compression="none"):
+    """ 完了したジョブの結果をベクトルストアと BM25 の転置インデックスに追加する """
+    finished = {
+        doc_id: entry for doc_id, entry in st.session_state.index_jobs.items() if entry["job"].done
+    }
+    if not finished:
+        return
+    # BM25 の転置インデックスはベクトルストアと並べて持ち、チャンクの追加・削除に合わせて更新する
+    if "keyword_index" not in st.session_state:
+        st.session_state.keyword_index = build_keyword_index(st.session_state.get("vectorstore"))
+    keyword_index = st.session_state.keyword_index
+
+    dropped = 0
+    # インデックスへの追加にかかった時間 (抽出・埋め込みは含まない)
+    vector_sec = keyword_sec = 0.0
+    for doc_id, entry in finished.items():
+        del st.session_state.index_jobs[doc_id]
+        name, job = entry["name"], entry["job"]
+        # 結果はジョブのキャッシュから読み込む (メモリには残していない)
+        result = job.result
+        if job.error is not None or result is None:
+            # 再実行のたびに投入し直さないよう記録しておく (エラーは display_failed_documents で表示する)
+            st.session_state.failed_documents[doc_id] = {
+                "name": name, "error": job.error or "結果のキャッシュが見つかりません"}
+            continue
+        # 同じファイル名で内容が違う場合は、古いドキュメントを差し替える
+        # (古い版のチャンクと重複判定されないよう、追加する前に削除しておく)
+        for old_id, document in list(st.session_state.documents.items()):
+            if document["name"] == name:
+                delete_document(st.session_state.vectorstore, st.session_state.documents, old_id,
+                                deduplicator, keyword_index)
+                # アップローダーには古い版も残っているので、再実行で古い版が追加し直されないようにする
+                st.session_state.deleted_documents.add(old_id)
+
+        prepared = prepare_document(name, doc_id, result, deduplicator)
+        if prepared["dedup"]:
+            dropped += prepared["dedup"]["exact"] + prepared["dedup"]["near"]
+        if not prepared["texts"]:
+            # テキストがない・全て重複だったドキュメントは、再実行のたびに読み込み直して警告しないよう記録しておく
+            st.session_state.skipped_documents.add(doc_id)
+            st.warning(f"{name} に新しいテキストがありませんでした")
+            continue
+
+        started = time.perf_counter()
+        st.session_state.vectorstore = add_document(
+            st.session_state.get("vectorstore"), prepared, embeddings, compression)
+        vector_sec += time.perf_counter() - started
+        started = time.perf_counter()
+        keyword_index.add(prepared["ids"], prepared["texts"])
+        keyword_sec += time.perf_counter() - started
+        st.session_state.documents[doc_id] = {
+            "name": name,
+            "ids": prepared["ids"],
+            "chunks": prepared["chunks"],
+            "summaries": prepared["summaries"],
+            "dedup": prepared["dedup"],
+            # 重複として除去したチャンク (重複元が削除されたらインデックスに戻す)
+            "dropped": prepared["dropped"],
+        }
+    if deduplicator is not None:
+        st.info(f"重複チャンクを {dropped} 件除去しました")
+    st.caption(f"インデックスへの追加: ベクトル {vector_sec * 1000:.0f} ms / BM25 {keyword_sec * 1000:.0f} ms")
+
+def display_failed_documents():
+    """ 読み込みに失敗したドキュメントと、再試行のボタンを表示する """
+    for doc_id, failure in list(st.session_state.failed_documents.items()):
+        col_error, col_button = st.columns([4, 1])
+        col_error.error(f"{failure['name']} の読み込みに失敗しました: {failure['error']}")
+        if col_button.button("Retry", key=f"retry-{doc_id}"):
+            # 記録を消せば、アップローダーに残っているファイルが次の実行で投入し直される
+            del st.session_state.failed_documents[doc_id]
+            st.session_state.retry_documents.add(doc_id)
+            st.rerun()
+
+def manage_documents():
+    if not st.session_state.documents:
+        return
+    st.markdown("## Documents")
+    for doc_id, document in list(st.session_state.documents.items()):
+        col_name, col_button = st.columns([4, 1])
+        dedup = document.get("dedup")
+        dropped = f", {dedup['exact']} exact / {dedup['near']} near duplicates dropped" if dedup else ""
+        summaries = f", {document['summaries']} summaries" if document.get("summaries") else ""
+        col_name.write(f"{document['name']} ({document['chunks']} chunks{summaries}{dropped})")
+        if col_button.button("Delete", key=f"delete-{doc_id}"):
+            delete_document(st.session_state.vectorstore, st.session_state.documents, doc_id,
+                            st.session_state.get("deduplicator"), st.session_state.get("keyword_index"))
+            st.session_state.deleted_documents.add(doc_id)
+            if not st.session_state.documents:
+                del st.session_state.vectorstore
+                st.session_state.pop("keyword_index", None)
+            st.rerun()
 
 def page_pdf_upload_and_build_vector_db():
     st.title("PDF Upload📃")
-    pdf_text = get_pdf_text()
-    if pdf_text:
-        build_vector_store(pdf_text)
+    deduplicator = select_deduplicator()
+    compression = select_compression()
+    summarizer = select_summarizer()
+    # 埋め込みの呼び出しもレート制限の対象にする (langchain_openai はここで初めて読み込まれる)
+    embeddings = create_embeddings(EMBEDDING_MODEL)
+    files = get_pdf_files()
+    if files:
+        submit_index_jobs(files, embeddings, summarizer)
+    add_finished_documents(embeddings, deduplicator, compression)
+    # ジョブの処理中も画面は操作でき、ページを移動しても処理は続く
+    if st.session_state.index_jobs:
+        poll_index_jobs()
+    display_failed_documents()
+    manage_documents()
+    display_memory_report()
+    display_memory_metrics()
 
 def main():
     init_page()
@@ -72,4 +293,6 @@ def main():
     page_pdf_upload_and_build_vector_db()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # インデックスは、操作されていない間ディスクに退避できるようにする
+    with track_session_memory(["vectorstore"]):
+        main()
@@ -1,11 +1,25 @@
+import sys
+from pathlib import Path
 import streamlit as st
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.runnables import RunnablePassthrough
 from langchain_core.output_parsers import StrOutputParser
 
+# chapter_007 直下の summary_index・hybrid_search と、リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
 # models
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
+from common.models import MODELS, create_chat_model
+from common.routing import select_fallback
+from common.rate_limit import display_rate_limit_metrics
+from common.session_memory import track_session_memory
+from common.streaming import cancellable_stream, write_stream
+from hybrid_search import HybridRetriever, build_keyword_index
+from summary_index import CHUNK_TIER, SUMMARY_TIERS, question_tiers
+
+# 使用量の計測(common.metering)で使うアプリ名
+APP_NAME = "chapter_007"
 
 def init_page():
     st.set_page_config(
@@ -20,23 +34,63 @@ def select_model():
     temperature = st.sidebar.slider(
         "Temperature", min_value=0.0, max_value=2.0, value=0.0, step=0.01)
     
-    models = ["gpt-4o-mini", "claude-3-5-sonnet-20240620"]
-    model = st.sidebar.radio("Choose a Model", models)
-    if model == "gpt-4o-mini":
-        st.session_state.model_name = "gpt-4o-mini"
-        return ChatOpenAI(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
-    elif model == "claude-3-5-sonnet-20240620":
-        st.session_state.model_name = "claude-3-5-sonnet-20240620"
-        return ChatAnthropic(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
+    model = st.sidebar.radio("Choose a Model", MODELS)
+    st.session_state.model_name = model
+    # 応答が遅い・エラーの場合に別プロバイダのモデルへ切り替える設定
+    fallback_model, hedge_delay = select_fallback(model, MODELS)
+    # 同じプロセスの全アプリで共有しているレート制限の待ち状況
+    display_rate_limit_metrics()
+    return create_chat_model(
+        model, temperature, app=APP_NAME,
+        fallback_model=fallback_model, hedge_delay=hedge_delay)
     
-def init_qa_chain():
-    llm = select_model()
+def select_documents():
+    """ 質問の対象にするドキュメントを選ばせ、検索用のフィルタを返す """
+    documents = st.session_state.get("documents", {})
+    if not documents:
+        return None
+    doc_ids = st.sidebar.multiselect(
+        "対象のドキュメント",
+        options=list(documents),
+        default=list(documents),
+        format_func=lambda doc_id: documents[doc_id]["name"],
+    )
+    if not doc_ids or len(doc_ids) == len(documents):
+        return None
+    return {"doc_id": doc_ids}
+
+def select_search_tier():
+    """ チャンク・要約のどちらから検索するか ("自動" の場合は質問の内容から判断する) """
+    return st.sidebar.radio(
+        "検索対象", ["自動", "チャンク", "要約"],
+        help="要約はアップロード時に「要約インデックスを作成する」を選んだドキュメントにだけあります")
+
+def select_retrieval():
+    """ 検索方式と、回答に使うチャンクの数を選ばせる """
+    method = st.sidebar.radio(
+        "検索方式", ["ハイブリッド", "ベクトル"],
+        help="ハイブリッドは BM25 (キーワード) とベクトル検索の結果を統合します。型番やエラーコードなどの検索に強くなります")
+    k = st.sidebar.slider("回答に使うチャンクの数", min_value=1, max_value=10, value=5)
+    return method, k
+
+def get_keyword_index():
+    # BM25 のインデックスがない (このページの追加前に作られた) ベクトルストアは、ここで作る
+    if "keyword_index" not in st.session_state:
+        st.session_state.keyword_index = build_keyword_index(st.session_state.vectorstore)
+    return st.session_state.keyword_index
+
+def search_tiers(query, tier, search_filter):
+    """ 質問をどの階層 (チャンク・要約) から検索するか """
+    documents = st.session_state.get("documents", {})
+    doc_ids = search_filter["doc_id"] if search_filter else list(documents)
+    # 要約を作っていないドキュメントしかなければチャンクから検索する
+    if not any(documents.get(doc_id, {}).get("summaries") for doc_id in doc_ids):
+        return [CHUNK_TIER]
+    if tier == "自動":
+        return question_tiers(query)
+    return SUMMARY_TIERS if tier == "要約" else [CHUNK_TIER]
+
+def init_qa_chain(llm, retriever):
     prompt = ChatPromptTemplate.from_template("""
     以下の前提知識を用いて、ユーザーからの質問に答えてください
     
@@ -47,13 +101,6 @@ def init_qa_chain():
     ユーザーの質問
     {question}
     """)
-    retriever = st.session_state.vectorstore.as_retriever(
-        # "mmr" , "similarity_score_threshold" を指定することもできる
-        search_type="similarity",
-
-        # 文書を何個取得するか (default: 4)
-        search_kwargs={"k":10}
-    )
     chain = (
         {"context": retriever, "question": RunnablePassthrough()}
         | prompt
@@ -62,12 +109,44 @@ def init_qa_chain():
     )
     return chain
 
+def init_retriever(search_filter, tiers, method, k):
+    # チャンクと要約は同じベクトルストアに入っているので、metadata の tier で絞り込む
+    search_filter = {**(search_filter or {}), "tier": tiers}
+    return HybridRetriever(
+        vectorstore=st.session_state.vectorstore,
+        keyword_index=get_keyword_index() if method == "ハイブリッド" else None,
+        # 要約は1つで広い範囲をカバーするので、チャンクより少なくてよい
+        k=k if CHUNK_TIER in tiers else min(k, 4),
+        search_filter=search_filter,
+    )
+
+def display_retrieval_latency(retriever):
+    timings = retriever.timings
+    detail = " / ".join(
+        f"{label} {timings[key]:.0f} ms"
+        for key, label in [("vector", "ベクトル"), ("bm25", "BM25"), ("fusion", "統合")]
+        if key in timings)
+    st.caption(f"検索: {sum(timings.values()):.0f} ms ({detail})")
+
 def page_ask_my_pdfs():
-    chain = init_qa_chain()
+    llm = select_model()
+    search_filter = select_documents()
+    tier = select_search_tier()
+    method, k = select_retrieval()
 
     if query := st.text_input("PDFへの質問を書いてね: ", key="input"):
+        tiers = search_tiers(query, tier, search_filter)
+        retriever = init_retriever(search_filter, tiers, method, k)
+        chain = init_qa_chain(llm, retriever)
         st.markdown("## Answer")
-        st.write_stream(chain.stream(query))
+        if CHUNK_TIER not in tiers:
+            st.caption("要約から回答します")
+        elif len(tiers) > 1:
+            st.caption("要約とチャンクから回答します")
+        else:
+            st.caption("チャンクから回答します")
+        write_stream(cancellable_stream(chain, query))
+        display_retrieval_latency(retriever)
 
 def main():
     init_page()
@@ -78,4 +157,6 @@ def main():
         page_ask_my_pdfs()
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # インデックスは、操作されていない間ディスクに退避できるようにする
+    with track_session_memory(["vectorstore"]):
+        main()
\ No newline at end of file
@@ -0,0 +1,200 @@
+"""
+PDFのインデックス作成 (1_Upload_PDF.py から利用)
+
+ドキュメントごとにIDを振り、各チャンクのメタデータに doc_id を入れておくことで、
+ドキュメント単位での削除・差し替えや、質問時の絞り込み検索ができるようにしている。
+要約インデックス (summary_index) を作る場合は、要約も同じベクトルストアに入れ、
+メタデータの tier でチャンクと区別する。
+
+抽出・分割・要約・埋め込みは common.jobs のジョブ (index_document) としてバックグラウンドで行い、
+結果はPDFの内容ごとにキャッシュする。ベクトルストアへの追加はセッションごとにページ側で行う。
+"""
+import hashlib
+
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from common.jobs import job_key, run_in_process
+from summary_index import CHUNK_TIER, SUMMARY_MODEL, summarize_document
+from vector_compression import create_vector_store
+
+EMBEDDING_MODEL = "text-embedding-3-small"
+# 1回の埋め込みの呼び出しで送るテキストの数 (この単位で進捗を報告する)
+EMBED_BATCH = 100
+
+
+def document_id(data):
+    """ PDFの中身からドキュメントIDを作る (同じ内容なら同じID) """
+    return hashlib.sha256(data).hexdigest()[:16]
+
+def extract_pages(data):
+    """ ページごとのテキストと目次 (get_toc() の戻り値) を返す """
+    # PyMuPDF は読み込みに時間がかかるので、最初にPDFを処理するときに読み込む
+    import fitz # PyMuPDF
+    pdf_doc = fitz.open(stream=data, filetype="pdf")
+    return [page.get_text() for page in pdf_doc], pdf_doc.get_toc()
+
+def split_text(text):
+    text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
+        model_name=EMBEDDING_MODEL,
+        # 適切な chunk_size は質問対象のPDFによって変わるため調整が必要
+        # 大きくしすぎると質問回答時に色々な個所の情報を参照することができない
+        # 逆に小さくしすぎると、一つのchunkに十分なサイズの文脈が入らない
+        chunk_size=500,
+        chunk_overlap=0,
+    )
+    return text_splitter.split_text(text)
+
+
+def extract_chunks(data):
+    """ ページごとのテキスト・目次・チャンクを返す (CPU を使うので、ジョブからはプロセスプールで実行する) """
+    pages, toc = extract_pages(data)
+    return pages, toc, split_text("".join(pages))
+
+def index_job_key(name, data, summarize=False):
+    """ index_document のジョブのキー (要約にはファイル名が入るので、要約する場合は名前もキーに含める) """
+    if summarize:
+        return job_key("pdf_index", EMBEDDING_MODEL, data, SUMMARY_MODEL, name)
+    return job_key("pdf_index", EMBEDDING_MODEL, data)
+
+def index_document(job, name, data, embeddings, summarizer=None):
+    """
+    1つのPDFの抽出・分割・要約・埋め込みを行う (common.jobs のジョブとして実行される)
+
+    結果はPDFの内容 (と要約の有無) だけで決まるので、キャッシュとして他のセッションからも再利用される。
+    重複チャンクの除去はセッションごとの状態に依存するので、ここでは行わず prepare_document で行う
+    """
+    job.report(0.0, "テキストを抽出しています")
+    pages, toc, chunks = run_in_process(extract_chunks, data)
+    summaries = []
+    if summarizer is not None:
+        job.report(0.1, "要約しています")
+        summaries = summarize_document(name, pages, toc, summarizer)
+    texts = chunks + [summary["text"] for summary in summaries]
+    vectors = []
+    for start in range(0, len(texts), EMBED_BATCH):
+        job.report(0.3 + 0.7 * start / len(texts), f"埋め込みを作成しています ({start}/{len(texts)})")
+        vectors.extend(embeddings.embed_documents(texts[start:start + EMBED_BATCH]))
+    return {
+        "chunks": chunks,
+        "chunk_vectors": vectors[:len(chunks)],
+        "summaries": summaries,
+        "summary_vectors": vectors[len(chunks):],
+    }
+
+def prepare_document(name, doc_id, indexed, deduplicator=None):
+    """
+    index_document の結果から、ベクトルストアに追加するテキスト・メタデータ・ベクトルを作る
+
+    deduplicator (dedup.ChunkDeduplicator) を渡すと、重複チャンクを取り除く。
+    取り除いたチャンクは、重複元のドキュメントが削除されたときに戻せるよう dropped に入れておく
+    """
+    chunks = indexed["chunks"]
+    dropped = {}
+    if deduplicator is not None:
+        keep, dedup_stats = deduplicator.add(doc_id, chunks)
+        for i, kind in dedup_stats.pop("dropped").items():
+            dropped[i] = {
+                "text": chunks[i],
+                "vector": np.asarray(indexed["chunk_vectors"][i], dtype=np.float32),
+                "kind": kind,
+            }
+    else:
+        keep, dedup_stats = list(range(len(chunks))), None
+    texts = [chunks[i] for i in keep]
+    vectors = [indexed["chunk_vectors"][i] for i in keep]
+    metadatas = [
+        {"doc_id": doc_id, "source": name, "tier": CHUNK_TIER, "chunk": i}
+        for i in keep
+    ]
+    ids = [f"{doc_id}-{i}" for i in keep]
+
+    # 要約は重複除去の対象にしない
+    summaries = indexed["summaries"]
+    for i, (summary, vector) in enumerate(zip(summaries, indexed["summary_vectors"])):
+        texts.append(summary["text"])
+        vectors.append(vector)
+        metadatas.append({
+            "doc_id": doc_id, "source": name, "tier": summary["tier"],
+            "title": summary["title"], "pages": summary["pages"],
+        })
+        ids.append(f"{doc_id}-{summary['tier']}-{i}")
+
+    return {
+        "doc_id": doc_id,
+        "name": name,
+        "texts": texts,
+        "metadatas": metadatas,
+        "ids": ids,
+        "vectors": vectors,
+        "chunks": len(keep),
+        "summaries": len(summaries),
+        "dedup": dedup_stats,
+        "dropped": dropped,
+    }
+
+
+def add_document(vectorstore, prepared, embeddings, compression="none"):
+    """
+    準備済みのドキュメントをベクトルストアに追加する (なければ作成して返す)
+
+    compression は新しく作る場合のベクトルの保存形式 (vector_compression.COMPRESSION_MODES)
+    """
+    if vectorstore is None:
+        # FAISSのデフォルト設定はL2距離となっている
+        # (圧縮インデックスの re-scoring も L2距離で行う)
+        vectorstore = create_vector_store(embeddings, len(prepared["vectors"][0]), compression)
+    vectorstore.add_embeddings(
+        list(zip(prepared["texts"], prepared["vectors"])),
+        metadatas=prepared["metadatas"],
+        ids=prepared["ids"],
+    )
+    return vectorstore
+
+def restore_chunks(vectorstore, documents, keys, keyword_index=None):
+    """
+    重複として取り除いていたチャンクをベクトルストア (と BM25 の転置インデックス) に戻す
+
+    keys は (doc_id, チャンクの番号) のリスト (ChunkDeduplicator.remove の戻り値など)。
+    取り除いていないチャンクは無視する。戻したチャンクの数を返す
+    """
+    restored = {}
+    for doc_id, i in keys:
+        if i in documents.get(doc_id, {}).get("dropped", {}):
+            restored.setdefault(doc_id, []).append(i)
+    for doc_id, indices in restored.items():
+        document = documents[doc_id]
+        entries = [document["dropped"].pop(i) for i in indices]
+        texts = [entry["text"] for entry in entries]
+        ids = [f"{doc_id}-{i}" for i in indices]
+        vectorstore.add_embeddings(
+            list(zip(texts, [entry["vector"].tolist() for entry in entries])),
+            metadatas=[
+                {"doc_id": doc_id, "source": document["name"], "tier": CHUNK_TIER, "chunk": i}
+                for i in indices
+            ],
+            ids=ids,
+        )
+        if keyword_index is not None:
+            keyword_index.add(ids, texts)
+        document["ids"].extend(ids)
+        document["chunks"] += len(ids)
+        if document.get("dedup"):
+            for entry in entries:
+                document["dedup"][entry["kind"]] -= 1
+            document["dedup"]["kept"] += len(entries)
+    return sum(len(indices) for indices in restored.values())
+
+def delete_document(vectorstore, documents, doc_id, deduplicator=None, keyword_index=None):
+    """
+    ドキュメントのチャンクをベクトルストア (と BM25 の転置インデックス) から削除する (インデックスの再構築はしない)
+
+    他のドキュメントで、このドキュメントのチャンクの重複として取り除いていたチャンクはインデックスに戻す
+    """
+    document = documents.pop(doc_id)
+    if document["ids"]:
+        vectorstore.delete(document["ids"])
+        if keyword_index is not None:
+            keyword_index.remove(document["ids"])
+    if deduplicator is not None:
+        restore_chunks(vectorstore, documents, deduplicator.remove(doc_id), keyword_index)
@@ -0,0 +1,169 @@
+"""
+PDFの要約インデックス (ページ → セクション → ドキュメントの階層的な要約)
+
+「第3章を要約して」「このドキュメントは何について書かれている?」のような全体的な質問は、
+チャンクの top-k 検索では内容の一部しか拾えず、k を大きくするとプロンプトが膨らむ。
+そこでインデックス作成時に、ページごと・セクションごと・ドキュメント全体の要約を作り、
+チャンクとは別の階層 (metadata の tier) としてベクトルストアに入れておく。
+全体的な質問には要約の階層から、具体的な質問にはチャンクから検索する
+(全体的な言い回しでも、エラーコードのような具体的な語を含む場合は両方から検索する)。
+
+- ページの要約はページ本文から、セクションの要約はページの要約から、
+  ドキュメントの要約はセクションの要約から作る (上の階層ほど入力が小さい)
+- 同じ階層の要約はまとめて並列に作る (llm.batch)
+- セクションはPDFの目次(しおり)の最上位の項目で区切り、目次がなければ SECTION_PAGES ページごとに区切る
+"""
+import re
+
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.prompts import ChatPromptTemplate
+
+# 要約の作成に使うモデル (ページ数だけ呼び出すので安いモデルにする)
+SUMMARY_MODEL = "gpt-4o-mini"
+# 目次がない場合に1セクションにまとめるページ数
+SECTION_PAGES = 5
+# 同時に要約を作る数
+MAX_CONCURRENCY = 8
+# これより短いページ (表紙・白紙など) は要約しない
+MIN_PAGE_CHARS = 50
+# 1ページの本文はこの文字数までを要約に使う
+MAX_PAGE_CHARS = 6000
+
+CHUNK_TIER = "chunk"
+SUMMARY_TIERS = ["document", "section", "page"]
+
+PAGE_PROMPT = """以下はPDF「{source}」の {pages} ページ目の本文です。
+このページの内容を、後から検索できるよう重要な用語を残して200文字程度で要約してください。
+
+======
+{text}
+======
+"""
+
+SECTION_PROMPT = """以下はPDF「{source}」の「{title}」({pages} ページ) の各ページの要約です。
+このセクション全体の内容を400文字程度で要約してください。
+
+======
+{text}
+======
+"""
+
+DOCUMENT_PROMPT = """以下はPDF「{source}」の各セクションの要約です。
+このドキュメントが何について書かれているか、全体の構成と要点を600文字程度で要約してください。
+
+======
+{text}
+======
+"""
+
+# 全体的な質問とみなす表現 (要約の階層から検索する)
+# 「章」「構成」のような語だけでは「第3章のエラーコードE-102は?」のような具体的な質問にも当たるので、
+# 要約や全体像を求める言い回しに限る
+BROAD_QUESTION = re.compile(
+    r"要約|要旨|概要|まとめて|まとめると|あらすじ|全体像|全体の(内容|構成|流れ)|全体として|"
+    r"何について|どんな内容|主な内容|構成を(教え|説明)|"
+    r"summar|overview|outline|what is (this|the) (document|pdf|paper|book|chapter|section) about|"
+    r"main (points|topics|ideas)",
+    re.IGNORECASE,
+)
+# 要約には残っていないことがある具体的な語 (型番・エラーコード・バージョン番号・括弧で囲んだ語句)
+SPECIFIC_TERM = re.compile(
+    r"[A-Za-z]+[-_]?\d[\w.-]*|\d+(\.\d+){2,}|「[^」]+」|\"[^\"]+\"",
+)
+
+
+def is_broad_question(question):
+    """ ドキュメントやセクション全体についての質問かどうか (簡易的な判定) """
+    return BROAD_QUESTION.search(question) is not None
+
+def question_tiers(question):
+    """ 質問をどの階層から検索するか (tier のリスト) を返す """
+    if not is_broad_question(question):
+        return [CHUNK_TIER]
+    if SPECIFIC_TERM.search(question):
+        # 要約だけでは答えられないことがあるので、チャンクからも検索する
+        return SUMMARY_TIERS + [CHUNK_TIER]
+    return SUMMARY_TIERS
+
+
+def split_sections(page_count, toc):
+    """
+    セクションの (タイトル, 開始ページ, 終了ページ) のリストを返す (ページは 1 始まり)
+
+    toc は PyMuPDF の get_toc() の戻り値 ([レベル, タイトル, ページ] のリスト)
+    """
+    starts = [(title.strip(), page) for level, title, page in toc if level == 1 and 1 <= page <= page_count]
+    if not starts:
+        return [
+            (f"p.{start}-{min(start + SECTION_PAGES - 1, page_count)}",
+             start, min(start + SECTION_PAGES - 1, page_count))
+            for start in range(1, page_count + 1, SECTION_PAGES)
+        ]
+    if starts[0][1] > 1:
+        starts.insert(0, ("(前付け)", 1))
+    sections = []
+    for i, (title, start) in enumerate(starts):
+        end = starts[i + 1][1] - 1 if i + 1 < len(starts) else page_count
+        if end >= start:
+            sections.append((title, start, end))
+    return sections
+
+
+def _page_range(start, end):
+    return str(start) if start == end else f"{start}-{end}"
+
+def _summarize(llm, prompt, inputs, max_concurrency):
+    if not inputs:
+        return []
+    chain = ChatPromptTemplate.from_template(prompt) | llm | StrOutputParser()
+    return chain.batch(inputs, config={"max_concurrency": max_concurrency})
+
+
+def summarize_document(source, pages, toc, llm, max_concurrency=MAX_CONCURRENCY):
+    """
+    ページ・セクション・ドキュメントの要約を作り、
+    {"tier", "title", "pages", "text"} のリストで返す (text は検索用にタイトルを付けたもの)
+    """
+    page_inputs = [
+        {"source": source, "pages": number, "text": text[:MAX_PAGE_CHARS]}
+        for number, text in enumerate(pages, start=1)
+        if len(text.strip()) >= MIN_PAGE_CHARS
+    ]
+    page_summaries = dict(zip(
+        (item["pages"] for item in page_inputs),
+        _summarize(llm, PAGE_PROMPT, page_inputs, max_concurrency),
+    ))
+
+    sections = []
+    for title, start, end in split_sections(len(pages), toc):
+        summaries = [page_summaries[n] for n in range(start, end + 1) if n in page_summaries]
+        if summaries:
+            sections.append((title, start, end, summaries))
+    section_summaries = _summarize(llm, SECTION_PROMPT, [
+        {"source": source, "title": title, "pages": _page_range(start, end),
+         "text": "\n\n".join(f"- {summary}" for summary in summaries)}
+        for title, start, end, summaries in sections
+    ], max_concurrency)
+
+    results = [
+        {"tier": "page", "title": f"p.{number}", "pages": str(number),
+         "text": f"{source} p.{number}\n{summary}"}
+        for number, summary in page_summaries.items()
+    ]
+    results += [
+        {"tier": "section", "title": title, "pages": _page_range(start, end),
+         "text": f"{source} / {title} (p.{_page_range(start, end)})\n{summary}"}
+        for (title, start, end, _), summary in zip(sections, section_summaries)
+    ]
+    if section_summaries:
+        (document_summary,) = _summarize(llm, DOCUMENT_PROMPT, [{
+            "source": source,
+            "text": "\n\n".join(
+                f"## {title}\n{summary}"
+                for (title, _, _, _), summary in zip(sections, section_summaries)),
+        }], max_concurrency)
+        results.append({
+            "tier": "document", "title": source, "pages": _page_range(1, len(pages)),
+            "text": f"{source} (全体の要約)\n{document_summary}",
+        })
+    return results
@@ -0,0 +1,293 @@
+"""
+PDFインデックスのベクトル圧縮
+
+text-embedding-3-small は 1536次元の float32 なので、1チャンクあたり 6KB になる。
+セッションごとにインデックスを持つと、利用者が増えるとすぐにメモリが足りなくなるため、
+メモリ上のインデックスは圧縮した形式で持つ。
+
+- float16: スカラー量子化 (半精度)      1チャンク 3KB
+- int8:    スカラー量子化 (8bit)        1チャンク 1.5KB
+- pq:      直積量子化 (96 x 8bit)       1チャンク 96B
+
+PQ はサブベクトルごとに 256 個のセントロイドを学習するので、その数のベクトルが揃うまでは
+圧縮せずに (IndexFlatL2 で) 持ち、揃った時点で全ベクトルで学習したインデックスに作り直す。
+
+圧縮すると距離が近似になるので、候補を k の RESCORE_FACTOR 倍取ってから、ディスク上に置いた
+元の float32 ベクトルで距離を計算し直して (re-scoring) 上位を返す。候補の中での順位とスコアは
+IndexFlatL2 と同じになるが、近似の距離で候補から漏れたチャンクは返らないことがある。
+"""
+import uuid
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.faiss import dependable_faiss_import
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+
+from common.paths import data_path
+
+COMPRESSION_MODES = ["none", "float16", "int8", "pq"]
+# PQ のサブベクトルの数 (1536次元なら16次元ずつ)
+PQ_SUBVECTORS = 96
+# PQ のサブベクトルごとのビット数 (セントロイドは 2^8 = 256 個)
+PQ_NBITS = 8
+# 圧縮インデックスから k の何倍の候補を取って re-scoring するか
+RESCORE_FACTOR = 4
+
+
+def pq_subvectors(dim):
+    return PQ_SUBVECTORS if dim % PQ_SUBVECTORS == 0 else 1
+
+def pq_train_size(dim):
+    """ PQ の学習に使うベクトルの数の下限 (これより少ない間は圧縮しない) """
+    return 2 ** PQ_NBITS * pq_subvectors(dim)
+
+def create_index(mode, dim):
+    """ 圧縮方式に応じた FAISS のインデックスを作る (学習は呼び出し側で行う) """
+    # faiss は読み込みに時間がかかるので、最初にインデックスを作るときに読み込む
+    faiss = dependable_faiss_import()
+    if mode == "none":
+        return faiss.IndexFlatL2(dim)
+    if mode == "float16":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_L2)
+    if mode == "int8":
+        return faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_L2)
+    if mode == "pq":
+        return faiss.IndexPQ(dim, pq_subvectors(dim), PQ_NBITS, faiss.METRIC_L2)
+    raise ValueError(f"Unknown compression mode: {mode}")
+
+def build_index(mode, vectors):
+    """ vectors で学習・追加したインデックスを作る (PQ の学習に足りない場合は圧縮しない) """
+    dim = vectors.shape[1]
+    if mode == "pq" and len(vectors) < pq_train_size(dim):
+        mode = "none"
+    index = create_index(mode, dim)
+    if not index.is_trained:
+        index.train(vectors)
+    index.add(vectors)
+    return index
+
+
+class FullPrecisionVectors:
+    """
+    re-scoring 用の float32 ベクトルをディスク上のファイルに置いておく
+
+    読み出しは memmap 経由なので、メモリに載るのは実際に参照した行だけになる
+    """
+
+    def __init__(self, dim, path=None):
+        self.dim = dim
+        self.path = path or data_path("vectors", f"{uuid.uuid4().hex}.f32")
+        self.path.touch()
+        self._rows = 0
+        self._memmap = None
+
+    def __len__(self):
+        return self._rows
+
+    def append(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        with open(self.path, "ab") as f:
+            f.write(vectors.tobytes())
+        self._rows += len(vectors)
+        self._memmap = None
+
+    def get(self, positions):
+        if self._memmap is None:
+            self._memmap = np.memmap(self.path, dtype=np.float32, mode="r", shape=(self._rows, self.dim))
+        return np.asarray(self._memmap[positions])
+
+    def remove(self, positions):
+        """ 指定した行を削除して詰める (FAISS の remove_ids と同じ並びになる) """
+        keep = np.setdiff1d(np.arange(self._rows), np.fromiter(positions, dtype=np.int64))
+        remaining = self.get(keep)
+        self._memmap = None
+        with open(self.path, "wb") as f:
+            f.write(remaining.tobytes())
+        self._rows = len(remaining)
+
+    def __del__(self):
+        try:
+            self._memmap = None
+            self.path.unlink(missing_ok=True)
+        except Exception:
+            pass
+
+
+class CompressedFAISS(FAISS):
+    """ 圧縮インデックス + 元ベクトルでの re-scoring を行う FAISS ベクトルストア """
+
+    def __init__(self, *args, compression="int8", rescore_factor=RESCORE_FACTOR, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression = compression
+        self.rescore_factor = rescore_factor
+        self.full_vectors = FullPrecisionVectors(self.index.d)
+
+    @classmethod
+    def create(cls, embedding, dim, compression="int8", rescore_factor=RESCORE_FACTOR):
+        """
+        空のベクトルストアを作る
+
+        スカラー量子化のインデックスは最初に追加したベクトルで学習する。
+        PQ は学習に必要な数のベクトルが揃うまで、圧縮しないインデックスで始める
+        """
+        return cls(
+            embedding,
+            create_index("none" if compression == "pq" else compression, dim),
+            InMemoryDocstore(),
+            {},
+            compression=compression,
+            rescore_factor=rescore_factor,
+        )
+
+    @property
+    def pq_pending(self):
+        """ PQ の学習に必要な数のベクトルが揃うのを待っている (まだ圧縮していない) かどうか """
+        return self.compression == "pq" and not isinstance(self.index, dependable_faiss_import().IndexPQ)
+
+    def _train(self, vectors):
+        if not self.index.is_trained:
+            self.index.train(vectors)
+
+    def _build_pq(self):
+        """ PQ の学習に必要な数のベクトルが揃ったら、全ベクトルで学習したインデックスに作り直す """
+        if self.compression != "pq" or isinstance(self.index, dependable_faiss_import().IndexPQ):
+            return
+        if self.index.ntotal < pq_train_size(self.index.d):
+            return
+        # 並び順は変わらないので、index_to_docstore_id はそのまま使える
+        self.index = build_index("pq", self.full_vectors.get(np.arange(len(self.full_vectors))))
+
+    def add_embeddings(self, text_embeddings, metadatas=None, ids=None, **kwargs):
+        text_embeddings = list(text_embeddings)
+        vectors = np.array([vector for _, vector in text_embeddings], dtype=np.float32)
+        self._train(vectors)
+        ids = super().add_embeddings(text_embeddings, metadatas=metadatas, ids=ids, **kwargs)
+        self.full_vectors.append(vectors)
+        self._build_pq()
+        return ids
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        embeddings = self._embed_documents(texts)
+        return self.add_embeddings(zip(texts, embeddings), metadatas=metadatas, ids=ids, **kwargs)
+
+    def delete(self, ids=None, **kwargs):
+        reversed_index = {id_: idx for idx, id_ in self.index_to_docstore_id.items()}
+        positions = {reversed_index[id_] for id_ in ids or [] if id_ in reversed_index}
+        result = super().delete(ids, **kwargs)
+        self.full_vectors.remove(positions)
+        return result
+
+    def similarity_search_with_score_by_vector(self, embedding, k=4, filter=None, fetch_k=20, **kwargs):
+        if self.distance_strategy != DistanceStrategy.EUCLIDEAN_DISTANCE:
+            return super().similarity_search_with_score_by_vector(
+                embedding, k=k, filter=filter, fetch_k=fetch_k, **kwargs)
+
+        vector = np.array([embedding], dtype=np.float32)
+        # 圧縮インデックスでは多めに候補を取っておく
+        candidates = (k if filter is None else fetch_k) * self.rescore_factor
+        _, indices = self.index.search(vector, candidates)
+        positions = np.array([i for i in indices[0] if i != -1], dtype=np.int64)
+        if len(positions) == 0:
+            return []
+
+        # 候補を元の float32 ベクトルで L2距離(の2乗)で計算し直す
+        # (候補の中では IndexFlatL2 と同じスコアと順位になる。候補に入らなかったものは返らない)
+        exact = ((self.full_vectors.get(positions) - vector) ** 2).sum(axis=1)
+        order = np.argsort(exact)
+
+        filter_func = self._create_filter_func(filter) if filter is not None else None
+        score_threshold = kwargs.get("score_threshold")
+        docs = []
+        for j in order:
+            doc = self.docstore.search(self.index_to_docstore_id[int(positions[j])])
+            if not isinstance(doc, Document):
+                raise ValueError(f"Could not find document for position {positions[j]}, got {doc}")
+            if filter_func is not None and not filter_func(doc.metadata):
+                continue
+            if score_threshold is not None and exact[j] > score_threshold:
+                continue
+            docs.append((doc, float(exact[j])))
+            if len(docs) == k:
+                break
+        return docs
+
+
+def create_vector_store(embeddings, dim, compression="none"):
+    """ 圧縮方式に応じた空のベクトルストアを作る """
+    if compression == "none":
+        return FAISS(embeddings, create_index("none", dim), InMemoryDocstore(), {})
+    return CompressedFAISS.create(embeddings, dim, compression=compression)
+
+def stored_vectors(vectorstore):
+    """ ベクトルストアに入っているベクトルを (並び順どおりに) float32 で取り出す """
+    n = vectorstore.index.ntotal
+    if isinstance(vectorstore, CompressedFAISS):
+        return vectorstore.full_vectors.get(np.arange(n))
+    return vectorstore.index.reconstruct_n(0, n)
+
+def convert_vector_store(vectorstore, compression):
+    """ 既存のベクトルストアを別の圧縮方式に作り直す (埋め込みの再計算はしない) """
+    vectors = stored_vectors(vectorstore)
+    ids = [vectorstore.index_to_docstore_id[i] for i in range(vectorstore.index.ntotal)]
+    documents = [vectorstore.docstore.search(id_) for id_ in ids]
+    converted = create_vector_store(vectorstore.embedding_function, vectorstore.index.d, compression)
+    if ids:
+        converted.add_embeddings(
+            [(doc.page_content, vector) for doc, vector in zip(documents, vectors)],
+            metadatas=[doc.metadata for doc in documents],
+            ids=ids,
+        )
+    return converted
+
+def index_memory_bytes(index):
+    return dependable_faiss_import().serialize_index(index).nbytes
+
+
+def compare_compression(vectors, k=10, n_queries=50, modes=COMPRESSION_MODES, seed=0):
+    """
+    圧縮方式ごとのメモリ使用量と recall@k を比較する
+
+    vectors の一部をクエリとして取り出し、残りで作ったインデックスに対して
+    float32 の全探索の結果をどれだけ再現できるかを測る
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    rng = np.random.default_rng(seed)
+    n_queries = min(n_queries, len(vectors) // 2)
+    if n_queries == 0:
+        return []
+    query_ids = rng.choice(len(vectors), size=n_queries, replace=False)
+    queries = vectors[query_ids]
+    base = np.delete(vectors, query_ids, axis=0)
+    k = min(k, len(base))
+
+    exact_index = create_index("none", base.shape[1])
+    exact_index.add(base)
+    _, truth = exact_index.search(queries, k)
+
+    rows = []
+    for mode in modes:
+        # ベクトルストアと同じく、PQ の学習に足りない場合は圧縮しないインデックスになる
+        index = build_index(mode, base)
+        _, approx = index.search(queries, k)
+        _, candidates = index.search(queries, k * RESCORE_FACTOR)
+        rescored = []
+        for query, row in zip(queries, candidates):
+            row = row[row != -1]
+            distances = ((base[row] - query) ** 2).sum(axis=1)
+            rescored.append(row[np.argsort(distances)[:k]])
+        rows.append({
+            "mode": mode,
+            "index": type(index).__name__,
+            "index_bytes": index_memory_bytes(index),
+            "bytes_per_vector": index_memory_bytes(index) / len(base),
+            f"recall@{k}": _recall(truth, approx),
+            f"recall@{k} (rescored)": _recall(truth, rescored),
+        })
+    return rows
+
+def _recall(truth, found):
+    hits = sum(len(set(t) & set(f)) for t, f in zip(truth, found))
+    return hits / max(1, sum(len(t) for t in truth))
@@ -1,8 +1,12 @@
+import sys
+from pathlib import Path
 from langchain.agents import tool
-from langchain_openai import ChatOpenAI
 from langchain_core.output_parsers import JsonOutputToolsParser
 
-llm = ChatOpenAI(model="gpt-4o-mini")
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[2]))
+
+from common.models import create_chat_model
 
 # toolデコレータで関数をラップすることで、その関数をLLMのツールとして使用できるようになる
 # つまり自分で定義した関数をLLmが使ってくれるってことらしい
@@ -11,9 +15,18 @@ def get_word_length(word: str) -> int:
     """returns the length of a word."""
     return len(word)
 
-# ここでLLMに対してget_word_length関数をバインドしている
-# つまり、LLMがget_word_length関数を使ってくれるようになる
-llm_with_tools = llm.bind_tools([get_word_length])
-chain = llm_with_tools | JsonOutputToolsParser()
-res = chain.invoke("abafefavsaweafve って何文字？")
-print(res)
\ No newline at end of file
+def main():
+    # common.models 経由で作ると、LLM_CASSETTE_MODE=replay で記録済みの応答を使って
+    # APIキーなしでも動かせる (common.cassette)
+    llm = create_chat_model("gpt-4o-mini")
+
+    # ここでLLMに対してget_word_length関数をバインドしている
+    # つまり、LLMがget_word_length関数を使ってくれるようになる
+    llm_with_tools = llm.bind_tools([get_word_length])
+    chain = llm_with_tools | JsonOutputToolsParser()
+    res = chain.invoke("abafefavsaweafve って何文字？")
+    print(res)
+
+# import しただけで API を呼ばないよう、直接実行したときだけ動かす
+if __name__ == "__main__":
+    main()
@@ -1,17 +1,34 @@
+import sys
+import time
+from contextlib import nullcontext
+from pathlib import Path
 import streamlit as st
 from langchain.agents import create_tool_calling_agent, AgentExecutor
 from langchain.memory import ConversationBufferMemory
 from langchain.prompts import MessagesPlaceholder, ChatPromptTemplate
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.messages import convert_to_messages
 from langchain_core.runnables import RunnableConfig
 from langchain_community.callbacks import StreamlitCallbackHandler
 
+# リポジトリ直下の common パッケージを読み込めるようにする
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
 # models
-from langchain_openai import ChatOpenAI
-from langchain_anthropic import ChatAnthropic
+from common.models import MODELS, create_chat_model
+from common.routing import select_fallback
+from common.rate_limit import display_rate_limit_metrics
+from common.session_memory import track_session_memory, display_memory_metrics
+from common.chat_history import get_chat_history_store, get_conversation_id, display_history
+from common.streaming import FRAME_INTERVAL, chunk_to_text
+
+# 使用量の計測(common.metering)・会話履歴の保存(common.chat_history)で使うアプリ名
+APP_NAME = "chapter_009"
 
 # custom tools
 from tools.search_ddg import search_ddg
 from tools.fetch_page import fetch_page
+from tools.prefetch import get_prefetcher, prefetch_turn
 
 CUSTOM_PROMPT = """
 
@@ -24,6 +41,7 @@ CUSTOM_PROMPT = """
 検索ページを見ただけでは情報があまりないと思われる場合は、次の2つのオプションを検討して試してみてください。
 
 - 検索結果のリンクをクリックして、各ページのコンテンツにアクセスし、読んでみてください。
+- 探している情報が決まっている場合は、fetch_page の query にキーワードを指定して、関連する部分から読んでください。
 - 1ページが長すぎる場合は、3回以上ページ送りしないでください( メモリの負荷がかかるため )
 - 検索クエリを変更して、新しい検索を実行してください。
 - 検索する内容に応じて検索に利用する言語を適切に変更してください。
@@ -49,6 +67,66 @@ CUSTOM_PROMPT = """
 
 """
 
+class ToolCallCounter(BaseCallbackHandler):
+    """ 1回の質問で呼び出されたツールの回数を数える """
+
+    def __init__(self):
+        self.counts = {}
+
+    def on_tool_start(self, serialized, input_str, **kwargs):
+        name = (serialized or {}).get("name") or kwargs.get("name", "unknown")
+        self.counts[name] = self.counts.get(name, 0) + 1
+
+class FinalAnswerStreamer(BaseCallbackHandler):
+    """
+    エージェントの最終回答のトークンを、届いたそばから表示するコールバック
+
+    ツールを呼び出すステップの LLM の出力も同じように届くので、LLM の呼び出しごとに表示し直し、
+    ツール呼び出しを含んでいた場合はそのステップの表示を消す (最後に残るのが最終回答になる)
+    """
+
+    def __init__(self, container, started):
+        self.placeholder = container.empty()
+        self.started = started
+        # 最終回答の最初のトークンを表示するまでの時間 (秒)
+        self.first_token_sec = None
+        self._reset()
+
+    def _reset(self):
+        self.text = ""
+        self.tool_step = False
+        self.first_render = None
+        self.last_render = None
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self._reset()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self._reset()
+
+    def on_llm_new_token(self, token, *, chunk=None, **kwargs):
+        message = getattr(chunk, "message", None)
+        if getattr(message, "tool_call_chunks", None) and not self.tool_step:
+            # ツールを呼び出すステップだった (ここまでの表示は StreamlitCallbackHandler 側にも出ている)
+            self.tool_step = True
+            self.placeholder.empty()
+        if self.tool_step:
+            return
+        self.text += chunk_to_text(message if message is not None else token)
+        now = time.perf_counter()
+        # 最初のトークンはすぐに表示し、以降は一定間隔でまとめて描画する
+        if self.text and (self.last_render is None or now - self.last_render >= FRAME_INTERVAL):
+            self.placeholder.markdown(self.text)
+            self.last_render = now
+            if self.first_render is None:
+                self.first_render = now
+
+    def on_llm_end(self, response, **kwargs):
+        if self.tool_step or not self.text:
+            return
+        self.placeholder.markdown(self.text)
+        self.first_token_sec = (self.first_render or time.perf_counter()) - self.started
+
 def init_page():
     st.set_page_config(
         page_title="Web検索エージェント",
@@ -60,8 +138,11 @@ def init_page():
 
 def init_messages():
     clear_button = st.sidebar.button("会話をクリア", key="clear")
+    # 会話ID (URLのクエリパラメータに入っているので、再読み込みしても同じ会話になる)
+    conversation_id = get_conversation_id(APP_NAME, new=clear_button)
 
-    if clear_button or "messages" not in st.session_state:
+    if st.session_state.get("conversation_id") != conversation_id:
+        st.session_state.conversation_id = conversation_id
         st.session_state.messages = [
             {"role": "assistant", "content": "こんにちは！なんでも質問をどうぞ！"}
         ]
@@ -69,6 +150,9 @@ def init_messages():
             return_messages=True,
             memory_key="chat_history"
         )
+        # 保存済みの会話があればエージェントのメモリに読み込む
+        st.session_state['memory'].chat_memory.add_messages(
+            convert_to_messages(get_chat_history_store().load(conversation_id)))
 
 def select_model():
     # スライダーを追加し、temperatureを0から2までの範囲で選択可能にする
@@ -76,20 +160,15 @@ def select_model():
     temperature = st.sidebar.slider(
         "Temperature", min_value=0.0, max_value=2.0, value=0.0, step=0.01)
     
-    models = ["gpt-4o-mini", "claude-3-5-sonnet-20240620"]
-    model = st.sidebar.selectbox("AIモデルを選択", models)
-    if model == "gpt-4o-mini":
-        st.session_state.model_name = "gpt-4o-mini"
-        return ChatOpenAI(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
-    elif model == "claude-3-5-sonnet-20240620":
-        st.session_state.model_name = "claude-3-5-sonnet-20240620"
-        return ChatAnthropic(
-            temperature=temperature,
-            model=st.session_state.model_name
-            )
+    model = st.sidebar.selectbox("AIモデルを選択", MODELS)
+    st.session_state.model_name = model
+    # 応答が遅い・エラーの場合に別プロバイダのモデルへ切り替える設定
+    fallback_model, hedge_delay = select_fallback(model, MODELS)
+    # 同じプロセスの全アプリで共有しているレート制限の待ち状況
+    display_rate_limit_metrics()
+    return create_chat_model(
+        model, temperature, app=APP_NAME,
+        fallback_model=fallback_model, hedge_delay=hedge_delay)
     
 def create_agent():
     tools = [search_ddg, fetch_page]
@@ -108,27 +187,92 @@ def create_agent():
         memory=st.session_state['memory']
     )
 
+def select_prefetch():
+    use_prefetch = st.sidebar.checkbox(
+        "検索結果を先読みする", value=True,
+        help="検索結果の上位ページをバックグラウンドで取得しておき、fetch_page を速くします")
+    if use_prefetch:
+        stats = get_prefetcher().snapshot()
+        st.sidebar.caption(
+            f"先読み: {stats['scheduled']}件 / ヒット: {stats['hits'] + stats['waited']}件 / ミス: {stats['misses']}件")
+    return use_prefetch
+
+def select_answer_streaming():
+    return st.sidebar.checkbox(
+        "回答をストリーミング表示する", value=True,
+        help="最終回答を生成されたそばから表示します (オフにすると、回答が全て生成されてから表示します)")
+
+def display_answer_latency():
+    """ 質問してから回答の最初の文字が表示されるまでの時間 (ストリーミングの有無ごとの平均) """
+    latencies = st.session_state.get("answer_latency", {})
+    parts = [
+        f"{label} {sum(values) / len(values):.1f}秒 ({len(values)}回)"
+        for label, values in latencies.items() if values
+    ]
+    if parts:
+        st.sidebar.caption("回答が表示されるまで: " + " / ".join(parts))
+
+def display_tool_calls():
+    """ 直近の質問でのツールの呼び出し回数と、これまでの平均を表示する """
+    history = st.session_state.get("tool_calls", [])
+    if not history:
+        return
+    last = history[-1]
+    average = sum(sum(counts.values()) for counts in history) / len(history)
+    details = ", ".join(f"{name} {count}回" for name, count in last.items()) or "なし"
+    st.sidebar.caption(f"ツール呼び出し: {details} (質問あたり平均 {average:.1f}回)")
+
 def main():
     init_page()
     init_messages()
     web_browsing_agent = create_agent()
+    use_prefetch = select_prefetch()
+    stream_answer = select_answer_streaming()
+    display_tool_calls()
+    display_answer_latency()
+    display_memory_metrics()
 
-    for msg in st.session_state['memory'].chat_memory.messages:
-        st.chat_message(msg.type).write(msg.content)
+    # 会話履歴の表示 (直近のメッセージだけを表示し、それより前は必要なときに読み込む)
+    display_history(st.session_state.conversation_id)
 
     if prompt := st.chat_input(placeholder="2023 FIFA 女子ワールドカップの優勝国は？"):
         st.chat_message("user").write(prompt)
+        started = time.perf_counter()
         with st.chat_message("assistant"):
             # コールバック関数の設定 (エージェントの動作の可視化用)
             st_cb = StreamlitCallbackHandler(
                 st.container(), expand_new_thoughts=True)
+            tool_counter = ToolCallCounter()
+            callbacks = [st_cb, tool_counter]
+            # 最終回答はツールの実行の様子の下に、生成されたそばから表示する
+            answer_streamer = FinalAnswerStreamer(st.container(), started) if stream_answer else None
+            if answer_streamer is not None:
+                callbacks.append(answer_streamer)
+
+            # エージェントの実行 (検索結果の先読みが有効な場合は、このターンの間だけ先読みする)
+            with prefetch_turn(get_prefetcher()) if use_prefetch else nullcontext():
+                response = web_browsing_agent.invoke(
+                    {"input": prompt},
+                    config=RunnableConfig({'callbacks': callbacks})
+                )
+            if answer_streamer is not None:
+                # 表示したトークンと最終的な出力が違う場合 (出力のパースなど) に備えて、最後に置き換える
+                answer_streamer.placeholder.markdown(response['output'])
+                first_token_sec = answer_streamer.first_token_sec
+            else:
+                st.write(response['output'])
+                first_token_sec = None
+            if first_token_sec is None:
+                first_token_sec = time.perf_counter() - started
+        mode = "ストリーミング" if stream_answer else "一括"
+        st.session_state.setdefault("answer_latency", {}).setdefault(mode, []).append(first_token_sec)
+        st.session_state.setdefault("tool_calls", []).append(tool_counter.counts)
 
-            # エージェントの実行
-            response = web_browsing_agent.invoke(
-                {"input": prompt},
-                config=RunnableConfig({'callbacks': [st_cb]})
-            )
-            st.write(response['output'])
+        store = get_chat_history_store()
+        store.append(st.session_state.conversation_id, "user", prompt)
+        store.append(st.session_state.conversation_id, "assistant", response['output'])
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    # エージェントの会話メモリは、操作されていない間ディスクに退避できるようにする
+    with track_session_memory(["memory"]):
+        main()
\ No newline at end of file
@@ -1,18 +1,26 @@
-import requests
-import html2text
-from readability import Document
+from typing import Optional
+
 from langchain_core.tools import tool
 from langchain_core.pydantic_v1 import (BaseModel, Field)
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 
+from common.bm25 import BM25
+from common.cassette import recordable
+from tools.page_download import download_page
+from tools.prefetch import get_prefetched_page
+
 
 class FetchPageInput(BaseModel):
     url: str = Field(description="取得したいWebページのURL")
     page_num: int = Field(default=0, description="ページ番号（0から始まる、負の数は無効）")
+    query: Optional[str] = Field(
+        default=None,
+        description="探している情報を表すキーワード (指定すると、ページ内で関連度の高い部分から順に返す)")
 
 # 関数といっても追加プロンプトに近い？
 @tool(args_schema=FetchPageInput)
-def fetch_page(url, page_num=0, timeout_sec=10):
+@recordable("fetch_page")
+def fetch_page(url, page_num=0, query=None, timeout_sec=10):
     """
     指定されたURL(とページ番号から)ウェブページのコンテンツを取得するツール。
 
@@ -24,6 +32,11 @@ def fetch_page(url, page_num=0, timeout_sec=10):
     続きを読むには、同じURLで`page_num`パラメータをインクリメントして、再度入力してください。
     ( ページングは0から始まるので、次のページは1です)
 
+    探している情報が決まっている場合は `query` にキーワードを指定してください。
+    ページを先頭から読む代わりに、キーワードとの関連度が高い部分から順に返します。
+    (`page_num=0` が最も関連度の高い部分、`page_num=1` が2番目です。
+    `chunk_index` はその部分がページの先頭から何番目かを表します)
+
     1ページが長すぎる場合は、**3回以上取得しないでください**(メモリの負荷がかかるため)
 
     Returns
@@ -34,6 +47,7 @@ def fetch_page(url, page_num=0, timeout_sec=10):
         - title: str
         - content: str
         - has_next: bool
+        - chunk_index: int (query を指定した場合)
     """
     # page_numが負の数の場合のバリデーション
     if page_num < 0:
@@ -42,32 +56,15 @@ def fetch_page(url, page_num=0, timeout_sec=10):
             "page_content": {'error_message': 'page_num must be 0 or greater. Please provide a valid page number.'}
         }
     
-    try:
-        response = requests.get(url, timeout=timeout_sec)
-        response.encoding = "utf-8"
-    except requests.exceptions.Timeout:
-        return {
-            "status": 500,
-            "page_content": {'error_message': 'Could not download page due to Timeout Error. Please try to fetch other pages.'}
-        }
-    
-    if response.status_code != 200:
-        return {
-            "status": response.status_code,
-            "page_content": {'error_message': 'Could not download page. Please try to fetch other pages.'}
-        }
-    
-    try:
-        doc = Document(response.text)
-        title = doc.title()
-        html_content = doc.summary()
-        content = html2text.html2text(html_content)
-    except Exception as e:
-        return {
-            "status": 500,
-            "page_content": {'error_message': 'Could not parse page content. Please try to fetch other pages.'}
-        }
-    
+    # プリフェッチ済みならそれを使い、なければその場で取得する
+    page = get_prefetched_page(url)
+    if page is None:
+        page = download_page(url, timeout_sec=timeout_sec)
+    if page["status"] != 200:
+        return page
+    title = page["title"]
+    content = page["content"]
+
     text_splitter = RecursiveCharacterTextSplitter.from_tiktoken_encoder(
         model_name="gpt-4o-mini",
         chunk_size=1000,
@@ -84,6 +81,18 @@ def fetch_page(url, page_num=0, timeout_sec=10):
             "status": 503,
             "page_content": { 'error_message': 'Reading more of this page_num`s content will overload your memory. Please provide your response based on the information you currently have.'}
         }
+    elif query:
+        # BM25 でクエリとの関連度が高い順に並べ、page_num 番目に関連度の高い部分を返す
+        chunk_index, _ = BM25(chunks).rank(query)[page_num]
+        return {
+            "status": 200,
+            "page_content": {
+                "title": title,
+                "content": chunks[chunk_index],
+                "has_next": page_num < len(chunks) - 1,
+                "chunk_index": chunk_index,
+            }
+        }
     else:
         return {
             "status": 200,
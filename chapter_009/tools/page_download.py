@@ -0,0 +1,67 @@
+import requests
+import html2text
+from readability import Document
+
+
+def download_page(url, timeout_sec=10, max_bytes=None, cancelled=None):
+    """
+    ページをダウンロードして本文を抽出する (fetch_page とプリフェッチで共用)
+
+    max_bytes を超えるページや、cancelled (threading.Event) がセットされた場合は途中で打ち切る
+
+    Returns
+    -------
+    Dict[str, Any]:
+    - status: int
+    - title: str (status が200の場合)
+    - content: str (status が200の場合)
+    - page_content (status が200以外の場合、fetch_page の戻り値と同じ形式のエラー)
+    """
+    try:
+        response = requests.get(url, timeout=timeout_sec, stream=True)
+        response.encoding = "utf-8"
+    except requests.exceptions.Timeout:
+        return {
+            "status": 500,
+            "page_content": {'error_message': 'Could not download page due to Timeout Error. Please try to fetch other pages.'}
+        }
+    except requests.exceptions.RequestException:
+        return {
+            "status": 500,
+            "page_content": {'error_message': 'Could not download page. Please try to fetch other pages.'}
+        }
+
+    with response:
+        if response.status_code != 200:
+            return {
+                "status": response.status_code,
+                "page_content": {'error_message': 'Could not download page. Please try to fetch other pages.'}
+            }
+
+        body = []
+        size = 0
+        try:
+            for data in response.iter_content(chunk_size=64 * 1024):
+                if cancelled is not None and cancelled.is_set():
+                    return {"status": 499, "page_content": {'error_message': 'Download was cancelled.'}}
+                body.append(data)
+                size += len(data)
+                if max_bytes is not None and size > max_bytes:
+                    return {"status": 413, "page_content": {'error_message': 'Page is too large.'}}
+        except requests.exceptions.RequestException:
+            return {
+                "status": 500,
+                "page_content": {'error_message': 'Could not download page. Please try to fetch other pages.'}
+            }
+
+    try:
+        doc = Document(b"".join(body).decode(response.encoding, errors="replace"))
+        title = doc.title()
+        html_content = doc.summary()
+        content = html2text.html2text(html_content)
+    except Exception as e:
+        return {
+            "status": 500,
+            "page_content": {'error_message': 'Could not parse page content. Please try to fetch other pages.'}
+        }
+    return {"status": 200, "title": title, "content": content}
@@ -0,0 +1,186 @@
+"""
+検索結果ページの先読み (プリフェッチ)
+
+エージェントは search_ddg の直後にほぼ必ず fetch_page で上位のページを読みにいくので、
+検索結果が返った時点で上位N件をバックグラウンドで取得・本文抽出しておき、
+fetch_page の呼び出し時にはキャッシュから返せるようにする。
+
+- 同時に取得するページ数・1ページの最大バイト数・キャッシュ全体の最大バイト数で制限する
+- キャッシュは短時間 (ttl_sec) で破棄する
+- エージェントの1ターンが終わったら、そのターンで始めた取得は中断する
+
+使い方:
+    with prefetch_turn(get_prefetcher()):
+        agent.invoke(...)
+"""
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from tools.page_download import download_page
+
+# 検索結果の上位何件を先読みするか
+PREFETCH_TOP_N = 3
+# 先読みでは fetch_page より短めのタイムアウトにする
+PREFETCH_TIMEOUT_SEC = 5
+# fetch_page が取得中の先読みを待つ最大秒数 (これを超えたら自分で取得する)
+WAIT_TIMEOUT_SEC = 10
+
+# 現在のターンの (prefetcher, turn)。prefetch_turn の中でだけセットされる
+_current_turn = contextvars.ContextVar("prefetch_turn", default=None)
+
+
+class PrefetchTurn:
+    """ エージェントの1ターンで開始した先読みをまとめて中断するためのもの """
+
+    def __init__(self):
+        self.cancelled = threading.Event()
+        self.futures = []
+
+
+class PagePrefetcher:
+
+    def __init__(self, max_workers=3, top_n=PREFETCH_TOP_N, max_page_bytes=2_000_000,
+                 max_total_bytes=20_000_000, ttl_sec=300):
+        self.top_n = top_n
+        self.max_page_bytes = max_page_bytes
+        self.max_total_bytes = max_total_bytes
+        self.ttl_sec = ttl_sec
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self._lock = threading.Lock()
+        self._cache = OrderedDict()  # url -> (expires_at, page, size)
+        self._cache_bytes = 0
+        self._inflight = {}          # url -> Future
+        self.stats = {"scheduled": 0, "hits": 0, "waited": 0, "misses": 0, "cancelled": 0}
+
+    def schedule(self, urls, turn):
+        """ 上位 top_n 件の取得をバックグラウンドで開始する """
+        for url in urls[:self.top_n]:
+            with self._lock:
+                if not url or url in self._inflight or self._lookup(url) is not None:
+                    continue
+                future = self._executor.submit(self._prefetch, url, turn)
+                self._inflight[url] = future
+                turn.futures.append(future)
+                self.stats["scheduled"] += 1
+
+    def _prefetch(self, url, turn):
+        try:
+            if turn.cancelled.is_set():
+                return None
+            page = download_page(
+                url, timeout_sec=PREFETCH_TIMEOUT_SEC,
+                max_bytes=self.max_page_bytes, cancelled=turn.cancelled)
+            # 取得に失敗したページはキャッシュせず、fetch_page に改めて取得させる
+            if page["status"] != 200:
+                return None
+            with self._lock:
+                self._store(url, page)
+            return page
+        finally:
+            with self._lock:
+                self._inflight.pop(url, None)
+
+    def _lookup(self, url):
+        entry = self._cache.get(url)
+        if entry is None:
+            return None
+        expires_at, page, size = entry
+        if expires_at < time.monotonic():
+            del self._cache[url]
+            self._cache_bytes -= size
+            return None
+        self._cache.move_to_end(url)
+        return page
+
+    def _store(self, url, page):
+        size = len(page["content"].encode("utf-8")) + len(page["title"].encode("utf-8"))
+        if size > self.max_total_bytes:
+            return
+        if url in self._cache:
+            self._cache_bytes -= self._cache.pop(url)[2]
+        self._cache[url] = (time.monotonic() + self.ttl_sec, page, size)
+        self._cache_bytes += size
+        # 上限を超えた分は古いものから捨てる
+        while self._cache_bytes > self.max_total_bytes:
+            _, (_, _, evicted) = self._cache.popitem(last=False)
+            self._cache_bytes -= evicted
+
+    def get(self, url):
+        """ 先読み済み(または取得中)のページを返す。なければ None """
+        with self._lock:
+            page = self._lookup(url)
+            future = self._inflight.get(url)
+        if page is not None:
+            self._count("hits")
+            return page
+        if future is not None:
+            try:
+                page = future.result(timeout=WAIT_TIMEOUT_SEC)
+            except Exception:
+                page = None
+            if page is not None:
+                self._count("waited")
+                return page
+        self._count("misses")
+        return None
+
+    def cancel(self, turn):
+        """ ターンで開始した先読みを中断する (キャッシュ済みのものは残す) """
+        turn.cancelled.set()
+        for future in turn.futures:
+            if future.cancel():
+                self._count("cancelled")
+
+    def _count(self, field):
+        # get / cancel は複数のセッションのスレッドから同時に呼ばれる
+        with self._lock:
+            self.stats[field] += 1
+
+    def snapshot(self):
+        """ 表示用に、カウンターをそろった時点の値でコピーして返す """
+        with self._lock:
+            return dict(self.stats)
+
+
+_prefetcher = None
+_prefetcher_lock = threading.Lock()
+
+def get_prefetcher():
+    """ プロセス内で共有する PagePrefetcher を返す (キャッシュはセッション間でも共有される) """
+    global _prefetcher
+    with _prefetcher_lock:
+        if _prefetcher is None:
+            _prefetcher = PagePrefetcher()
+        return _prefetcher
+
+
+@contextmanager
+def prefetch_turn(prefetcher):
+    """ この中で実行されたツールの呼び出しで先読みを有効にし、抜けるときに中断する """
+    turn = PrefetchTurn()
+    token = _current_turn.set((prefetcher, turn))
+    try:
+        yield turn
+    finally:
+        prefetcher.cancel(turn)
+        _current_turn.reset(token)
+
+
+def schedule_prefetch(urls):
+    """ search_ddg から呼ばれる。先読みが有効なターンでなければ何もしない """
+    current = _current_turn.get()
+    if current is not None:
+        prefetcher, turn = current
+        prefetcher.schedule(urls, turn)
+
+def get_prefetched_page(url):
+    """ fetch_page から呼ばれる。先読みが有効なターンでなければ None """
+    current = _current_turn.get()
+    if current is None:
+        return None
+    prefetcher, _ = current
+    return prefetcher.get(url)
@@ -3,6 +3,9 @@ from duckduckgo_search import DDGS
 from langchain_core.tools import tool
 from langchain_core.pydantic_v1 import (BaseModel, Field)
 
+from common.cassette import recordable
+from tools.prefetch import schedule_prefetch
+
 
 """
 Sample Response of DuckDuckGo python library
@@ -20,6 +23,7 @@ class SearchDDGInput(BaseModel):
     query: str = Field(description="検索したいキーワードを入力してください。")
 
 @tool(args_schema=SearchDDGInput)
+@recordable("search_ddg")
 def search_ddg(query, max_result_num=5):
     """
     
@@ -39,11 +43,14 @@ def search_ddg(query, max_result_num=5):
     - url
     """
     res = DDGS().text(query, region="wt-wt", safesearch="Off", timelimit="lite")
-    return [
+    results = [
         {
             "title": r.get('title', ""),
             "snippet": r.get('body', ""),
             "url": r.get('href', "")
         }
         for r in islice(res, max_result_num)
-    ]
\ No newline at end of file
+    ]
+    # このあと fetch_page で読まれることが多いので、上位のページを先読みしておく
+    schedule_prefetch([r["url"] for r in results])
+    return results
\ No newline at end of file
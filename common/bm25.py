@@ -0,0 +1,134 @@
+"""
+BM25 による語彙的な関連度のスコアリング
+
+埋め込みを使わずに、クエリの語がどれだけ含まれているかで文書を順位付けする。
+日本語は空白で区切られないので、かな・漢字の連続は文字 bigram に分けて扱う。
+
+- BM25: 文書のリストから一度に作る (1ページ分のチャンクなど、その場で使い捨てる場合)
+- InvertedIndex: 文書を後から追加・削除できる転置インデックス (ベクトルストアと並べて持つ場合)
+"""
+import math
+import re
+import unicodedata
+from collections import Counter, defaultdict
+
+# 英数字の連続と、かな・漢字の連続
+TOKEN_PATTERN = re.compile(r"[a-z0-9_]+|[぀-ヿ㐀-鿿]+")
+
+
+def tokenize(text):
+    text = unicodedata.normalize("NFKC", text).lower()
+    tokens = []
+    for word in TOKEN_PATTERN.findall(text):
+        if word.isascii():
+            tokens.append(word)
+        elif len(word) == 1:
+            tokens.append(word)
+        else:
+            tokens.extend(word[i:i + 2] for i in range(len(word) - 1))
+    return tokens
+
+def _idf(n, df):
+    return math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+def _term_score(idf, freq, norm, k1):
+    return idf * freq * (k1 + 1) / (freq + norm)
+
+
+class BM25:
+    """ 文書のリストに対する BM25 (Okapi) のスコア計算 """
+
+    def __init__(self, documents, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(doc)) for doc in documents]
+        self.doc_lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.doc_lengths) / len(self.doc_lengths) if self.doc_lengths else 0
+        doc_freqs = Counter(term for tf in self.term_freqs for term in tf)
+        n = len(self.term_freqs)
+        self.idf = {term: _idf(n, df) for term, df in doc_freqs.items()}
+
+    def scores(self, query):
+        """ 各文書のスコアのリスト (文書の並び順どおり) """
+        terms = tokenize(query)
+        results = []
+        for tf, length in zip(self.term_freqs, self.doc_lengths):
+            norm = self.k1 * (1 - self.b + self.b * length / self.avg_length) if self.avg_length else self.k1
+            score = 0.0
+            for term in terms:
+                freq = tf.get(term)
+                if freq:
+                    score += _term_score(self.idf[term], freq, norm, self.k1)
+            results.append(score)
+        return results
+
+    def rank(self, query, k=None):
+        """ スコアの高い順に (文書の index, スコア) のリストを返す (同点は元の順) """
+        ranked = sorted(enumerate(self.scores(query)), key=lambda item: (-item[1], item[0]))
+        return ranked if k is None else ranked[:k]
+
+
+class InvertedIndex:
+    """
+    文書を後から追加・削除できる BM25 の転置インデックス
+
+    文書は呼び出し側の ID (ベクトルストアの ID など) で管理する。
+    検索ではクエリの語を含む文書だけを見るので、文書数が増えてもクエリの語の出現数に比例した時間で済む。
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self.postings = defaultdict(dict)   # 語 -> {文書ID: 出現回数}
+        self.doc_terms = {}                 # 文書ID -> 含まれる語 (削除用)
+        self.doc_lengths = {}
+        self.total_length = 0
+
+    def __len__(self):
+        return len(self.doc_lengths)
+
+    def add(self, ids, texts):
+        """ 文書を追加する (同じIDがあれば置き換える) """
+        for id_, text in zip(ids, texts):
+            if id_ in self.doc_lengths:
+                self.remove([id_])
+            tf = Counter(tokenize(text))
+            for term, freq in tf.items():
+                self.postings[term][id_] = freq
+            self.doc_terms[id_] = list(tf)
+            self.doc_lengths[id_] = sum(tf.values())
+            self.total_length += self.doc_lengths[id_]
+
+    def remove(self, ids):
+        for id_ in ids:
+            if id_ not in self.doc_lengths:
+                continue
+            for term in self.doc_terms.pop(id_):
+                del self.postings[term][id_]
+                if not self.postings[term]:
+                    del self.postings[term]
+            self.total_length -= self.doc_lengths.pop(id_)
+
+    def search(self, query, k=None, filter=None):
+        """
+        スコアの高い順に (文書ID, スコア) のリストを返す (クエリの語を1つも含まない文書は返さない)
+
+        filter は文書IDを受け取って対象にするかどうかを返す関数
+        """
+        n = len(self.doc_lengths)
+        if n == 0:
+            return []
+        avg_length = self.total_length / n
+        scores = defaultdict(float)
+        for term in tokenize(query):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = _idf(n, len(postings))
+            for id_, freq in postings.items():
+                norm = self.k1 * (1 - self.b + self.b * self.doc_lengths[id_] / avg_length) if avg_length else self.k1
+                scores[id_] += _term_score(idf, freq, norm, self.k1)
+        ranked = sorted(scores.items(), key=lambda item: -item[1])
+        if filter is not None:
+            ranked = [item for item in ranked if filter(item[0])]
+        return ranked if k is None else ranked[:k]
@@ -0,0 +1,154 @@
+"""
+実行中の生成の協調的な中断
+
+Runnable を stream するときの config の callbacks に CancellationHandler を入れておくと、
+cancel() した後は、次のトークンが届いた時点 (またはモデルの呼び出しを始める時点) で
+GenerationCancelled が送出され、モデルのストリーム (プロバイダへの接続) が閉じられる。
+
+チェーンのストリームを close() するだけでは止まらない。LangChain のチェーンは閉じられたときに
+トレースのため前段の出力を最後まで読み切るので、結局 LLM の生成が最後まで続いてしまう。
+
+最初のトークンを待っている間も止められるように、モデルの呼び出し中は CancellationHandler を
+そのスレッドに登録しておく。common.http_client のクライアントはそのスレッドで受けたレスポンスを
+登録されている CancellationHandler に渡し、cancel() されたら接続を直接切る。
+ラッパーのモデル (レート制限・ヘッジ・カセット) は inherit_cancellation で内側の呼び出しに引き継ぐ。
+(ストリーミングでは _stream に run_manager が渡されないので、登録されているものから探す)
+"""
+import threading
+import time
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+
+# 中断を待っている処理 (レート制限の待ちなど) が cancel() を確認する間隔 (秒)
+POLL_INTERVAL = 0.1
+
+
+class GenerationCancelled(Exception):
+    """ CancellationHandler によって生成が中断された """
+
+
+class HedgeCancelled(Exception):
+    """ ヘッジで別のモデルが先に応答したため、生成が中断された """
+
+
+# スレッドごとの、実行中のモデルの呼び出しに付いている CancellationHandler ((run_id, handler) -> handler)
+_active = threading.local()
+
+def active_handlers():
+    """ このスレッドで実行中のモデルの呼び出しに付いている CancellationHandler のリスト """
+    return list(dict.fromkeys(getattr(_active, "runs", {}).values()))
+
+
+class CancellationHandler(BaseCallbackHandler):
+    """ cancel() された後のモデルの呼び出し・トークンで error (既定は GenerationCancelled) を送出するコールバック """
+
+    # コールバック内の例外を握りつぶさず、呼び出し元 (モデルのストリーム) まで伝える
+    raise_error = True
+
+    def __init__(self, error=GenerationCancelled):
+        self.error = error
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        with self._lock:
+            self._event.set()
+            connections = list(self._connections)
+        # トークンを待っているスレッドもすぐに抜けられるよう、受信中の接続を切る
+        for connection in connections:
+            connection.abort(self.error)
+
+    def raise_if_cancelled(self):
+        if self._event.is_set():
+            raise self.error()
+
+    def track(self, connection):
+        """ 受信中の接続を登録する (既に cancel() されていればすぐに切る) """
+        with self._lock:
+            if not self._event.is_set():
+                self._connections.add(connection)
+                return
+        connection.abort(self.error)
+
+    def untrack(self, connection):
+        with self._lock:
+            self._connections.discard(connection)
+
+    def _enter(self, run_id):
+        self.raise_if_cancelled()
+        if not hasattr(_active, "runs"):
+            _active.runs = {}
+        _active.runs[(run_id, id(self))] = self
+
+    def _exit(self, run_id):
+        getattr(_active, "runs", {}).pop((run_id, id(self)), None)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._enter(run_id)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._enter(run_id)
+
+    def on_llm_new_token(self, token, **kwargs):
+        self.raise_if_cancelled()
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._exit(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._exit(run_id)
+
+
+def cancellation_handlers(run_manager=None):
+    """
+    モデルの呼び出しに付いている CancellationHandler のリスト
+
+    BaseChatModel.stream() は _stream に run_manager を渡さないので、このスレッドで実行中の
+    呼び出しに登録されているもの (active_handlers) も含める。_stream の本体は stream() の
+    on_chat_model_start の後に同じスレッドで実行されるので、呼び出しに付いているものは全て見つかる
+    """
+    handlers = run_manager.handlers if run_manager is not None else []
+    found = [handler for handler in handlers if isinstance(handler, CancellationHandler)]
+    return list(dict.fromkeys([*found, *active_handlers()]))
+
+def inherit_cancellation(run_manager, *extra):
+    """
+    ラッパーのモデルが内側のモデルを呼ぶときの config
+
+    計測用などのコールバックは内側のモデルに直接付いているので引き継がず、
+    CancellationHandler だけを引き継ぐ (extra も追加する)
+    """
+    return {"callbacks": [*cancellation_handlers(run_manager), *extra]}
+
+def raise_if_cancelled(handlers):
+    for handler in handlers:
+        handler.raise_if_cancelled()
+
+def sleep(seconds, handlers):
+    """ time.sleep と同じだが、handlers のどれかが cancel() されたらすぐに例外を送出する """
+    deadline = time.monotonic() + seconds
+    while True:
+        raise_if_cancelled(handlers)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        time.sleep(min(remaining, POLL_INTERVAL) if handlers else remaining)
+
+
+def is_cancellation(error):
+    """
+    ユーザーの操作 (再実行・タブを閉じる) で生成を中断したことによるエラーかどうか
+
+    GeneratorExit はヘッジで負けた場合など、他の理由でストリームが閉じられても送出されるので含めない
+    """
+    return isinstance(error, GenerationCancelled)
+
+def is_hedge_cancellation(error):
+    """ ヘッジで別のモデルが先に応答したため中断したことによるエラーかどうか """
+    return isinstance(error, HedgeCancelled)
@@ -0,0 +1,270 @@
+"""
+LLM・埋め込み・ツールの呼び出しの記録と再生 (カセット)
+
+API キーなしでアプリを動かしたり、毎回同じ応答でプロファイリング・回帰テストをしたりするために、
+記録モードで実際の呼び出しの結果をファイルに保存し、再生モードではそれを返す。
+
+- チャットモデル: ストリーミングのチャンクを、最初からの経過時間つきで記録する
+- 埋め込み: ベクトルを記録する
+- ツール: @recordable を付けた関数 (search_ddg / fetch_page) の戻り値を記録する
+
+再生時は記録したときと同じ間隔でチャンクを返す。LLM_CASSETTE_SPEED で速さを変えられる
+(2 なら2倍速、0 なら待たずにすぐ返す)。同じリクエストが複数回記録されていれば、記録された順に返す。
+
+    LLM_CASSETTE_MODE=record LLM_CASSETTE=chapter_009 streamlit run chapter_009/main.py
+    LLM_CASSETTE_MODE=replay LLM_CASSETTE=chapter_009 LLM_CASSETTE_SPEED=0 streamlit run chapter_009/main.py
+
+カセットは .data/cassettes/<LLM_CASSETTE>.jsonl に1呼び出し1行で保存される。
+"""
+import base64
+import functools
+import hashlib
+import json
+import os
+import threading
+import time
+from array import array
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import message_to_dict, messages_from_dict
+from langchain_core.outputs import ChatGenerationChunk
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+from common import cancellation
+from common.cancellation import cancellation_handlers, inherit_cancellation
+from common.paths import data_path
+
+MODES = ("off", "record", "replay")
+
+
+class CassetteMiss(KeyError):
+    """ 再生モードで、記録されていない呼び出しがあった """
+
+
+def _stable_key(*parts):
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+def _message_key(message):
+    # id は実行ごとに変わるので、キーには内容だけを使う
+    return {
+        "type": message.type,
+        "content": message.content,
+        "tool_calls": [
+            {"name": call["name"], "args": call["args"], "id": call.get("id")}
+            for call in getattr(message, "tool_calls", None) or []
+        ],
+        "tool_call_id": getattr(message, "tool_call_id", None),
+    }
+
+
+class Cassette:
+    """ 1つのカセットファイル (record / replay で共有する) """
+
+    def __init__(self, path, mode, speed=1.0):
+        if mode not in MODES:
+            raise ValueError(f"Unknown cassette mode: {mode}")
+        self.path = path
+        self.mode = mode
+        self.speed = speed
+        self._lock = threading.Lock()
+        self._records = {}   # key -> [record, ...]
+        self._played = {}    # key -> 再生した回数
+        if mode == "replay":
+            if not path.exists():
+                raise FileNotFoundError(f"Cassette not found: {path}")
+            with open(path, encoding="utf-8") as f:
+                for line in f:
+                    record = json.loads(line)
+                    self._records.setdefault(record["key"], []).append(record)
+        elif mode == "record":
+            # 記録し直す場合は前の内容を消す
+            path.write_text("", encoding="utf-8")
+
+    def record(self, kind, key, **data):
+        with self._lock, open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"kind": kind, "key": key, **data}, ensure_ascii=False) + "\n")
+
+    def play(self, kind, key):
+        with self._lock:
+            records = self._records.get(key)
+            if not records:
+                raise CassetteMiss(f"No recorded {kind} call for key {key[:12]} in {self.path}")
+            count = self._played.get(key, 0)
+            self._played[key] = count + 1
+            # 記録より多く呼ばれた場合は最後の記録を繰り返す
+            return records[min(count, len(records) - 1)]
+
+    def sleep(self, seconds, handlers=()):
+        if self.speed > 0 and seconds > 0:
+            cancellation.sleep(seconds / self.speed, handlers)
+
+
+_cassette = None
+_cassette_lock = threading.Lock()
+
+def get_cassette():
+    """ 環境変数の設定に従ったカセットを返す (LLM_CASSETTE_MODE が off の場合は None) """
+    global _cassette
+    mode = os.environ.get("LLM_CASSETTE_MODE", "off")
+    if mode == "off":
+        return None
+    with _cassette_lock:
+        if _cassette is None:
+            name = os.environ.get("LLM_CASSETTE", "default")
+            speed = float(os.environ.get("LLM_CASSETTE_SPEED", "1"))
+            _cassette = Cassette(data_path("cassettes", f"{name}.jsonl"), mode, speed)
+        return _cassette
+
+
+class CassetteChatModel(BaseChatModel):
+    """
+    内側のチャットモデルのストリームを記録・再生する
+
+    再生モードでは API を呼ばないので inner は None でよい (APIキーも不要)
+    """
+
+    inner: Any
+    model_name: str
+    cassette: Any
+    # bind_tools で渡されたツールの定義など (リクエストの一部としてキーに含める)
+    bound: dict = {}
+
+    @property
+    def _llm_type(self):
+        return "cassette-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.__class__(
+            inner=self.inner.bind_tools(tools, **kwargs) if self.inner is not None else None,
+            model_name=self.model_name,
+            cassette=self.cassette,
+            # プロバイダによらず同じキーになるよう、OpenAI 形式に変換したものを使う
+            bound={"tools": [convert_to_openai_tool(t) for t in tools], **kwargs},
+            callbacks=self.callbacks,
+        )
+
+    def _key(self, messages, stop, kwargs):
+        return _stable_key(
+            self.model_name, [_message_key(m) for m in messages], stop, kwargs, self.bound)
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        key = self._key(messages, stop, kwargs)
+        if self.cassette.mode == "replay":
+            chunks = self._replay(key, cancellation_handlers(run_manager))
+        else:
+            chunks = self._record(key, messages, stop, kwargs, inherit_cancellation(run_manager))
+        for chunk in chunks:
+            generation = ChatGenerationChunk(message=chunk)
+            if run_manager:
+                run_manager.on_llm_new_token(generation.text, chunk=generation)
+            yield generation
+
+    def _replay(self, key, handlers):
+        record = self.cassette.play("chat", key)
+        elapsed = 0.0
+        for offset, chunk in zip(record["offsets"], messages_from_dict(record["chunks"])):
+            self.cassette.sleep(offset - elapsed, handlers)
+            elapsed = offset
+            yield chunk
+
+    def _record(self, key, messages, stop, kwargs, config):
+        started = time.perf_counter()
+        offsets, chunks = [], []
+        # 計測用のコールバックは内側のモデルに直接付いているので、config には中断のコールバックだけを入れる
+        for chunk in self.inner.stream(messages, config, stop=stop, **kwargs):
+            offsets.append(round(time.perf_counter() - started, 4))
+            chunks.append(chunk)
+            yield chunk
+        # 最後まで受け取れた呼び出しだけを記録する
+        self.cassette.record(
+            "chat", key, model=self.model_name, offsets=offsets,
+            chunks=[message_to_dict(chunk) for chunk in chunks])
+
+
+def _encode_vectors(vectors):
+    return [base64.b64encode(array("f", vector).tobytes()).decode("ascii") for vector in vectors]
+
+def _decode_vectors(encoded):
+    return [array("f", base64.b64decode(item)).tolist() for item in encoded]
+
+
+class CassetteEmbeddings(Embeddings):
+    """ 埋め込みの結果を記録・再生する """
+
+    def __init__(self, inner, model_name, cassette):
+        self.inner = inner
+        self.model_name = model_name
+        self.cassette = cassette
+
+    def _call(self, kind, texts, func):
+        key = _stable_key(self.model_name, kind, texts)
+        if self.cassette.mode == "replay":
+            record = self.cassette.play("embeddings", key)
+            self.cassette.sleep(record["duration"])
+            return _decode_vectors(record["vectors"])
+        started = time.perf_counter()
+        vectors = func()
+        self.cassette.record(
+            "embeddings", key, model=self.model_name,
+            duration=round(time.perf_counter() - started, 4), vectors=_encode_vectors(vectors))
+        return vectors
+
+    def embed_documents(self, texts):
+        return self._call("documents", list(texts), lambda: self.inner.embed_documents(texts))
+
+    def embed_query(self, text):
+        return self._call("query", [text], lambda: [self.inner.embed_query(text)])[0]
+
+
+def is_replaying():
+    cassette = get_cassette()
+    return cassette is not None and cassette.mode == "replay"
+
+def wrap_chat_model(model, model_name):
+    """ カセットが有効な場合は CassetteChatModel で包む """
+    cassette = get_cassette()
+    if cassette is None:
+        return model
+    return CassetteChatModel(inner=model, model_name=model_name, cassette=cassette)
+
+def wrap_embeddings(embeddings, model_name):
+    """ カセットが有効な場合は CassetteEmbeddings で包む """
+    cassette = get_cassette()
+    if cassette is None:
+        return embeddings
+    return CassetteEmbeddings(embeddings, model_name, cassette)
+
+
+def recordable(name):
+    """
+    ツールの関数の戻り値 (JSONにできるもの) を記録・再生するデコレータ
+
+    @tool の内側に付ける:
+        @tool(args_schema=...)
+        @recordable("search_ddg")
+        def search_ddg(query, ...):
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            cassette = get_cassette()
+            if cassette is None:
+                return func(*args, **kwargs)
+            key = _stable_key(name, args, kwargs)
+            if cassette.mode == "replay":
+                record = cassette.play("tool", key)
+                cassette.sleep(record["duration"])
+                return record["result"]
+            started = time.perf_counter()
+            result = func(*args, **kwargs)
+            cassette.record(
+                "tool", key, name=name, duration=round(time.perf_counter() - started, 4), result=result)
+            return result
+        return wrapper
+    return decorator
@@ -0,0 +1,185 @@
+"""
+会話履歴の永続化と、長い会話の表示
+
+会話は SQLite に1メッセージ1行で追記していく (書き換えはしない)。
+会話IDは URL のクエリパラメータ (?conversation=...) に入れておくので、
+ページを再読み込みしても同じ会話を続けられる。
+
+表示は直近の PAGE_SIZE 件だけにして、それより前のメッセージは
+「以前のメッセージを表示」を押したときにページ単位の見出し (ボタン) を増やす。
+ページの中身は、そのボタンで開いたときだけ読み込んで表示する。
+追記のみなので、一度書いたメッセージの内容は変わらない。そのため
+以前のページの markdown は (DBのパス, 会話ID, 範囲) ごとに1回だけ組み立てて使い回す。
+"""
+import sqlite3
+import threading
+import time
+import uuid
+from functools import lru_cache
+
+from common.paths import data_path
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS conversations (
+    id TEXT PRIMARY KEY,
+    app TEXT NOT NULL,
+    created REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS messages (
+    conversation_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    ts REAL NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    PRIMARY KEY (conversation_id, seq)
+);
+"""
+
+# 最初に表示するメッセージ数 (「以前のメッセージを表示」で1ページずつ増える)
+PAGE_SIZE = 20
+# 会話IDを入れておくクエリパラメータの名前
+QUERY_PARAM = "conversation"
+
+
+class ChatHistoryStore:
+    """ 会話履歴を保存する SQLite ストア """
+
+    def __init__(self, path=None):
+        self.path = path or data_path("chat_history.sqlite3")
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        return _connect(self.path)
+
+    def create_conversation(self, app):
+        conversation_id = uuid.uuid4().hex
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                "INSERT INTO conversations (id, app, created) VALUES (?, ?, ?)",
+                (conversation_id, app, time.time()),
+            )
+        return conversation_id
+
+    def exists(self, conversation_id, app):
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT 1 FROM conversations WHERE id = ? AND app = ?",
+                (conversation_id, app),
+            ).fetchone()
+        return row is not None
+
+    def append(self, conversation_id, role, content):
+        """ メッセージを会話の末尾に追記し、その番号 (0始まり) を返す """
+        with self._lock, self._connect() as conn:
+            (seq,) = conn.execute(
+                "SELECT COALESCE(MAX(seq) + 1, 0) FROM messages WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+            conn.execute(
+                "INSERT INTO messages (conversation_id, seq, ts, role, content) VALUES (?, ?, ?, ?, ?)",
+                (conversation_id, seq, time.time(), role, content),
+            )
+        return seq
+
+    def count(self, conversation_id):
+        with self._connect() as conn:
+            (n,) = conn.execute(
+                "SELECT COUNT(*) FROM messages WHERE conversation_id = ?",
+                (conversation_id,),
+            ).fetchone()
+        return n
+
+    def load(self, conversation_id, start=0, stop=None):
+        """ 番号が start 以上 stop 未満のメッセージを (role, content) のリストで返す """
+        return _load(self.path, conversation_id, start, stop)
+
+
+def _connect(path):
+    # Streamlit は複数スレッドから呼ぶので、接続は都度作成する
+    return sqlite3.connect(path, timeout=30)
+
+def _load(path, conversation_id, start=0, stop=None):
+    query = "SELECT role, content FROM messages WHERE conversation_id = ? AND seq >= ?"
+    params = [conversation_id, start]
+    if stop is not None:
+        query += " AND seq < ?"
+        params.append(stop)
+    with _connect(path) as conn:
+        return conn.execute(query + " ORDER BY seq", params).fetchall()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_chat_history_store():
+    """ プロセス内で共有する ChatHistoryStore を返す """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = ChatHistoryStore()
+        return _store
+
+
+def get_conversation_id(app, new=False):
+    """
+    URL のクエリパラメータから会話IDを取り出す
+
+    パラメータがない・別のアプリの会話IDの場合や new=True の場合は、新しい会話を作って URL に入れる
+    """
+    import streamlit as st
+
+    store = get_chat_history_store()
+    conversation_id = st.query_params.get(QUERY_PARAM)
+    if new or not conversation_id or not store.exists(conversation_id, app):
+        conversation_id = store.create_conversation(app)
+        st.query_params[QUERY_PARAM] = conversation_id
+    return conversation_id
+
+
+@lru_cache(maxsize=256)
+def _page_markdown(path, conversation_id, start, stop):
+    # 追記のみのストアなので、同じ範囲の内容は変わらない
+    # (ストアのオブジェクトではなくパスをキーにして、作り直したストアでもキャッシュを使う)
+    return "\n\n---\n\n".join(
+        f"**{role}**\n\n{content}" for role, content in _load(path, conversation_id, start, stop))
+
+def display_history(conversation_id, page_size=PAGE_SIZE):
+    """
+    会話履歴を表示する
+
+    直近の page_size 件 (区切りによっては最大 2 * page_size - 1 件) はメッセージごとに表示し、
+    それより前はページごとのボタンだけを表示する。ボタンで開いたページだけを読み込み、
+    まとめて1つの markdown として表示する (閉じているページは再実行のたびに描画しない)
+    """
+    import streamlit as st
+
+    store = get_chat_history_store()
+    total = store.count(conversation_id)
+    pages_key = f"history_pages_{conversation_id}"
+    pages = st.session_state.get(pages_key, 0)
+    # 開いている以前のページ (ページの先頭の番号の集合)
+    opened_key = f"history_opened_{conversation_id}"
+    opened = st.session_state.setdefault(opened_key, set())
+    # 表示範囲の区切りは page_size の倍数にそろえる (以前のページの範囲が変わらず、キャッシュが効く)
+    window_start = max(0, total - page_size) // page_size * page_size
+    start = max(0, window_start - pages * page_size)
+    if start > 0:
+        # on_click はスクリプトの再実行より前に呼ばれるので、押した回の表示から反映される
+        st.button(
+            f"以前のメッセージを表示 (残り {start} 件)",
+            on_click=lambda: st.session_state.update({pages_key: pages + 1}))
+
+    for page_start in range(start, window_start, page_size):
+        stop = page_start + page_size
+        is_open = page_start in opened
+        st.button(
+            f"{'▼' if is_open else '▶'} メッセージ {page_start + 1} - {stop}",
+            key=f"history_page_{conversation_id}_{page_start}",
+            on_click=opened.symmetric_difference_update, args=({page_start},))
+        if is_open:
+            st.markdown(_page_markdown(str(store.path), conversation_id, page_start, stop))
+
+    for role, content in store.load(conversation_id, window_start):
+        st.chat_message(role).markdown(content)
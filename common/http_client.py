@@ -0,0 +1,102 @@
+"""
+生成を中断したときに接続を直接切れる HTTP クライアント (common.models がプロバイダの SDK に渡す)
+
+CancellationHandler の中断は、次のトークンが届いたときに効く。最初のトークンを待っている間は
+スレッドが受信で止まっているので、ヘッジで負けた側や再実行で捨てられた生成の接続とスレッドが、
+トークンが届くまで残ってしまう。
+
+このクライアントで受けたレスポンスは、リクエストを送ったスレッドで実行中の呼び出しに付いている
+CancellationHandler (common.cancellation.active_handlers) に登録する。cancel() されたらソケットを
+shutdown して受信を待っているスレッドを起こし、そのスレッドでは中断の例外 (GenerationCancelled など) を送出させる。
+(レスポンスのヘッダーが届く前に cancel() された場合は、ヘッダーが届いた時点で切る)
+"""
+import socket
+import threading
+
+import httpx
+
+from common.cancellation import active_handlers
+
+# プロバイダの SDK の既定値に合わせる
+TIMEOUT = httpx.Timeout(timeout=600, connect=5.0)
+LIMITS = httpx.Limits(max_connections=1000, max_keepalive_connections=100)
+
+
+class _Connection:
+    """ 受信中のレスポンス1つ分の接続 """
+
+    def __init__(self, response):
+        self.response = response
+        self.error = None
+
+    def abort(self, error):
+        """ 接続を切り、受信しているスレッドで error を送出させる """
+        if self.error is not None:
+            return
+        self.error = error
+        network_stream = self.response.extensions.get("network_stream")
+        sock = network_stream.get_extra_info("socket") if network_stream is not None else None
+        if sock is None:
+            return
+        try:
+            # close() だけでは別のスレッドで待っている recv は戻らないので、shutdown で起こす
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+
+class _AbortableStream(httpx.SyncByteStream):
+    """ 接続が切られた場合に、読み取りのエラーの代わりに中断の例外を送出するレスポンスの本文 """
+
+    def __init__(self, stream, connection, handlers):
+        self.stream = stream
+        self.connection = connection
+        self.handlers = handlers
+
+    def __iter__(self):
+        try:
+            yield from self.stream
+        except Exception as e:
+            if self.connection.error is not None:
+                raise self.connection.error() from e
+            raise
+        if self.connection.error is not None:
+            raise self.connection.error()
+
+    def close(self):
+        for handler in self.handlers:
+            handler.untrack(self.connection)
+        self.stream.close()
+
+
+class CancellableTransport(httpx.HTTPTransport):
+    """ レスポンスを、実行中の呼び出しの CancellationHandler から切れるようにするトランスポート """
+
+    def handle_request(self, request):
+        handlers = active_handlers()
+        response = super().handle_request(request)
+        if not handlers:
+            return response
+        connection = _Connection(response)
+        response = httpx.Response(
+            status_code=response.status_code,
+            headers=response.headers,
+            stream=_AbortableStream(response.stream, connection, handlers),
+            extensions=response.extensions,
+        )
+        for handler in handlers:
+            handler.track(connection)
+        return response
+
+
+_http_client = None
+_http_client_lock = threading.Lock()
+
+def get_http_client():
+    """ プロセス内で共有する、中断できる httpx.Client を返す """
+    global _http_client
+    with _http_client_lock:
+        if _http_client is None:
+            _http_client = httpx.Client(
+                transport=CancellableTransport(limits=LIMITS), timeout=TIMEOUT, follow_redirects=True)
+        return _http_client
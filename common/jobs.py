@@ -0,0 +1,324 @@
+"""
+時間のかかる処理を実行するバックグラウンドのジョブキュー
+
+PDFのインデックス作成や長いコンテンツの要約を Streamlit のスクリプトのスレッドで実行すると、
+その間は画面が固まり、再実行やページの移動で途中までの処理が捨てられてしまう。
+ここではプロセス内で共有するワーカーで実行し、ページは進捗を定期的に確認して表示する。
+
+- ジョブは入力の内容から作ったキー (job_key) で識別する。同じキーで投入すると実行中・完了済みの
+  ジョブが返されるので、再実行しても二重に実行されず、他のセッションからも結果が再利用される
+- 完了した結果は .data/jobs/<key>.pkl に保存し、プロセスを再起動した後も再利用する
+  メモリには残さず、job.result を参照したときにディスクから読み込む (埋め込みのような大きな結果が
+  セッションごとのメモリ予算の外でたまらないように)。ディスクのキャッシュは容量と経過日数で古いものから消す
+- 失敗したジョブは FAILED_RETRY_AFTER 秒の間は同じキーで投入しても失敗したまま返す
+  (再実行のたびに同じエラーをすぐに繰り返さないように)。すぐにやり直す場合は retry=True で投入する
+- abandon_after を指定したジョブは、ページが job.touch() で見に来なくなってから一定時間たつと中断する
+  (要約のように、見ている人がいなくなったら続ける意味がない生成のため)
+- API の呼び出しのような I/O 待ちの処理はワーカースレッドで、PDFの解析のような CPU を使う処理は
+  run_in_process でプロセスプールで実行する (GIL で他のセッションのスクリプトを止めないように)
+
+    job = get_job_queue().submit(job_key("summary", model, content), stream_to_job, chain, {"content": content})
+    job.status / job.progress / job.message / job.partial / job.result
+"""
+import hashlib
+import json
+import logging
+import multiprocessing
+import os
+import pickle
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+
+from common.cancellation import CancellationHandler
+from common.paths import data_path
+
+logger = logging.getLogger(__name__)
+
+# ジョブを実行するワーカースレッドの数
+WORKERS = int(os.environ.get("JOB_WORKERS", "4"))
+# CPU を使う処理を実行するプロセスの数
+PROCESS_WORKERS = int(os.environ.get("JOB_PROCESS_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+# メモリ上に残しておく終了済みのジョブの数 (結果はディスクにあるので、追い出しても再利用できる)
+MAX_FINISHED_JOBS = 100
+# ディスクにキャッシュする結果の合計サイズと保存期間の上限
+MAX_CACHE_BYTES = int(float(os.environ.get("JOB_CACHE_MB", "1024")) * 1024 * 1024)
+MAX_CACHE_AGE = float(os.environ.get("JOB_CACHE_DAYS", "30")) * 86400
+# 失敗したジョブを、同じキーで投入されても再実行しない期間 (秒)
+FAILED_RETRY_AFTER = float(os.environ.get("JOB_RETRY_AFTER", "60"))
+# ページが進捗を確認する間隔 (秒)
+POLL_INTERVAL = 0.5
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+def job_key(*parts):
+    """ ジョブの種類と入力からキーを作る (bytes は中身のハッシュを使う) """
+    normalized = [
+        hashlib.sha256(part).hexdigest() if isinstance(part, (bytes, bytearray)) else part
+        for part in parts
+    ]
+    payload = json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+class Job:
+    """ 1つのジョブの状態 (ワーカーが更新し、ページが読み出す) """
+
+    def __init__(self, key, label=None, loader=None, abandon_after=None):
+        self.key = key
+        self.label = label or key[:12]
+        self.status = QUEUED
+        self.progress = 0.0
+        self.message = ""
+        # 途中までの出力 (要約の途中経過など)
+        self.partial = None
+        self.error = None
+        self.submitted = time.time()
+        self.finished = None
+        # 結果を読み込む関数 (結果はディスクのキャッシュにだけ置く)
+        self._loader = loader
+        # ジョブの関数はモデルの呼び出しの config の callbacks にこれを入れると、中断できるようになる
+        self.cancellation = CancellationHandler()
+        self.abandon_after = abandon_after
+        self.last_seen = time.time()
+
+    @property
+    def done(self):
+        return self.status in (DONE, FAILED)
+
+    @property
+    def result(self):
+        """ 完了したジョブの結果 (参照するたびにディスクから読み込む。読めなければ None) """
+        if self.status != DONE or self._loader is None:
+            return None
+        return self._loader(self.key)
+
+    @property
+    def retryable(self):
+        """ 失敗したジョブのうち、投入し直せば再実行するもの (中断されたものと、失敗してから時間がたったもの) """
+        if self.status != FAILED:
+            return False
+        return self.cancellation.cancelled or time.time() - self.finished >= FAILED_RETRY_AFTER
+
+    @property
+    def abandoned(self):
+        """ abandon_after 秒以上、どのページからも見られていない実行中のジョブかどうか """
+        return (self.abandon_after is not None and not self.done
+                and time.time() - self.last_seen > self.abandon_after)
+
+    def touch(self):
+        """ ページがこのジョブを表示している (見ている人がいる) ことを記録する """
+        self.last_seen = time.time()
+
+    def report(self, progress=None, message=None, partial=None):
+        """ ジョブの関数から進捗を報告する """
+        if progress is not None:
+            self.progress = min(1.0, max(0.0, progress))
+        if message is not None:
+            self.message = message
+        if partial is not None:
+            self.partial = partial
+
+
+class JobQueue:
+    """ キーで重複を除くジョブキュー (結果はディスクにキャッシュする) """
+
+    def __init__(self, workers=WORKERS, process_workers=PROCESS_WORKERS, cache_dir=None):
+        self.cache_dir = Path(cache_dir) if cache_dir else data_path("jobs")
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.process_workers = process_workers
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="job")
+        self._process_pool = None
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._watchdog = None
+        self._prune_cache()
+
+    def _cache_path(self, key):
+        return self.cache_dir / f"{key}.pkl"
+
+    def _load(self, key):
+        path = self._cache_path(key)
+        try:
+            with open(path, "rb") as f:
+                result = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception:
+            logger.warning("Ignoring unreadable job cache %s", path, exc_info=True)
+            # 次に投入されたときに実行し直すよう消しておく
+            path.unlink(missing_ok=True)
+            return None
+        # 最近使った結果ほど容量の上限で消されないよう、更新日時を使った日時にする
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return result
+
+    def _save(self, key, result):
+        path = self._cache_path(key)
+        # 書き込み途中のファイルを読まないよう、書き終わってから置き換える
+        tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(result, f)
+        os.replace(tmp, path)
+        self._prune_cache()
+
+    def _prune_cache(self):
+        """ 保存期間を過ぎた結果と、容量の上限を超えた分の古い結果をディスクから消す """
+        with self._lock:
+            # メモリ上のジョブの結果は、ページがまだ読みに来るかもしれないので残す
+            in_use = set(self._jobs)
+        entries = []
+        for path in self.cache_dir.glob("*.pkl"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        now = time.time()
+        total = sum(size for _, size, _ in entries)
+        for mtime, size, path in entries:
+            if now - mtime <= MAX_CACHE_AGE and total <= MAX_CACHE_BYTES:
+                break
+            if path.stem in in_use:
+                continue
+            path.unlink(missing_ok=True)
+            total -= size
+
+    def submit(self, key, func, *args, label=None, abandon_after=None, retry=False, **kwargs):
+        """
+        func(job, *args, **kwargs) をワーカーで実行するジョブを投入し、Job を返す
+
+        同じキーのジョブが実行中・完了済みの場合や、結果がキャッシュにある場合はそれを返す。
+        失敗したジョブは FAILED_RETRY_AFTER 秒たつまで失敗したまま返す (retry=True ならすぐに再実行する。
+        中断されたジョブは投入し直すと再実行する)。
+        abandon_after (秒) を指定すると、その間 job.touch() されなかったジョブは中断する
+        """
+        with self._lock:
+            job = self._jobs.get(key)
+            if job is not None and job.status == FAILED:
+                if not (retry or job.retryable):
+                    return job
+            # 完了済みでも、結果のファイルが消えていれば実行し直す
+            elif job is not None and (job.status != DONE or self._cache_path(key).exists()):
+                job.touch()
+                return job
+            job = Job(key, label, loader=self._load, abandon_after=abandon_after)
+            self._jobs[key] = job
+            self._evict()
+        if self._cache_path(key).exists():
+            job.progress = 1.0
+            job.finished = time.time()
+            job.status = DONE
+            return job
+        if abandon_after is not None:
+            self._start_watchdog()
+        self._executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def get(self, key):
+        with self._lock:
+            return self._jobs.get(key)
+
+    def _run(self, job, func, args, kwargs):
+        job.status = RUNNING
+        try:
+            # 待っている間に見ている人がいなくなったジョブは始めない
+            job.cancellation.raise_if_cancelled()
+            result = func(job, *args, **kwargs)
+            self._save(job.key, result)
+        except Exception as e:
+            if job.cancellation.cancelled:
+                logger.info("Job %s was abandoned", job.label)
+                job.error = "表示しているページがなくなったため中断しました"
+            else:
+                logger.exception("Job %s failed", job.label)
+                job.error = f"{type(e).__name__}: {e}"
+            job.status = FAILED
+        else:
+            job.progress = 1.0
+            job.status = DONE
+        finally:
+            job.finished = time.time()
+
+    def _start_watchdog(self):
+        with self._lock:
+            if self._watchdog is None:
+                self._watchdog = threading.Thread(target=self._watch, name="job-watchdog", daemon=True)
+                self._watchdog.start()
+
+    def _watch(self):
+        """ 見ている人がいなくなったジョブを中断する (生成中ならプロバイダへの接続も切る) """
+        while True:
+            time.sleep(POLL_INTERVAL)
+            with self._lock:
+                jobs = [job for job in self._jobs.values() if job.abandoned]
+            for job in jobs:
+                if not job.cancellation.cancelled:
+                    job.cancellation.cancel()
+
+    def _evict(self):
+        finished = sorted(
+            (job for job in self._jobs.values() if job.done), key=lambda job: job.finished)
+        for job in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[job.key]
+
+    def run_in_process(self, func, *args):
+        """ func(*args) をプロセスプールで実行して結果を返す (func と引数・戻り値は pickle できること) """
+        with self._lock:
+            if self._process_pool is None:
+                # スレッドを使っているプロセスを fork しないよう spawn で起動する
+                self._process_pool = ProcessPoolExecutor(
+                    max_workers=self.process_workers, mp_context=multiprocessing.get_context("spawn"))
+        return self._process_pool.submit(func, *args).result()
+
+
+_job_queue = None
+_job_queue_lock = threading.Lock()
+
+def get_job_queue():
+    """ プロセス内で共有する JobQueue を返す """
+    global _job_queue
+    with _job_queue_lock:
+        if _job_queue is None:
+            _job_queue = JobQueue()
+        return _job_queue
+
+def run_in_process(func, *args):
+    return get_job_queue().run_in_process(func, *args)
+
+
+def stream_to_job(job, runnable, input):
+    """
+    runnable をストリーミングで実行するジョブ (途中までの出力を job.partial に入れ、全文を返す)
+
+    job.cancellation を渡しておくので、abandon_after で中断するとモデルの生成も止まる
+    """
+    text = ""
+    for chunk in runnable.stream(input, {"callbacks": [job.cancellation]}):
+        text += chunk
+        job.report(partial=text)
+    return text
+
+
+def display_job_progress(jobs):
+    """ ジョブの進捗を表示する (終わっていないジョブがあれば True を返す) """
+    import streamlit as st
+
+    pending = False
+    for job in jobs:
+        job.touch()
+        if job.status == FAILED:
+            st.error(f"{job.label}: {job.error}")
+        elif not job.done:
+            pending = True
+            st.progress(job.progress, text=f"{job.label}: {job.message or job.status}")
+    return pending
@@ -0,0 +1,338 @@
+"""
+各プロバイダのレスポンスに含まれる実際の使用量(トークン数・レイテンシ)を記録する
+
+LangChain のコールバックとしてモデルに渡しておくと、invoke / stream のどちらでも
+呼び出しごとに1行ずつ SQLite に書き込まれる。
+
+ストリーミングが途中で打ち切られた場合 (再実行やタブを閉じたことで common.streaming が
+生成を中断した場合) は error="cancelled" として記録し、打ち切らなければ生成されていたはずの
+トークン数の推定値 (同じアプリ・モデルの平均出力トークン数 - 生成済みのトークン数) をイベントとして記録する。
+ヘッジ (common.routing) で負けて中断した呼び出しは、ユーザーの打ち切りとは分けて error="hedge_cancelled" として記録する。
+
+集計結果の確認:
+    python -m common.metering --by app,model,day
+    python -m common.metering --events
+"""
+import argparse
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from common.cancellation import is_cancellation, is_hedge_cancellation
+from common.paths import data_path
+from common.session import get_session_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS usage (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    app TEXT,
+    session_id TEXT,
+    provider TEXT,
+    model TEXT,
+    input_tokens INTEGER DEFAULT 0,
+    output_tokens INTEGER DEFAULT 0,
+    cached_tokens INTEGER DEFAULT 0,
+    latency_ms REAL,
+    first_token_ms REAL,
+    streaming INTEGER DEFAULT 0,
+    error TEXT
+);
+CREATE INDEX IF NOT EXISTS usage_app_model_day ON usage (app, model, day);
+CREATE INDEX IF NOT EXISTS usage_session ON usage (session_id);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    ts REAL NOT NULL,
+    day TEXT NOT NULL,
+    app TEXT,
+    session_id TEXT,
+    model TEXT,
+    kind TEXT NOT NULL,
+    tokens INTEGER DEFAULT 0
+);
+"""
+
+# 途中で打ち切られた呼び出しの error 列の値
+CANCELLED = "cancelled"
+# ヘッジで負けて中断した呼び出しの error 列の値
+HEDGE_CANCELLED = "hedge_cancelled"
+# 打ち切りで生成せずに済んだトークン数の推定値のイベント
+TOKENS_AVOIDED = "cancel_tokens_avoided"
+
+# 集計に使える列
+GROUP_COLUMNS = ("app", "model", "provider", "day", "session_id")
+
+
+class UsageStore:
+    """ 使用量を保存する SQLite ストア """
+
+    def __init__(self, path=None):
+        self.path = path or data_path("usage.sqlite3")
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.executescript(SCHEMA)
+
+    def _connect(self):
+        # Streamlit は複数スレッドから呼ぶので、接続は都度作成する
+        return sqlite3.connect(self.path, timeout=30)
+
+    def record(self, **row):
+        self._insert("usage", row)
+
+    def record_event(self, kind, **row):
+        self._insert("events", {"kind": kind, **row})
+
+    def _insert(self, table, row):
+        row.setdefault("ts", time.time())
+        row.setdefault("day", datetime.fromtimestamp(row["ts"]).strftime("%Y-%m-%d"))
+        columns = ", ".join(row)
+        placeholders = ", ".join("?" for _ in row)
+        with self._lock, self._connect() as conn:
+            conn.execute(
+                f"INSERT INTO {table} ({columns}) VALUES ({placeholders})",
+                tuple(row.values()),
+            )
+
+    def average_output_tokens(self, app, model):
+        """ 最後まで生成された呼び出しの平均出力トークン数 (記録がなければ None) """
+        query = """
+            SELECT AVG(output_tokens) FROM usage
+            WHERE app IS ? AND model IS ? AND error IS NULL AND output_tokens > 0
+        """
+        with self._connect() as conn:
+            return conn.execute(query, (app, model)).fetchone()[0]
+
+    def event_summary(self, since=None):
+        """ イベントの種類・アプリ・モデルごとの回数と合計トークン数 """
+        where, params = "", ()
+        if since is not None:
+            where, params = "WHERE ts >= ?", (since,)
+        query = f"""
+            SELECT kind, app, model, COUNT(*) AS events, SUM(tokens) AS tokens
+            FROM events {where}
+            GROUP BY kind, app, model
+            ORDER BY SUM(tokens) DESC
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r) for r in conn.execute(query, params)]
+
+    def summary(self, group_by=("app", "model", "day"), since=None):
+        """ group_by の列ごとに呼び出し回数・トークン数・レイテンシを集計する """
+        for column in group_by:
+            if column not in GROUP_COLUMNS:
+                raise ValueError(f"Unknown group_by column: {column}")
+        keys = ", ".join(group_by)
+        where, params = "", ()
+        if since is not None:
+            where, params = "WHERE ts >= ?", (since,)
+        query = f"""
+            SELECT {keys},
+                COUNT(*) AS calls,
+                SUM(error IS NOT NULL) AS errors,
+                SUM(input_tokens) AS input_tokens,
+                SUM(output_tokens) AS output_tokens,
+                SUM(cached_tokens) AS cached_tokens,
+                SUM(latency_ms) AS total_latency_ms,
+                AVG(latency_ms) AS avg_latency_ms,
+                AVG(first_token_ms) AS avg_first_token_ms
+            FROM usage {where}
+            GROUP BY {keys}
+            ORDER BY SUM(input_tokens) + SUM(output_tokens) DESC
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r) for r in conn.execute(query, params)]
+
+    def session_totals(self, session_id):
+        """ セッション内のモデルごとの合計トークン数 """
+        query = """
+            SELECT model,
+                SUM(input_tokens) AS input_tokens,
+                SUM(output_tokens) AS output_tokens,
+                SUM(cached_tokens) AS cached_tokens
+            FROM usage WHERE session_id = ? GROUP BY model
+        """
+        with self._connect() as conn:
+            conn.row_factory = sqlite3.Row
+            return [dict(r) for r in conn.execute(query, (session_id,))]
+
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_usage_store():
+    """ プロセス内で共有する UsageStore を返す """
+    global _store
+    with _store_lock:
+        if _store is None:
+            _store = UsageStore()
+        return _store
+
+
+def extract_usage(response):
+    """ LLMResult から (入力, 出力, キャッシュ) のトークン数を取り出す """
+    input_tokens = output_tokens = cached_tokens = 0
+    for generations in response.generations:
+        for generation in generations:
+            message = getattr(generation, "message", None)
+            if message is None:
+                continue
+            usage = getattr(message, "usage_metadata", None) or {}
+            input_tokens += usage.get("input_tokens", 0) or 0
+            output_tokens += usage.get("output_tokens", 0) or 0
+            details = usage.get("input_token_details") or {}
+            cached = details.get("cache_read")
+            if cached is None:
+                cached = _cached_from_metadata(message.response_metadata)
+            cached_tokens += cached or 0
+
+    # usage_metadata を返さない古い実装向け
+    if not (input_tokens or output_tokens) and response.llm_output:
+        usage = response.llm_output.get("token_usage") or response.llm_output.get("usage") or {}
+        input_tokens = usage.get("prompt_tokens", usage.get("input_tokens", 0)) or 0
+        output_tokens = usage.get("completion_tokens", usage.get("output_tokens", 0)) or 0
+    return input_tokens, output_tokens, cached_tokens
+
+def _cached_from_metadata(metadata):
+    # OpenAI: token_usage.prompt_tokens_details.cached_tokens
+    # Anthropic: usage.cache_read_input_tokens
+    token_usage = metadata.get("token_usage") or {}
+    details = token_usage.get("prompt_tokens_details") or {}
+    if "cached_tokens" in details:
+        return details["cached_tokens"]
+    usage = metadata.get("usage") or {}
+    return usage.get("cache_read_input_tokens", 0)
+
+
+class UsageCallbackHandler(BaseCallbackHandler):
+    """ LLMの呼び出しごとに使用量とレイテンシを UsageStore に書き込むコールバック """
+
+    def __init__(self, app, session_id=None, store=None):
+        self.app = app
+        self.session_id = session_id
+        self.store = store or get_usage_store()
+        self._runs = {}
+
+    def _start(self, run_id, kwargs):
+        params = kwargs.get("invocation_params") or {}
+        metadata = kwargs.get("metadata") or {}
+        self._runs[run_id] = {
+            "start": time.perf_counter(),
+            "first_token": None,
+            "tokens": 0,
+            "provider": metadata.get("ls_provider") or params.get("_type"),
+            "model": metadata.get("ls_model_name") or params.get("model") or params.get("model_name"),
+        }
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, **kwargs):
+        self._start(run_id, kwargs)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, **kwargs):
+        self._start(run_id, kwargs)
+
+    def on_llm_new_token(self, token, *, run_id, chunk=None, **kwargs):
+        run = self._runs.get(run_id)
+        if run is None:
+            return
+        # role だけの最初のチャンクや使用量だけのチャンクは、トークンとして数えない
+        message = getattr(chunk, "message", None)
+        if not token and not getattr(message, "tool_call_chunks", None):
+            return
+        if run["first_token"] is None:
+            run["first_token"] = time.perf_counter()
+        # ストリーミングのチャンクはほぼ1トークンずつ届く (打ち切られた場合の生成済みトークン数の目安)
+        run["tokens"] += 1
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        input_tokens, output_tokens, cached_tokens = extract_usage(response)
+        model = run["model"]
+        if response.llm_output:
+            model = response.llm_output.get("model_name") or response.llm_output.get("model") or model
+        self._write(run, model=model, input_tokens=input_tokens,
+                    output_tokens=output_tokens, cached_tokens=cached_tokens)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        if is_cancellation(error):
+            self._write_cancelled(run)
+            return
+        if is_hedge_cancellation(error):
+            # ヘッジの負けは生成せずに済んだトークン数には数えない
+            self._write(run, model=run["model"], output_tokens=run["tokens"], error=HEDGE_CANCELLED)
+            return
+        self._write(run, model=run["model"], error=type(error).__name__)
+
+    def _write_cancelled(self, run):
+        """ 生成が途中で中断された呼び出しを記録する """
+        generated = run["tokens"]
+        self._write(run, model=run["model"], output_tokens=generated, error=CANCELLED)
+        average = self.store.average_output_tokens(self.app, run["model"])
+        if average is not None and average > generated:
+            self.store.record_event(
+                TOKENS_AVOIDED, app=self.app, session_id=self.session_id,
+                model=run["model"], tokens=round(average - generated))
+
+    def _write(self, run, **row):
+        end = time.perf_counter()
+        first_token = run["first_token"]
+        self.store.record(
+            app=self.app,
+            session_id=self.session_id,
+            provider=run["provider"],
+            latency_ms=(end - run["start"]) * 1000,
+            first_token_ms=(first_token - run["start"]) * 1000 if first_token else None,
+            streaming=int(first_token is not None),
+            **row,
+        )
+
+
+def get_usage_handler(app):
+    """ 現在のセッション用の計測コールバックを返す """
+    return UsageCallbackHandler(app, session_id=get_session_id())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="LLMの使用量を集計して表示する")
+    parser.add_argument("--by", default="app,model,day",
+                        help=f"集計キー (カンマ区切り: {', '.join(GROUP_COLUMNS)})")
+    parser.add_argument("--days", type=float, default=None, help="直近N日分のみ集計する")
+    parser.add_argument("--events", action="store_true",
+                        help="使用量の代わりにイベント (打ち切りで生成せずに済んだトークン数など) を集計する")
+    args = parser.parse_args()
+
+    since = time.time() - args.days * 86400 if args.days else None
+    if args.events:
+        rows = get_usage_store().event_summary(since=since)
+    else:
+        group_by = tuple(c.strip() for c in args.by.split(",") if c.strip())
+        rows = get_usage_store().summary(group_by=group_by, since=since)
+    if not rows:
+        print("No usage recorded yet.")
+        return
+
+    columns = list(rows[0])
+    cells = [[_format(row[c]) for c in columns] for row in rows]
+    widths = [max(len(c), *(len(r[i]) for r in cells)) for i, c in enumerate(columns)]
+    print("  ".join(c.ljust(w) for c, w in zip(columns, widths)))
+    for r in cells:
+        print("  ".join(v.ljust(w) for v, w in zip(r, widths)))
+
+def _format(value):
+    if value is None:
+        return "-"
+    if isinstance(value, float):
+        return f"{value:.1f}"
+    return str(value)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+from common.cassette import is_replaying, wrap_chat_model, wrap_embeddings
+from common.metering import get_usage_handler
+from common.rate_limit import DEFAULT_MAX_RETRIES, RateLimitedChatModel, RateLimitedEmbeddings
+from common.routing import HedgedChatModel
+
+# 各アプリで選択できるモデル
+MODELS = ["gpt-4o-mini", "claude-3-5-sonnet-20240620"]
+
+def create_chat_model(model_name, temperature=0.0, app=None, callbacks=None,
+                      fallback_model=None, hedge_delay=None, rate_limit=True, **kwargs):
+    """
+    モデル名からチャットモデルを作成する
+
+    app を指定すると、使用量の計測コールバック(common.metering)が自動で付く
+    fallback_model を指定すると、common.routing.HedgedChatModel でヘッジ・フェイルオーバーする
+    rate_limit=True の場合は common.rate_limit のレート制限・再試行を付ける
+    (再試行はこちらで行うので、SDK側の再試行は無効にする。回数は max_retries で指定できる)
+    カセット(common.cassette)が有効な場合は、呼び出しを記録・再生するモデルになる
+    """
+    if fallback_model:
+        return HedgedChatModel(
+            # SDK側のリトライを待たずにすぐ切り替えるため、プライマリのリトライは無効にする
+            primary=create_chat_model(model_name, temperature, app=app, callbacks=callbacks,
+                                      rate_limit=rate_limit, **{**kwargs, "max_retries": 0}),
+            secondary=create_chat_model(fallback_model, temperature, app=app, callbacks=callbacks,
+                                        rate_limit=rate_limit, **kwargs),
+            hedge_delay=hedge_delay,
+            )
+
+    # カセットの再生時は API を呼ばないので、プロバイダのモデルは作らない
+    if is_replaying():
+        return wrap_chat_model(None, model_name)
+
+    callbacks = list(callbacks or [])
+    if app:
+        callbacks.append(get_usage_handler(app))
+    max_retries = kwargs.pop("max_retries", DEFAULT_MAX_RETRIES)
+
+    # プロバイダのパッケージは読み込みに時間がかかるので、実際に使うものだけをここで読み込む
+    # 生成を中断したときに、最初のトークンを待っている接続も切れるようにする (common.http_client)
+    from common.http_client import get_http_client
+    if model_name.startswith("claude"):
+        from langchain_anthropic import ChatAnthropic
+        provider = "anthropic"
+        model = ChatAnthropic(
+            temperature=temperature,
+            model=model_name,
+            callbacks=callbacks,
+            max_retries=0 if rate_limit else max_retries,
+            **kwargs
+            )
+        # このバージョンの ChatAnthropic は http_client を受け取らないので、SDK のクライアントを差し替える
+        object.__setattr__(model, "_client", model._client.with_options(http_client=get_http_client()))
+    else:
+        from langchain_openai import ChatOpenAI
+        provider = "openai"
+        model = ChatOpenAI(
+            temperature=temperature,
+            model=model_name,
+            # ストリーミング時も最後のチャンクで使用量を返してもらう
+            stream_usage=True,
+            callbacks=callbacks,
+            max_retries=0 if rate_limit else max_retries,
+            http_client=get_http_client(),
+            **kwargs
+            )
+    if rate_limit:
+        model = RateLimitedChatModel(
+            inner=model, model_name=model_name, provider=provider, max_retries=max_retries)
+    return wrap_chat_model(model, model_name)
+
+def create_embeddings(model_name="text-embedding-3-small", rate_limit=True, **kwargs):
+    """ 埋め込みモデルを作成する (rate_limit=True の場合はレート制限・再試行を付ける) """
+    if is_replaying():
+        return wrap_embeddings(None, model_name)
+    from langchain_openai import OpenAIEmbeddings
+    max_retries = kwargs.pop("max_retries", DEFAULT_MAX_RETRIES)
+    embeddings = OpenAIEmbeddings(model=model_name, max_retries=0 if rate_limit else max_retries, **kwargs)
+    if rate_limit:
+        embeddings = RateLimitedEmbeddings(embeddings, model_name, "openai", max_retries=max_retries)
+    return wrap_embeddings(embeddings, model_name)
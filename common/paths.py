@@ -0,0 +1,15 @@
+import os
+from pathlib import Path
+
+# リポジトリのルート (common/ の一つ上)
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+# 計測結果やキャッシュなど、実行時に生成されるファイルの置き場所
+# 環境変数 LLM_APP_DATA_DIR で変更できる
+DATA_DIR = Path(os.environ.get("LLM_APP_DATA_DIR", REPO_ROOT / ".data"))
+
+def data_path(*parts):
+    """ DATA_DIR 配下のパスを返す (親ディレクトリは自動で作成) """
+    path = DATA_DIR.joinpath(*parts)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    return path
@@ -0,0 +1,474 @@
+"""
+プロバイダ・モデルごとのレート制限 (プロセス全体で共有)
+
+各アプリが OpenAI / Anthropic をそれぞれ勝手に呼ぶと、同時にアクセスが集中したときに
+RPM / TPM の上限を超えて 429 になり、そのまま画面にエラーが出てしまう。
+ここではモデルごとにリクエスト数とトークン数(推定)のトークンバケットを持ち、
+呼び出し側を到着順に待たせてから API を呼ぶ。
+
+- 429 / 5xx / 接続エラーは、指数バックオフ (ジッター付き) で再試行する
+- Retry-After ヘッダーがあればその時間だけ待ち、その間は同じモデルの他の呼び出しも止める
+- 呼び出しが終わったら、実際の使用量との差をトークンのバケットに戻す (または追加で差し引く)
+
+common.models.create_chat_model / create_embeddings で作ったモデルには自動で付く。
+"""
+import base64
+import io
+import itertools
+import math
+import os
+import random
+import threading
+import time
+from collections import deque
+from email.utils import parsedate_to_datetime
+from typing import Any
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+
+from common import cancellation
+from common.cancellation import cancellation_handlers, inherit_cancellation
+from common.routing import LatencyHistogram, is_retryable
+
+# (リクエスト数/分, トークン数/分)  モデル名の前方一致で探す。組織のティアに合わせて調整する
+RATE_LIMITS = {
+    "gpt-4o-mini": (500, 200_000),
+    "gpt-4o": (500, 30_000),
+    "claude-3-5-sonnet": (50, 40_000),
+    "text-embedding-3-small": (3_000, 1_000_000),
+}
+DEFAULT_RATE_LIMIT = (60, 40_000)
+# 環境変数で上書きする場合: LLM_RATE_LIMITS="gpt-4o-mini=500:200000,claude-3-5-sonnet=50:40000"
+RATE_LIMITS_ENV = "LLM_RATE_LIMITS"
+
+DEFAULT_MAX_RETRIES = 4
+# バックオフの初期値と上限 (秒)
+BACKOFF_BASE_SEC = 1.0
+BACKOFF_MAX_SEC = 30.0
+# 出力トークン数の上限が指定されていない場合の見積もり
+DEFAULT_OUTPUT_TOKENS = 1024
+# 1トークンあたりのおおよその文字数 (日本語はもっと少ないが、見積もりなので多少ずれてもよい)
+CHARS_PER_TOKEN = 4
+# 画像の入力トークンは base64 の文字数で数えると桁違いに多くなるので、各プロバイダの計算方法で見積もる
+# OpenAI は 512px のタイル単位: (基本のトークン数, タイル1枚のトークン数)  モデル名の前方一致で探す
+# (detail="low" は基本のトークン数だけ。gpt-4o-mini は画像のトークン数が gpt-4o の約33倍になる)
+IMAGE_TILE_TOKENS = {
+    "gpt-4o-mini": (2833, 5667),
+    "gpt-4o": (85, 170),
+    "gpt-4-turbo": (85, 170),
+}
+DEFAULT_IMAGE_TILE_TOKENS = (85, 170)
+# Anthropic は 幅×高さ / 750 トークン (長辺が 1568px を超える画像は縮小される)
+ANTHROPIC_PIXELS_PER_TOKEN = 750
+ANTHROPIC_MAX_SIDE = 1568
+# 大きさが分からない画像 (URL で渡したものなど) は、この大きさとみなす
+DEFAULT_IMAGE_SIZE = (1024, 1024)
+
+
+def _parse_limits(value):
+    limits = {}
+    for item in filter(None, (part.strip() for part in value.split(","))):
+        name, _, numbers = item.partition("=")
+        rpm, _, tpm = numbers.partition(":")
+        limits[name.strip()] = (int(rpm), int(tpm))
+    return limits
+
+def _find_by_prefix(table, model_name, default):
+    # 長い名前を先に見る (gpt-4o-mini が gpt-4o にマッチしないように)
+    for prefix in sorted(table, key=len, reverse=True):
+        if model_name.startswith(prefix):
+            return table[prefix]
+    return default
+
+def find_limits(model_name):
+    limits = {**RATE_LIMITS, **_parse_limits(os.environ.get(RATE_LIMITS_ENV, ""))}
+    return _find_by_prefix(limits, model_name, DEFAULT_RATE_LIMIT)
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+def image_tokens(model_name, width, height, detail="auto"):
+    """ 画像1枚の入力トークン数の見積もり (detail="auto" は "high" として多めに見積もる) """
+    if model_name.startswith("claude"):
+        scale = min(1.0, ANTHROPIC_MAX_SIDE / max(width, height))
+        return math.ceil(width * scale * height * scale / ANTHROPIC_PIXELS_PER_TOKEN)
+    base, per_tile = _find_by_prefix(IMAGE_TILE_TOKENS, model_name, DEFAULT_IMAGE_TILE_TOKENS)
+    if detail == "low":
+        return base
+    # 2048px 四方に収まるように縮小してから、短辺が 768px になるように縮小して、512px のタイルに分ける
+    scale = min(1.0, 2048 / max(width, height))
+    scale *= min(1.0, 768 / (min(width, height) * scale))
+    tiles = math.ceil(width * scale / 512) * math.ceil(height * scale / 512)
+    return base + per_tile * tiles
+
+def retry_after(error):
+    """ エラーのレスポンスの Retry-After (秒) を返す (なければNone) """
+    headers = getattr(getattr(error, "response", None), "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+def backoff_delay(attempt, base=BACKOFF_BASE_SEC, cap=BACKOFF_MAX_SEC):
+    """ 指数バックオフ (full jitter) の待ち時間 """
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+class TokenBucket:
+    """ rate (個/秒) で補充され、capacity 個まで貯まるバケット (ロックは RateLimiter 側で取る) """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """ amount 個取り出せるまでの秒数 """
+        self._refill()
+        if self.level >= amount:
+            return 0.0
+        return (amount - self.level) / self.rate
+
+    def take(self, amount):
+        self._refill()
+        self.level -= amount
+
+    def give_back(self, amount):
+        """ 見積もりとの差を戻す (負の値なら追加で差し引く) """
+        self._refill()
+        self.level = min(self.capacity, self.level + amount)
+
+
+class RateLimiter:
+    """ 1つのモデルのリクエスト数・トークン数の制限 (待っている呼び出しは到着順に通す) """
+
+    def __init__(self, name, requests_per_minute, tokens_per_minute):
+        self.name = name
+        self.requests = TokenBucket(requests_per_minute / 60, requests_per_minute)
+        self.tokens = TokenBucket(tokens_per_minute / 60, tokens_per_minute)
+        self._cond = threading.Condition()
+        self._queue = deque()
+        # Retry-After などで、この時刻までは誰も呼び出さない
+        self._blocked_until = 0.0
+        self.wait_histogram = LatencyHistogram()
+        self.stats = {"calls": 0, "retries": 0, "rate_limited": 0, "max_queue_depth": 0, "total_wait_ms": 0.0}
+
+    @property
+    def queue_depth(self):
+        return len(self._queue)
+
+    def acquire(self, tokens=0, requests=1, handlers=()):
+        """
+        リクエスト・トークンの枠が空くまで待ち、待った秒数を返す
+
+        handlers (CancellationHandler のリスト) のどれかが cancel() されたら、待つのをやめて例外を送出する
+        """
+        # 1回でバケットの容量を超える呼び出しは、容量いっぱいまで待てばよいことにする
+        tokens = min(tokens, self.tokens.capacity)
+        requests = min(requests, self.requests.capacity)
+        ticket = object()
+        started = time.monotonic()
+        with self._cond:
+            self._queue.append(ticket)
+            self.stats["max_queue_depth"] = max(self.stats["max_queue_depth"], len(self._queue))
+            try:
+                while True:
+                    cancellation.raise_if_cancelled(handlers)
+                    timeout = None
+                    # 先頭の呼び出しだけがバケットから取り出せる (後ろは先頭が通るまで待つ)
+                    if self._queue[0] is ticket:
+                        timeout = max(
+                            self.requests.wait_time(requests),
+                            self.tokens.wait_time(tokens),
+                            self._blocked_until - time.monotonic(),
+                        )
+                        if timeout <= 0:
+                            self.requests.take(requests)
+                            self.tokens.take(tokens)
+                            break
+                    if handlers:
+                        timeout = cancellation.POLL_INTERVAL if timeout is None else min(timeout, cancellation.POLL_INTERVAL)
+                    self._cond.wait(timeout=timeout)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+        waited = time.monotonic() - started
+        self.wait_histogram.observe(waited * 1000)
+        with self._cond:
+            self.stats["calls"] += 1
+            self.stats["total_wait_ms"] += waited * 1000
+        return waited
+
+    def settle(self, estimated_tokens, actual_tokens):
+        """ 呼び出し後に、見積もったトークン数と実際の使用量の差をバケットに反映する """
+        if actual_tokens is None:
+            return
+        with self._cond:
+            self.tokens.give_back(min(estimated_tokens, self.tokens.capacity) - actual_tokens)
+            self._cond.notify_all()
+
+    def settle_failure(self, estimated_tokens, error):
+        """
+        失敗した呼び出しの見積もりを精算する
+
+        HTTP のエラー (429 など) が返ってきた呼び出しは生成していないので使用量を 0 とする。
+        接続エラーやタイムアウトは途中まで生成したかもしれないので、見積もりのまま差し引いておく
+        """
+        status = getattr(error, "status_code", None)
+        if status is None:
+            status = getattr(getattr(error, "response", None), "status_code", None)
+        if status is not None:
+            self.settle(estimated_tokens, 0)
+
+    def retry_delay(self, error, attempt, max_retries):
+        """
+        再試行する場合は待つ秒数を、しない場合は None を返す
+
+        429 で Retry-After が返ってきた場合は、同じモデルの他の呼び出しもその間止める
+        """
+        if attempt >= max_retries or not is_retryable(error):
+            return None
+        wait = retry_after(error)
+        delay = wait if wait is not None else backoff_delay(attempt)
+        with self._cond:
+            self.stats["retries"] += 1
+            if getattr(error, "status_code", None) == 429:
+                self.stats["rate_limited"] += 1
+                self._blocked_until = max(self._blocked_until, time.monotonic() + delay)
+        return delay
+
+    def call(self, func, tokens=0, requests=1, max_retries=DEFAULT_MAX_RETRIES, handlers=()):
+        """ 枠を取ってから func() を呼び、失敗したらバックオフして再試行する """
+        for attempt in itertools.count():
+            self.acquire(tokens, requests, handlers)
+            try:
+                return func()
+            except Exception as e:
+                # 再試行で見積もりを取り直すので、失敗した分を先に戻しておく
+                self.settle_failure(tokens, e)
+                delay = self.retry_delay(e, attempt, max_retries)
+                if delay is None:
+                    raise
+                cancellation.sleep(delay, handlers)
+
+
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+def get_rate_limiter(provider, model_name):
+    """ プロセス内で共有する、プロバイダ・モデルごとの RateLimiter を返す """
+    key = f"{provider}:{model_name}"
+    with _limiters_lock:
+        if key not in _limiters:
+            _limiters[key] = RateLimiter(key, *find_limits(model_name))
+        return _limiters[key]
+
+def rate_limit_report():
+    """ モデルごとの待ち行列の長さ・待ち時間を表示用の dict のリストで返す """
+    with _limiters_lock:
+        limiters = sorted(_limiters.items())
+    rows = []
+    for name, limiter in limiters:
+        calls = limiter.stats["calls"]
+        rows.append({
+            "model": name,
+            "queue_depth": limiter.queue_depth,
+            "max_queue_depth": limiter.stats["max_queue_depth"],
+            "calls": calls,
+            "retries": limiter.stats["retries"],
+            "429": limiter.stats["rate_limited"],
+            "avg_wait_ms": round(limiter.stats["total_wait_ms"] / calls, 1) if calls else None,
+            "p95_wait_ms": limiter.wait_histogram.quantile(0.95),
+        })
+    return rows
+
+
+def _image_size(data):
+    """ base64 の画像の (幅, 高さ) を返す (読み取れなければ None) """
+    try:
+        # Pillow は Streamlit の依存なので入っているが、読み込みに時間がかかるので画像があるときだけ読み込む
+        from PIL import Image
+        with Image.open(io.BytesIO(base64.b64decode(data))) as image:
+            return image.size
+    except Exception:
+        return None
+
+def _image_block_tokens(block, model_name):
+    """ 画像のブロック (OpenAI の image_url / Anthropic の image) の入力トークン数の見積もり """
+    data, detail = None, "auto"
+    if block.get("type") == "image_url":
+        image_url = block.get("image_url")
+        if isinstance(image_url, dict):
+            detail = image_url.get("detail") or "auto"
+            image_url = image_url.get("url", "")
+        if isinstance(image_url, str) and image_url.startswith("data:") and "," in image_url:
+            data = image_url.split(",", 1)[1]
+    else:
+        source = block.get("source") or {}
+        if source.get("type") == "base64":
+            data = source.get("data")
+    size = _image_size(data) if data else None
+    width, height = size or DEFAULT_IMAGE_SIZE
+    return image_tokens(model_name, width, height, detail)
+
+def _content_tokens(content, model_name):
+    if isinstance(content, str):
+        return estimate_tokens(content)
+    tokens = 0
+    for block in content:
+        if isinstance(block, dict) and block.get("type") in ("image_url", "image"):
+            tokens += _image_block_tokens(block, model_name)
+        elif isinstance(block, dict) and block.get("type") == "text":
+            tokens += estimate_tokens(block.get("text", ""))
+        else:
+            tokens += estimate_tokens(str(block))
+    return tokens
+
+def _message_tokens(messages, model_name):
+    return sum(_content_tokens(message.content, model_name) for message in messages)
+
+def _usage_tokens(message):
+    usage = getattr(message, "usage_metadata", None)
+    if not usage:
+        return None
+    return usage.get("total_tokens") or usage.get("input_tokens", 0) + usage.get("output_tokens", 0)
+
+
+class RateLimitedChatModel(BaseChatModel):
+    """ 呼び出しの前にレート制限の枠を取り、429 などは再試行するチャットモデル """
+
+    inner: Any
+    model_name: str
+    provider: str
+    max_retries: int = DEFAULT_MAX_RETRIES
+
+    @property
+    def _llm_type(self):
+        return "rate-limited-chat"
+
+    @property
+    def limiter(self):
+        return get_rate_limiter(self.provider, self.model_name)
+
+    def bind_tools(self, tools, **kwargs):
+        return self.__class__(
+            inner=self.inner.bind_tools(tools, **kwargs),
+            model_name=self.model_name,
+            provider=self.provider,
+            max_retries=self.max_retries,
+            callbacks=self.callbacks,
+        )
+
+    def _estimate(self, messages, kwargs):
+        bound = getattr(self.inner, "bound", self.inner)  # bind_tools 済みの場合
+        output_tokens = kwargs.get("max_tokens") or getattr(bound, "max_tokens", None) or DEFAULT_OUTPUT_TOKENS
+        return _message_tokens(messages, self.model_name) + output_tokens
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._estimate(messages, kwargs)
+        # 計測用のコールバックは内側のモデルに直接付いているので、中断のコールバックだけを引き継ぐ
+        config = inherit_cancellation(run_manager)
+        message = self.limiter.call(
+            lambda: self.inner.invoke(messages, config, stop=stop, **kwargs),
+            tokens=tokens, max_retries=self.max_retries, handlers=cancellation_handlers(run_manager))
+        self.limiter.settle(tokens, _usage_tokens(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        tokens = self._estimate(messages, kwargs)
+        config = inherit_cancellation(run_manager)
+        handlers = cancellation_handlers(run_manager)
+        # 再試行できるのは、最初のチャンクが届く前に失敗した場合だけ
+        # (途中まで返した後にやり直すと、同じ内容を二重に返してしまう)
+        for attempt in itertools.count():
+            self.limiter.acquire(tokens, handlers=handlers)
+            stream = self.inner.stream(messages, config, stop=stop, **kwargs)
+            try:
+                first = next(stream, None)
+                break
+            except Exception as e:
+                stream.close()
+                self.limiter.settle_failure(tokens, e)
+                delay = self.limiter.retry_delay(e, attempt, self.max_retries)
+                if delay is None:
+                    raise
+                cancellation.sleep(delay, handlers)
+
+        merged = None
+        try:
+            chunk = first
+            while chunk is not None:
+                merged = chunk if merged is None else merged + chunk
+                generation = ChatGenerationChunk(message=chunk)
+                if run_manager:
+                    run_manager.on_llm_new_token(generation.text, chunk=generation)
+                yield generation
+                chunk = next(stream, None)
+        finally:
+            stream.close()
+            self.limiter.settle(tokens, _usage_tokens(merged) if merged is not None else None)
+
+
+class RateLimitedEmbeddings(Embeddings):
+    """ 埋め込みの呼び出しにレート制限と再試行を付ける """
+
+    def __init__(self, inner, model_name, provider, max_retries=DEFAULT_MAX_RETRIES):
+        self.inner = inner
+        self.model_name = model_name
+        self.provider = provider
+        self.max_retries = max_retries
+
+    @property
+    def limiter(self):
+        return get_rate_limiter(self.provider, self.model_name)
+
+    def embed_documents(self, texts):
+        # OpenAIEmbeddings は chunk_size 件ずつに分けてリクエストする
+        batch_size = getattr(self.inner, "chunk_size", None) or len(texts) or 1
+        return self.limiter.call(
+            lambda: self.inner.embed_documents(texts),
+            tokens=sum(estimate_tokens(text) for text in texts),
+            requests=max(1, math.ceil(len(texts) / batch_size)),
+            max_retries=self.max_retries,
+        )
+
+    def embed_query(self, text):
+        return self.limiter.call(
+            lambda: self.inner.embed_query(text),
+            tokens=estimate_tokens(text), max_retries=self.max_retries)
+
+
+def display_rate_limit_metrics():
+    """ サイドバーにモデルごとの待ち行列の長さ・待ち時間を表示する """
+    import streamlit as st
+
+    with st.sidebar.expander("レート制限"):
+        rows = rate_limit_report()
+        if rows:
+            st.dataframe(rows)
+        else:
+            st.caption("まだ記録がありません")
@@ -0,0 +1,303 @@
+"""
+OpenAI / Anthropic の2つのモデルにまたがるヘッジ・フェイルオーバー
+
+- プライマリの最初のトークンが hedge_delay 秒以内に届かなければセカンダリも起動し、
+  先に最初のトークンを返した方からストリーミングする (負けた方はすぐに接続を切って中断する)
+  最初のトークンは本文かツール呼び出しを含む最初のチャンクとし、role だけの最初のチャンクや
+  使用量だけのチャンクは勝者が決まるまでためておく
+- プライマリが 429 / 5xx / 接続エラーで失敗した場合はセカンダリに切り替える
+- 最初のトークンまでの時間をプロバイダごとのヒストグラムに記録し、
+  hedge_delay の調整に使えるようにする (負けた方は、中断した時点までの時間を下限として記録する)
+"""
+import queue
+import threading
+import time
+from typing import Any, Optional
+
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.outputs import ChatGenerationChunk
+
+from common.cancellation import CancellationHandler, GenerationCancelled, HedgeCancelled, inherit_cancellation
+
+# フェイルオーバーの対象とするHTTPステータス
+RETRYABLE_STATUS = {408, 409, 429}
+# ステータスコードを持たない接続系のエラー
+RETRYABLE_ERRORS = {"APIConnectionError", "APITimeoutError", "ConnectError", "ReadTimeout", "Timeout"}
+
+# ヒストグラムのバケット上限 (ミリ秒)
+LATENCY_BUCKETS_MS = (250, 500, 1000, 2000, 4000, 8000, 16000, float("inf"))
+
+
+class EmptyStream(Exception):
+    """ モデルのストリームがチャンクを1つも返さずに終わった """
+
+
+def is_retryable(error):
+    """ 別のプロバイダで再試行する価値のあるエラーかどうか """
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(getattr(error, "response", None), "status_code", None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+
+class LatencyHistogram:
+    """ 最初のトークンまでの時間の分布 """
+
+    def __init__(self, buckets=LATENCY_BUCKETS_MS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.errors = 0
+        self.wins = 0
+        self.cancelled = 0
+        self._lock = threading.Lock()
+
+    def observe(self, latency_ms):
+        with self._lock:
+            for i, bound in enumerate(self.buckets):
+                if latency_ms <= bound:
+                    self.counts[i] += 1
+                    return
+
+    def count(self, field):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + 1)
+
+    @property
+    def total(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        """ バケットの上限値で q 分位点を近似する (記録がなければNone) """
+        total = self.total
+        if not total:
+            return None
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= q * total:
+                return bound
+        return self.buckets[-1]
+
+
+_histograms = {}
+_histograms_lock = threading.Lock()
+
+def get_latency_histogram(name):
+    with _histograms_lock:
+        if name not in _histograms:
+            _histograms[name] = LatencyHistogram()
+        return _histograms[name]
+
+def latency_report():
+    """ プロバイダ(モデル)ごとのヒストグラムを表示用の dict のリストで返す """
+    rows = []
+    with _histograms_lock:
+        items = sorted(_histograms.items())
+    for name, histogram in items:
+        row = {"model": name, "samples": histogram.total, "wins": histogram.wins,
+               "cancelled": histogram.cancelled, "errors": histogram.errors,
+               "p50_ms": histogram.quantile(0.5), "p95_ms": histogram.quantile(0.95)}
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            row[f"<={bound:g}ms"] = count
+        rows.append(row)
+    return rows
+
+
+def has_output(chunk):
+    """ 本文かツール呼び出しを含むチャンクかどうか (role だけのチャンクや使用量だけのチャンクは含まない) """
+    return bool(chunk.content) or bool(getattr(chunk, "tool_call_chunks", None))
+
+def model_label(model):
+    """ ヒストグラムのキーにするモデル名 """
+    bound = getattr(model, "bound", model)  # bind_tools 済みの場合
+    return getattr(bound, "model_name", None) or getattr(bound, "model", None) or type(bound).__name__
+
+
+class _StreamWorker(threading.Thread):
+    """ 1つのモデルのストリームを別スレッドで読み、イベントをキューに流す """
+
+    def __init__(self, model, messages, stop, config, kwargs, events):
+        super().__init__(daemon=True)
+        self.model = model
+        self.label = model_label(model)
+        self.messages = messages
+        self.stop_sequences = stop
+        self.kwargs = kwargs
+        self.events = events
+        # 負けたときに、最初のトークンを待っている接続 (common.http_client) やレート制限の待ちもすぐに止める
+        self.cancellation = CancellationHandler(error=HedgeCancelled)
+        self.config = {**config, "callbacks": [*config.get("callbacks", []), self.cancellation]}
+        self.started_at = time.perf_counter()
+
+    def run(self):
+        stream = self.model.stream(self.messages, self.config, stop=self.stop_sequences, **self.kwargs)
+        received = False
+        try:
+            for chunk in stream:
+                received = True
+                # 中断された後は、次のチャンクを要求したときにモデルの中で中断の例外が送出される
+                # (ここで break すると、計測には中断ではなく GeneratorExit として記録されてしまう)
+                if not self.cancellation.cancelled:
+                    self.events.put(("chunk", self, chunk))
+            else:
+                self.events.put(("done", self, None))
+        except AssertionError as e:
+            # BaseChatModel.stream() はチャンクが1つもないと AssertionError で終わる
+            if received:
+                self.events.put(("error", self, e))
+            else:
+                self.events.put(("error", self, EmptyStream(f"{self.label} returned an empty stream")))
+        except Exception as e:
+            self.events.put(("error", self, e))
+        finally:
+            # 中断された場合もここで接続を閉じる
+            stream.close()
+
+    def cancel(self):
+        self.cancellation.cancel()
+
+
+class HedgedChatModel(BaseChatModel):
+    """ プライマリとセカンダリのうち、先に応答した方の結果を返すチャットモデル """
+
+    primary: Any
+    secondary: Any
+    # プライマリの最初のトークンをこの秒数待ってもこなければセカンダリも起動する (Noneならヘッジしない)
+    hedge_delay: Optional[float] = 2.0
+    # 429 / 5xx などのエラー時にセカンダリへ切り替えるかどうか
+    failover: bool = True
+
+    @property
+    def _llm_type(self):
+        return "hedged-chat"
+
+    def bind_tools(self, tools, **kwargs):
+        return self.__class__(
+            primary=self.primary.bind_tools(tools, **kwargs),
+            secondary=self.secondary.bind_tools(tools, **kwargs),
+            hedge_delay=self.hedge_delay,
+            failover=self.failover,
+            callbacks=self.callbacks,
+        )
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        # invoke の場合もストリームで受け取ってまとめることで、ヘッジを効かせる
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        events = queue.Queue()
+        # 外側のコールバックには勝者のトークンだけを流すため、内側の呼び出しには中断のコールバックだけを引き継ぐ
+        # (計測用のコールバックは各モデルに直接付いている)。呼び出し元の CancellationHandler も渡すので、
+        # ユーザーが止めた場合はワーカーのモデルでも GenerationCancelled になり、ヘッジの負けとは区別して記録される
+        config = inherit_cancellation(run_manager)
+        models = [self.primary, self.secondary]
+        workers = []
+
+        def start_next():
+            worker = _StreamWorker(models[len(workers)], messages, stop, config, kwargs, events)
+            workers.append(worker)
+            worker.start()
+
+        start_next()
+        winner, finished = None, False
+        # 勝者が決まるまでに届いた、モデルごとのチャンク
+        buffered = {}
+        failed = set()
+        try:
+            # 本文かツール呼び出しのチャンク (または本文のない応答の正常終了) が最初に届いたモデルを勝者とする
+            while winner is None:
+                timeout = None
+                if len(workers) < len(models) and self.hedge_delay is not None:
+                    timeout = max(0.0, workers[0].started_at + self.hedge_delay - time.perf_counter())
+                try:
+                    kind, worker, payload = events.get(timeout=timeout)
+                except queue.Empty:
+                    start_next()
+                    continue
+                if worker in failed:
+                    continue
+                if kind == "error" and isinstance(payload, GenerationCancelled):
+                    # 呼び出し元から中断された (プロバイダのエラーではない)
+                    raise payload
+                if kind == "done" and not buffered.get(worker):
+                    # チャンクを1つも返さなかったモデルは勝者にせず、失敗として扱う
+                    kind, payload = "error", EmptyStream(f"{worker.label} returned an empty stream")
+                if kind == "error":
+                    failed.add(worker)
+                    get_latency_histogram(worker.label).count("errors")
+                    retryable = is_retryable(payload) or isinstance(payload, EmptyStream)
+                    if self.failover and retryable and len(workers) < len(models):
+                        start_next()
+                        continue
+                    if len(failed) == len(workers):
+                        raise payload
+                    continue
+                if kind == "done":
+                    # 本文のない応答で正常に終わった
+                    winner, finished = worker, True
+                    continue
+                buffered.setdefault(worker, []).append(payload)
+                if has_output(payload):
+                    winner = worker
+
+            now = time.perf_counter()
+            histogram = get_latency_histogram(winner.label)
+            histogram.observe((now - winner.started_at) * 1000)
+            histogram.count("wins")
+            for worker in workers:
+                if worker is winner or worker in failed:
+                    continue
+                worker.cancel()
+                loser = get_latency_histogram(worker.label)
+                # 負けた側の最初のトークンまでの時間は分からないが、少なくともここまでかかっている
+                # (記録しないと、遅かった呼び出しが分布から抜けて hedge_delay を短く見積もってしまう)
+                loser.observe((now - worker.started_at) * 1000)
+                loser.count("cancelled")
+
+            for chunk in buffered[winner]:
+                yield self._generation(chunk, run_manager)
+            while not finished:
+                kind, worker, payload = self._next_event(events, winner)
+                if kind == "error":
+                    raise payload
+                if kind == "done":
+                    break
+                yield self._generation(payload, run_manager)
+        finally:
+            for worker in workers:
+                worker.cancel()
+
+    @staticmethod
+    def _generation(chunk, run_manager):
+        generation = ChatGenerationChunk(message=chunk)
+        if run_manager:
+            run_manager.on_llm_new_token(generation.text, chunk=generation)
+        return generation
+
+    @staticmethod
+    def _next_event(events, winner):
+        while True:
+            kind, worker, payload = events.get()
+            if worker is winner:
+                return kind, worker, payload
+
+
+def select_fallback(model_name, models):
+    """ サイドバーでヘッジ・フェイルオーバーの設定を選ばせ、(セカンダリのモデル名, hedge_delay) を返す """
+    import streamlit as st
+
+    if not st.sidebar.checkbox("別プロバイダへのヘッジ/フェイルオーバー", value=False):
+        return None, None
+    candidates = [m for m in models if m != model_name]
+    fallback_model = st.sidebar.selectbox("セカンダリのモデル", candidates)
+    hedge_delay = st.sidebar.slider(
+        "ヘッジまでの待ち時間(秒)", min_value=0.5, max_value=10.0, value=2.0, step=0.5)
+    with st.sidebar.expander("最初のトークンまでの時間"):
+        rows = latency_report()
+        if rows:
+            st.dataframe(rows)
+        else:
+            st.caption("まだ記録がありません")
+    return fallback_model, hedge_delay
@@ -0,0 +1,8 @@
+def get_session_id():
+    """ 現在の Streamlit セッションのIDを返す (Streamlit外から呼ばれた場合はNone) """
+    try:
+        from streamlit.runtime.scriptrunner import get_script_run_ctx
+    except ImportError:
+        return None
+    ctx = get_script_run_ctx()
+    return ctx.session_id if ctx else None
@@ -0,0 +1,301 @@
+"""
+セッションごとのメモリ予算と、重いオブジェクトのディスクへの退避 (spill)
+
+FAISS のインデックスや会話履歴を st.session_state に入れたままにすると、
+操作していないセッションの分もセッションが切れるまでメモリに残り続ける。
+ここでは各セッションの重いオブジェクトのおおよそのサイズを記録しておき、
+全体の予算を超えたら、しばらく操作されていないセッションのものから中身をディスクに退避する。
+退避したオブジェクトは、そのセッションの次の操作(スクリプトの再実行)の最初に読み戻す。
+
+退避はオブジェクトの中身だけを入れ替える形で行うので、アプリ側は st.session_state を
+今までどおりに使えばよい。スクリプト全体を track_session_memory で囲むだけでよい:
+
+    if __name__ == "__main__":
+        with track_session_memory(["vectorstore"]):
+            main()
+"""
+import os
+import pickle
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+from common.paths import data_path
+from common.session import get_session_id
+
+# 全セッション合計でメモリに置いておく重いオブジェクトの上限
+BUDGET_BYTES = int(float(os.environ.get("SESSION_MEMORY_BUDGET_MB", "512")) * 1024 * 1024)
+# この秒数以上操作されていないセッションだけを退避の対象にする
+MIN_IDLE_SEC = float(os.environ.get("SESSION_SPILL_MIN_IDLE_SEC", "30"))
+
+
+def _is_vectorstore(obj):
+    return all(hasattr(obj, name) for name in ("index", "docstore", "index_to_docstore_id"))
+
+def _is_chat_memory(obj):
+    return hasattr(getattr(obj, "chat_memory", None), "messages")
+
+
+def estimate_size(obj):
+    """ 重いオブジェクトのおおよそのメモリ使用量 (バイト) """
+    if _is_vectorstore(obj):
+        index = obj.index
+        if index is None:
+            return 0
+        code_size = getattr(index, "code_size", index.d * 4)
+        size = code_size * index.ntotal
+        for id_ in obj.index_to_docstore_id.values():
+            doc = obj.docstore.search(id_)
+            size += len(getattr(doc, "page_content", "")) * 2 + 200
+        return size
+    if _is_chat_memory(obj):
+        return sum(_text_size(m.content) + 200 for m in obj.chat_memory.messages)
+    if isinstance(obj, list):
+        return sys.getsizeof(obj) + sum(_text_size(item) for item in obj)
+    try:
+        return len(pickle.dumps(obj))
+    except Exception:
+        return sys.getsizeof(obj)
+
+def _text_size(value):
+    if isinstance(value, str):
+        return sys.getsizeof(value)
+    if isinstance(value, (tuple, list)):
+        return sys.getsizeof(value) + sum(_text_size(v) for v in value)
+    return sys.getsizeof(value)
+
+
+def spill(obj, path):
+    """ オブジェクトの中身をファイルに書き出し、メモリ上からは取り除く """
+    if _is_vectorstore(obj):
+        import faiss
+        state = {
+            "index": faiss.serialize_index(obj.index),
+            "docstore": obj.docstore,
+            "index_to_docstore_id": obj.index_to_docstore_id,
+        }
+        with open(path, "wb") as f:
+            pickle.dump(state, f)
+        obj.index = None
+        obj.docstore = None
+        obj.index_to_docstore_id = None
+    elif _is_chat_memory(obj):
+        with open(path, "wb") as f:
+            pickle.dump(list(obj.chat_memory.messages), f)
+        obj.chat_memory.messages = []
+    elif isinstance(obj, list):
+        with open(path, "wb") as f:
+            pickle.dump(list(obj), f)
+        del obj[:]
+    else:
+        raise TypeError(f"Cannot spill {type(obj).__name__}")
+
+def restore(obj, path):
+    """ spill したオブジェクトの中身をファイルから読み戻す """
+    with open(path, "rb") as f:
+        state = pickle.load(f)
+    if _is_vectorstore(obj):
+        import faiss
+        obj.index = faiss.deserialize_index(state["index"])
+        obj.docstore = state["docstore"]
+        obj.index_to_docstore_id = state["index_to_docstore_id"]
+    elif _is_chat_memory(obj):
+        obj.chat_memory.messages = state
+    else:
+        obj[:] = state
+    os.remove(path)
+
+def _is_spillable(obj):
+    return _is_vectorstore(obj) or _is_chat_memory(obj) or isinstance(obj, list)
+
+def _is_session_alive(session_id):
+    from streamlit.runtime import Runtime
+    return not Runtime.exists() or Runtime.instance().is_active_session(session_id)
+
+
+class _Entry:
+    """ 1つのセッションの1つのキーに入っている重いオブジェクト """
+
+    def __init__(self, obj):
+        self.obj = obj
+        self.size = estimate_size(obj)
+        self.spilled_path = None
+
+    def discard(self):
+        if self.spilled_path is not None:
+            try:
+                os.remove(self.spilled_path)
+            except FileNotFoundError:
+                pass
+            self.spilled_path = None
+
+
+class SessionMemoryManager:
+
+    def __init__(self, budget_bytes=BUDGET_BYTES, min_idle_sec=MIN_IDLE_SEC):
+        self.budget_bytes = budget_bytes
+        self.min_idle_sec = min_idle_sec
+        self._lock = threading.RLock()
+        # session_id -> {"last_seen": float, "active": bool, "entries": {key: _Entry}}
+        self._sessions = {}
+        self.spill_count = 0
+        self.restore_count = 0
+
+    def begin(self, session_id):
+        """ スクリプトの実行開始時: 退避されていたオブジェクトを読み戻す """
+        with self._lock:
+            session = self._sessions.setdefault(
+                session_id, {"last_seen": time.time(), "active": False, "entries": {}})
+            session["active"] = True
+            session["last_seen"] = time.time()
+            for entry in session["entries"].values():
+                if entry.spilled_path is not None:
+                    restore(entry.obj, entry.spilled_path)
+                    entry.spilled_path = None
+                    entry.size = estimate_size(entry.obj)
+                    self.restore_count += 1
+
+    def end(self, session_id, state, keys):
+        """ スクリプトの実行終了時: サイズを測り直し、予算を超えていれば他のセッションを退避する """
+        with self._lock:
+            session = self._sessions.get(session_id)
+            if session is None:
+                return
+            for key in keys:
+                obj = state.get(key)
+                if obj is None:
+                    self._drop(session, key)
+                    continue
+                if not _is_spillable(obj):
+                    continue
+                entry = session["entries"].get(key)
+                if entry is None or entry.obj is not obj:
+                    self._drop(session, key)
+                    session["entries"][key] = _Entry(obj)
+                else:
+                    entry.size = estimate_size(obj)
+            session["active"] = False
+            session["last_seen"] = time.time()
+            self.prune()
+            self.enforce_budget(exclude=session_id)
+
+    def prune(self):
+        """ 終了したセッションの記録と退避ファイルを消す (オブジェクトへの参照もここで手放す) """
+        with self._lock:
+            for session_id in list(self._sessions):
+                session = self._sessions[session_id]
+                if not session["active"] and not _is_session_alive(session_id):
+                    for key in list(session["entries"]):
+                        self._drop(session, key)
+                    del self._sessions[session_id]
+
+    def _drop(self, session, key):
+        entry = session["entries"].pop(key, None)
+        if entry is not None:
+            entry.discard()
+
+    def in_memory_bytes(self):
+        with self._lock:
+            return sum(
+                entry.size
+                for session in self._sessions.values()
+                for entry in session["entries"].values()
+                if entry.spilled_path is None
+            )
+
+    def enforce_budget(self, exclude=None):
+        """ 予算を超えている間、長く操作されていないセッションから順に退避する """
+        with self._lock:
+            total = self.in_memory_bytes()
+            if total <= self.budget_bytes:
+                return
+            now = time.time()
+            candidates = sorted(
+                (
+                    (session["last_seen"], session_id, session)
+                    for session_id, session in self._sessions.items()
+                    if session_id != exclude
+                    and not session["active"]
+                    and now - session["last_seen"] >= self.min_idle_sec
+                ),
+                key=lambda item: item[0],
+            )
+            for _, session_id, session in candidates:
+                for key, entry in session["entries"].items():
+                    if entry.spilled_path is not None:
+                        continue
+                    path = data_path("spill", session_id, f"{key}-{uuid.uuid4().hex}.pkl")
+                    spill(entry.obj, path)
+                    entry.spilled_path = path
+                    total -= entry.size
+                    self.spill_count += 1
+                if total <= self.budget_bytes:
+                    return
+
+    def report(self):
+        """ セッションごとのメモリ使用量 (表示用の dict のリスト) """
+        now = time.time()
+        rows = []
+        with self._lock:
+            for session_id, session in self._sessions.items():
+                in_memory = spilled = 0
+                for entry in session["entries"].values():
+                    if entry.spilled_path is None:
+                        in_memory += entry.size
+                    else:
+                        spilled += entry.size
+                rows.append({
+                    "session": session_id[:8],
+                    "keys": ", ".join(session["entries"]),
+                    "in_memory_kb": round(in_memory / 1024, 1),
+                    "spilled_kb": round(spilled / 1024, 1),
+                    "idle_sec": round(now - session["last_seen"]),
+                    "active": session["active"],
+                })
+        return sorted(rows, key=lambda row: -row["in_memory_kb"])
+
+
+_manager = None
+_manager_lock = threading.Lock()
+
+def get_session_memory_manager():
+    """ プロセス内で共有する SessionMemoryManager を返す """
+    global _manager
+    with _manager_lock:
+        if _manager is None:
+            _manager = SessionMemoryManager()
+        return _manager
+
+
+@contextmanager
+def track_session_memory(keys):
+    """ スクリプトの実行中、st.session_state の keys を管理の対象にする """
+    import streamlit as st
+
+    session_id = get_session_id()
+    if session_id is None:
+        yield
+        return
+    manager = get_session_memory_manager()
+    manager.begin(session_id)
+    try:
+        yield
+    finally:
+        manager.end(session_id, st.session_state, keys)
+
+
+def display_memory_metrics():
+    """ サイドバーにセッションごとのメモリ使用量を表示する """
+    import streamlit as st
+
+    manager = get_session_memory_manager()
+    with st.sidebar.expander("メモリ使用量"):
+        st.write(
+            f"{manager.in_memory_bytes() / 1024 / 1024:.1f} MB / "
+            f"予算 {manager.budget_bytes / 1024 / 1024:.0f} MB "
+            f"(退避 {manager.spill_count} 回 / 読み戻し {manager.restore_count} 回)")
+        rows = manager.report()
+        if rows:
+            st.dataframe(rows)
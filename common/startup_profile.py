@@ -0,0 +1,121 @@
+"""
+各アプリの起動時(モジュールの読み込み時)の import 時間を計測する
+
+アプリのスクリプトを `python -X importtime` の別プロセスで読み込み (main() は実行しない)、
+トップレベルの import ごとの時間を集計する。プロセスを毎回作り直すので、
+デプロイ直後のコールドスタートと同じ条件になる。
+
+    python -m common.startup_profile                       # 全アプリの合計
+    python -m common.startup_profile chapter_007/pages/1_Upload_PDF.py --top 15
+    python -m common.startup_profile --save .data/startup.json
+    python -m common.startup_profile --baseline .data/startup.json --tolerance 0.2
+
+--baseline を指定すると、保存しておいた結果より tolerance 以上遅くなったアプリがあれば
+終了コード 1 で終わる (CI などで起動時間の悪化を検出する用)
+"""
+import argparse
+import json
+import re
+import subprocess
+import sys
+
+from common.paths import REPO_ROOT
+
+# Streamlit アプリ (chapter_008/sample は読み込むだけで API を呼ぶスクリプトなので対象外)
+APP_PATTERNS = ("chapter_*/main.py", "chapter_*/pages/*.py")
+# 何回計測して最小値を取るか (ディスクキャッシュなどのばらつきを抑える)
+DEFAULT_REPEAT = 3
+
+# `import time: self [us] | cumulative | imported package`
+IMPORTTIME_LINE = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( *)(\S+)")
+
+# アプリのスクリプトを main() を呼ばずに読み込む
+# (各アプリは if __name__ == "__main__": main() になっている)
+LOADER = """
+import runpy, sys
+sys.path.insert(0, sys.argv[1])
+runpy.run_path(sys.argv[2], run_name="__startup_profile__")
+"""
+
+
+def find_apps():
+    apps = []
+    for pattern in APP_PATTERNS:
+        apps.extend(sorted(REPO_ROOT.glob(pattern)))
+    return [app.relative_to(REPO_ROOT).as_posix() for app in apps]
+
+
+def profile_app(app):
+    """ 1つのアプリを読み込んで、トップレベルの import ごとの累積時間(ミリ秒)を返す """
+    path = REPO_ROOT / app
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", LOADER, str(path.parent), str(path)],
+        cwd=path.parent, capture_output=True, text=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        # インデントのないものがトップレベル(アプリやその依存から直接読まれた)の import
+        if match and match.group(3) == " ":
+            modules[match.group(4)] = int(match.group(2)) / 1000
+    if result.returncode != 0:
+        raise RuntimeError(f"{app} failed to import:\n{result.stderr[-2000:]}")
+    return modules
+
+
+def profile(apps, repeat=DEFAULT_REPEAT):
+    """ アプリごとに {"total_ms", "modules": {module: ms}} を返す (repeat 回の最小値) """
+    results = {}
+    for app in apps:
+        best = None
+        for _ in range(repeat):
+            modules = profile_app(app)
+            if best is None or sum(modules.values()) < sum(best.values()):
+                best = modules
+        results[app] = {"total_ms": round(sum(best.values()), 1), "modules": best}
+    return results
+
+
+def compare(results, baseline, tolerance):
+    """ baseline より tolerance (割合) 以上遅くなったアプリの (app, before, after) のリスト """
+    regressions = []
+    for app, result in results.items():
+        before = baseline.get(app, {}).get("total_ms")
+        if before and result["total_ms"] > before * (1 + tolerance):
+            regressions.append((app, before, result["total_ms"]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Streamlit アプリの起動時の import 時間を計測する")
+    parser.add_argument("apps", nargs="*", help="計測するアプリ (省略時は全アプリ)")
+    parser.add_argument("--top", type=int, default=0, help="アプリごとに時間のかかった import を上位N件表示する")
+    parser.add_argument("--repeat", type=int, default=DEFAULT_REPEAT)
+    parser.add_argument("--save", help="結果を JSON で保存する")
+    parser.add_argument("--baseline", help="比較対象の JSON (--save で保存したもの)")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="許容する悪化の割合")
+    args = parser.parse_args(argv)
+
+    results = profile(args.apps or find_apps(), repeat=args.repeat)
+    for app, result in results.items():
+        print(f"{result['total_ms']:9.1f} ms  {app}")
+        top = sorted(result["modules"].items(), key=lambda item: -item[1])[:args.top]
+        for module, ms in top:
+            print(f"{ms:21.1f} ms  {module}")
+
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2, ensure_ascii=False)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        for app, before, after in regressions:
+            print(f"REGRESSION {app}: {before:.1f} ms -> {after:.1f} ms")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
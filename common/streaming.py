@@ -0,0 +1,305 @@
+"""
+st.write_stream の代わりに使うストリーミング描画
+
+st.write_stream はトークンが届くたびに要素全体を再描画するため、長い回答では
+同じ markdown を何百回も送り直すことになる。ここでは
+
+- トークンを一定時間/一定文字数ごとにまとめて1フレームとして描画する
+  (ストリームは別スレッドで読むので、次のチャンクが届かなくても時間が来れば描画する)
+- 書き終わった段落は確定させて、以降は末尾の段落だけを更新する
+- 末尾が非常に長くなった場合はストリーミング中だけプレーンテキストで表示する
+
+ことで、体感の速さを変えずに再描画の量を減らしている。
+段落をまたいで効く書き方 (参照形式のリンクや脚注の定義) があれば、最後に全文を1つの要素で描画し直す。
+
+また、ストリーミング中にユーザーが次の入力を送ったりタブを閉じたりした場合は、
+チャンクを待っている間も一定間隔で Streamlit の再実行・停止の要求を確認して中断し、上流の生成も止める。
+(st.write_stream では描画が終わるまで古い生成がトークンと接続を使い続ける)
+cancellable_stream(chain, input) を渡すと、次のトークンを待たずにプロバイダへの接続を切り、
+チェーンの中のモデルの生成まで止められる。止めた呼び出しは common.metering に打ち切りとして記録される。
+(そのまま渡したストリームは、次のチャンクが届いた時点で閉じる)
+"""
+import logging
+import queue
+import re
+import threading
+import time
+
+import streamlit as st
+from streamlit.runtime.scriptrunner import get_script_run_ctx
+from streamlit.runtime.scriptrunner.script_requests import ScriptRequestType
+from streamlit.runtime.scriptrunner.script_runner import RerunException, StopException
+
+from common.cancellation import POLL_INTERVAL, CancellationHandler, GenerationCancelled
+
+logger = logging.getLogger(__name__)
+
+# フレームを送る最短間隔(秒)
+FRAME_INTERVAL = 0.05
+# この文字数がたまったら時間を待たずにフレームを送る
+FRAME_CHARS = 400
+# 未確定部分がこれより長い場合、ストリーミング中は markdown ではなくテキストで表示する
+PLAIN_TEXT_THRESHOLD = 20000
+
+# コードブロックのフェンス (``` または ~~~ を3文字以上)
+FENCE_PATTERN = re.compile(r"^ {0,3}(`{3,}|~{3,})")
+# リストの項目の先頭
+LIST_ITEM_PATTERN = re.compile(r"^ {0,3}([-*+]|\d{1,9}[.)])(\s|$)")
+# 参照形式のリンク・脚注の定義 (文書の後ろの方にあっても、前の段落の描画が変わる)
+REFERENCE_PATTERN = re.compile(r"^ {0,3}\[[^\]]+\]:", re.MULTILINE)
+
+
+def chunk_to_text(chunk):
+    """ str / AIMessageChunk などのチャンクから文字列を取り出す """
+    if isinstance(chunk, str):
+        return chunk
+    content = getattr(chunk, "content", chunk)
+    if isinstance(content, str):
+        return content
+    if isinstance(content, list):
+        # Anthropic はコンテンツブロックのリストで返すことがある
+        return "".join(
+            block if isinstance(block, str) else block.get("text", "")
+            for block in content
+        )
+    return str(content)
+
+
+def _is_closing_fence(line, fence):
+    """ 開いたフェンスと同じ文字で、同じ長さ以上のフェンスだけの行なら閉じるフェンス """
+    stripped = line.strip()
+    return len(stripped) >= len(fence) and set(stripped) == {fence[0]}
+
+def _starts_new_block(line):
+    """ 空行の次の行が、前のブロック (リストの項目など) の続きではなく新しいブロックを始めるかどうか """
+    return (
+        line.endswith("\n")    # 書き終わっていない行は、まだ何になるか分からない
+        and line.strip()
+        and not line[0].isspace()
+        and not LIST_ITEM_PATTERN.match(line)
+    )
+
+def find_block_boundary(text):
+    """
+    text のうち確定できる(これ以上変わらない)部分の長さを返す
+
+    コードブロックの外にある空行のうち、次の行が新しいブロックを始めるもの (リストの項目や
+    インデントされた続きの行ではないもの) の最後までを確定部分とみなす
+    """
+    boundary = 0
+    fence = None
+    position = 0
+    lines = text.splitlines(keepends=True)
+    for i, line in enumerate(lines):
+        position += len(line)
+        if fence is not None:
+            if _is_closing_fence(line, fence):
+                fence = None
+            continue
+        match = FENCE_PATTERN.match(line)
+        if match:
+            fence = match.group(1)
+        elif not line.strip() and i + 1 < len(lines) and _starts_new_block(lines[i + 1]):
+            boundary = position
+    return boundary
+
+
+class FrameRenderer:
+    """ 確定済みの段落と、更新中の末尾段落に分けて描画する """
+
+    def __init__(self, plain_text_threshold=PLAIN_TEXT_THRESHOLD):
+        self.plain_text_threshold = plain_text_threshold
+        self.frozen = 0
+        self.blocks = [st.empty()]
+        self.frames = 0
+
+    @property
+    def tail(self):
+        return self.blocks[-1]
+
+    def render(self, text, final=False):
+        pending = text[self.frozen:]
+        self.frames += 1
+        if final:
+            if len(self.blocks) > 1 and REFERENCE_PATTERN.search(text):
+                # 分けて描画すると参照が解決されないので、全文を最初の要素に描画し直す
+                self.blocks[0].markdown(text)
+                for block in self.blocks[1:]:
+                    block.empty()
+            elif pending:
+                # 最後は未確定部分も markdown として描画する
+                self.tail.markdown(pending)
+            return
+        boundary = find_block_boundary(pending)
+        if boundary:
+            # 確定した段落は一度だけ描画し、以降は触らない
+            self.tail.markdown(pending[:boundary])
+            self.frozen += boundary
+            pending = pending[boundary:]
+            self.blocks.append(st.empty())
+        if pending:
+            if len(pending) > self.plain_text_threshold:
+                self.tail.text(pending)
+            else:
+                self.tail.markdown(pending)
+
+
+class CancellableStream:
+    """
+    cancel() / close() したときに、チェーンの中のモデルの生成も中断するストリーム
+
+    cancel() は別のスレッドからも呼べて、受信中の接続をすぐに切る (次のトークンを待たない)。
+    write_stream が途中で抜けると、cancel() してからストリームを読んでいるスレッドで close() する
+    """
+
+    def __init__(self, runnable, input, config=None):
+        self.cancellation = CancellationHandler()
+        config = dict(config or {})
+        config["callbacks"] = [*(config.get("callbacks") or []), self.cancellation]
+        self._stream = runnable.stream(input, config)
+
+    def __iter__(self):
+        return self._stream
+
+    def cancel(self):
+        self.cancellation.cancel()
+
+    def close(self):
+        self.cancel()
+        try:
+            # 接続は切れているので、次のチャンクを要求するとすぐにモデルの中で GenerationCancelled が送出され、
+            # チェーンの各段を通って戻ってくる
+            # (close() で閉じると、チェーンが前段の出力を最後まで読み切ってしまう)
+            for _ in self._stream:
+                pass
+        except GenerationCancelled:
+            pass
+
+def cancellable_stream(runnable, input, config=None):
+    """ runnable.stream(input) の代わりに使う (write_stream から中断できるようになる) """
+    return CancellableStream(runnable, input, config)
+
+
+def raise_if_interrupted():
+    """
+    再実行・停止の要求が来ていれば RerunException / StopException を送出する
+
+    Streamlit は st.* の呼び出しのたびにこの確認をするが、フレームの間は st.* を呼ばないので、
+    チャンクを待つ間も一定間隔で同じ確認をして、すぐに中断できるようにする
+    """
+    ctx = get_script_run_ctx()
+    if ctx is None or ctx.script_requests is None:
+        return
+    request = ctx.script_requests.on_scriptrunner_yield()
+    if request is None:
+        return
+    if request.type == ScriptRequestType.RERUN:
+        raise RerunException(request.rerun_data)
+    raise StopException()
+
+
+class _StreamReader:
+    """
+    ストリームを別スレッドで読み、チャンクをキューに入れる
+
+    スクリプトのスレッドはチャンクを待つ間も一定時間ごとに起きて、たまったチャンクを描画できる。
+    ストリームはこのスレッドの中でしか進められないので、途中でやめる場合も stop() で頼んで、
+    このスレッドに閉じてもらう (cancel() できるストリームは、stop() の時点で上流を止める)
+    """
+
+    _END = object()
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.queue = queue.Queue()
+        self._stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="write_stream", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        try:
+            for chunk in self.stream:
+                if self._stopped.is_set():
+                    break
+                self.queue.put(chunk)
+        except BaseException as e:
+            self.queue.put(e)
+        finally:
+            self._close()
+            self.queue.put(self._END)
+
+    def _close(self):
+        close = getattr(self.stream, "close", None)
+        if close is None:
+            return
+        try:
+            close()
+        except Exception as e:
+            if not self._stopped.is_set():
+                self.queue.put(e)
+                return
+            # 途中でやめた場合は、呼び出し元で送出している例外 (RerunException など) を優先する
+            logger.warning("Failed to close an interrupted stream", exc_info=True)
+
+    def get(self, timeout):
+        """ 次のチャンクを返す (timeout 秒以内に届かなければ queue.Empty、終わりなら None) """
+        item = self.queue.get(timeout=timeout)
+        if item is self._END:
+            return None
+        if isinstance(item, BaseException):
+            raise item
+        return item
+
+    def stop(self):
+        self._stopped.set()
+        cancel = getattr(self.stream, "cancel", None)
+        if cancel is None:
+            return
+        try:
+            cancel()
+        except Exception:
+            logger.warning("Failed to cancel a stream", exc_info=True)
+
+
+def write_stream(stream, frame_interval=FRAME_INTERVAL, frame_chars=FRAME_CHARS,
+                 plain_text_threshold=PLAIN_TEXT_THRESHOLD):
+    """
+    ストリームをフレーム単位で描画し、全文を返す (st.write_stream と同じ使い方)
+
+    再実行・停止で中断された場合も、ストリームを閉じてから例外をそのまま送出する
+    """
+    renderer = FrameRenderer(plain_text_threshold=plain_text_threshold)
+    reader = _StreamReader(stream)
+    text = ""
+    unflushed = 0
+    last_flush = None
+    try:
+        while True:
+            # チャンクを待つ間も再実行・停止の要求を確認し、描画していないチャンクがあれば次のフレームの時刻に起きる
+            timeout = POLL_INTERVAL
+            if unflushed:
+                timeout = min(timeout, max(0.0, last_flush + frame_interval - time.perf_counter()))
+            try:
+                chunk = reader.get(timeout)
+            except queue.Empty:
+                chunk = ""
+            else:
+                if chunk is None:
+                    break
+            raise_if_interrupted()
+            piece = chunk_to_text(chunk)
+            text += piece
+            unflushed += len(piece)
+            if not unflushed:
+                continue
+            now = time.perf_counter()
+            # 最初のトークンはすぐに表示して、体感の待ち時間を変えないようにする
+            if last_flush is None or now - last_flush >= frame_interval or unflushed >= frame_chars:
+                renderer.render(text)
+                last_flush = now
+                unflushed = 0
+    finally:
+        # 途中で抜けた場合は、上流の生成 (プロバイダへの接続やワーカースレッド) を止める
+        reader.stop()
+    renderer.render(text, final=True)
+    return text
@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# 計測結果やキャッシュをリポジトリの .data に書き込まないよう、common を読み込む前に置き場所を変える
+os.environ["LLM_APP_DATA_DIR"] = tempfile.mkdtemp(prefix="llm-app-test-")
+
+REPO_ROOT = Path(__file__).resolve().parents[1]
+# リポジトリ直下の common パッケージと、chapter_007 直下のモジュールを読み込めるようにする
+sys.path.insert(0, str(REPO_ROOT))
+sys.path.append(str(REPO_ROOT / "chapter_007"))
@@ -0,0 +1,66 @@
+"""
+テスト用のチャットモデルとエラー
+
+API を呼ばずに、決まったチャンクを決まった間隔で返す。待っている間は cancellation.sleep で
+待つので、common.http_client の接続を切った場合と同じように cancel() ですぐに中断される。
+"""
+import itertools
+from types import SimpleNamespace
+from typing import Any, List
+
+from langchain_core.language_models.chat_models import BaseChatModel, generate_from_stream
+from langchain_core.messages import AIMessageChunk
+from langchain_core.outputs import ChatGenerationChunk
+
+from common import cancellation
+from common.cancellation import cancellation_handlers
+
+_names = itertools.count()
+
+
+def unique_name(prefix="stub"):
+    """ レート制限やヒストグラムがテストの間で混ざらないよう、モデルごとに別の名前を付ける """
+    return f"{prefix}-{next(_names)}"
+
+
+class StubChatModel(BaseChatModel):
+    """ chunks を順に返すチャットモデル (文字列はそのまま AIMessageChunk の content にする) """
+
+    chunks: List[Any] = ["Hello", " world"]
+    # 最初のチャンクまでの秒数と、チャンクの間隔 (秒)
+    first_delay: float = 0.0
+    delay: float = 0.0
+    # 最初のチャンクの前に送出する例外 (呼び出すたびに先頭から1つずつ使う)
+    errors: List[Any] = []
+    model_name: str = "stub"
+    calls: int = 0
+
+    @property
+    def _llm_type(self):
+        return "stub-chat"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs):
+        return generate_from_stream(self._stream(messages, stop=stop, run_manager=run_manager, **kwargs))
+
+    def _stream(self, messages, stop=None, run_manager=None, **kwargs):
+        self.calls += 1
+        handlers = cancellation_handlers(run_manager)
+        cancellation.sleep(self.first_delay, handlers)
+        if self.errors:
+            raise self.errors.pop(0)
+        for i, chunk in enumerate(self.chunks):
+            if i:
+                cancellation.sleep(self.delay, handlers)
+            message = chunk if isinstance(chunk, AIMessageChunk) else AIMessageChunk(content=chunk)
+            yield ChatGenerationChunk(message=message)
+
+
+class RateLimitError(Exception):
+    """ プロバイダの 429 と同じ属性を持つエラー """
+
+    status_code = 429
+
+    def __init__(self, retry_after=None):
+        super().__init__("rate limited")
+        headers = {"retry-after": str(retry_after)} if retry_after is not None else {}
+        self.response = SimpleNamespace(status_code=429, headers=headers)
@@ -0,0 +1,34 @@
+from common.bm25 import BM25, InvertedIndex, tokenize
+
+
+def test_tokenize_splits_cjk_into_bigrams():
+    assert tokenize("東京都") == ["東京", "京都"]
+    assert tokenize("猫") == ["猫"]
+
+def test_tokenize_mixed_text():
+    # 全角英数字は NFKC で半角・小文字にそろえる
+    assert tokenize("ＡＰＩのエラーE-1234") == ["api", "のエ", "エラ", "ラー", "e", "1234"]
+
+def test_bm25_ranks_cjk_documents():
+    bm25 = BM25(["東京都の天気", "大阪府の天気", "京都の観光"])
+    ranked = bm25.rank("東京の天気")
+    assert ranked[0][0] == 0
+
+def test_inverted_index_add_remove_search():
+    index = InvertedIndex()
+    index.add(["a", "b", "c"], ["エラーコード E-1234 の対処", "型番 XZ-900 の仕様", "エラーの一覧"])
+    assert [id_ for id_, _ in index.search("E-1234")] == ["a"]
+    assert {id_ for id_, _ in index.search("エラー")} == {"a", "c"}
+
+    index.remove(["a"])
+    assert len(index) == 2
+    assert index.search("1234") == []
+    assert [id_ for id_, _ in index.search("エラー", filter=lambda id_: id_ != "b")] == ["c"]
+
+def test_inverted_index_matches_bm25_scores():
+    texts = ["東京都の天気", "大阪府の天気は晴れ", "京都の観光"]
+    index = InvertedIndex()
+    index.add(["0", "1", "2"], texts)
+    expected = BM25(texts).scores("京都の天気")
+    for id_, score in index.search("京都の天気"):
+        assert abs(score - expected[int(id_)]) < 1e-9
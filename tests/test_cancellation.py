@@ -0,0 +1,78 @@
+import json
+import threading
+import time
+
+from langchain_core.messages import AIMessageChunk, HumanMessage, message_to_dict
+
+from common.cancellation import GenerationCancelled
+from common.cassette import Cassette, CassetteChatModel
+from common.rate_limit import RateLimitedChatModel, get_rate_limiter
+from common.streaming import CancellableStream
+from stubs import RateLimitError, StubChatModel, unique_name
+
+# cancel() してから呼び出しが戻るまでの上限 (秒)
+PROMPT = 1.0
+
+
+def consume_in_thread(stream):
+    """ stream を別スレッドで最後まで読む (結果か例外を dict に入れる) """
+    result = {}
+
+    def consume():
+        try:
+            result["chunks"] = [chunk.content for chunk in stream]
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    return thread, result
+
+def cancel_and_wait(stream, thread):
+    started = time.monotonic()
+    stream.cancel()
+    thread.join(timeout=5)
+    assert not thread.is_alive()
+    return time.monotonic() - started
+
+
+def test_cancel_interrupts_rate_limiter_wait():
+    name = unique_name()
+    limiter = get_rate_limiter("test", name)
+    # Retry-After を受けた直後と同じく、しばらく誰も通れない状態にする
+    limiter._blocked_until = time.monotonic() + 30
+    stream = CancellableStream(RateLimitedChatModel(inner=StubChatModel(), model_name=name, provider="test"), "hi")
+    thread, result = consume_in_thread(stream)
+    time.sleep(0.3)
+    assert limiter.queue_depth == 1
+
+    assert cancel_and_wait(stream, thread) < PROMPT
+    assert isinstance(result["error"], GenerationCancelled)
+    assert limiter.queue_depth == 0
+
+def test_cancel_interrupts_retry_backoff():
+    name = unique_name()
+    inner = StubChatModel(errors=[RateLimitError(retry_after=30)])
+    stream = CancellableStream(RateLimitedChatModel(inner=inner, model_name=name, provider="test"), "hi")
+    thread, result = consume_in_thread(stream)
+    time.sleep(0.3)
+    assert inner.calls == 1
+
+    assert cancel_and_wait(stream, thread) < PROMPT
+    assert isinstance(result["error"], GenerationCancelled)
+    assert inner.calls == 1
+
+def test_cancel_interrupts_cassette_replay(tmp_path):
+    path = tmp_path / "cassette.jsonl"
+    model = CassetteChatModel(inner=None, model_name="replayed", cassette=None)
+    key = model._key([HumanMessage(content="hi")], None, {})
+    chunks = [message_to_dict(AIMessageChunk(content=text)) for text in ["Hello", " world"]]
+    path.write_text(json.dumps({"kind": "chat", "key": key, "offsets": [0.0, 30.0], "chunks": chunks}) + "\n")
+    model.cassette = Cassette(path, "replay")
+
+    stream = CancellableStream(model, "hi")
+    thread, result = consume_in_thread(stream)
+    time.sleep(0.3)
+
+    assert cancel_and_wait(stream, thread) < PROMPT
+    assert isinstance(result["error"], GenerationCancelled)
@@ -0,0 +1,27 @@
+from common.chat_history import ChatHistoryStore, _page_markdown
+
+
+def test_page_markdown_is_cached_by_path(tmp_path):
+    path = tmp_path / "history.sqlite3"
+    store = ChatHistoryStore(path)
+    conversation_id = store.create_conversation("test")
+    for i in range(4):
+        store.append(conversation_id, "user" if i % 2 == 0 else "assistant", f"message {i}")
+
+    first = _page_markdown(str(path), conversation_id, 0, 2)
+    assert first == "**user**\n\nmessage 0\n\n---\n\n**assistant**\n\nmessage 1"
+
+    # 同じDBを開き直したストアでも、キャッシュを使う
+    hits = _page_markdown.cache_info().hits
+    assert _page_markdown(str(ChatHistoryStore(path).path), conversation_id, 0, 2) == first
+    assert _page_markdown.cache_info().hits == hits + 1
+
+def test_load_range(tmp_path):
+    store = ChatHistoryStore(tmp_path / "history.sqlite3")
+    conversation_id = store.create_conversation("test")
+    for i in range(5):
+        store.append(conversation_id, "user", str(i))
+
+    assert store.count(conversation_id) == 5
+    assert [content for _, content in store.load(conversation_id, 1, 3)] == ["1", "2"]
+    assert [content for _, content in store.load(conversation_id, 3)] == ["3", "4"]
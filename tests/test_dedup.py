@@ -0,0 +1,89 @@
+import numpy as np
+import pytest
+
+from dedup import ChunkDeduplicator
+
+BASE = "The quick brown fox jumps over the lazy dog while the cat watches from the window sill. " * 3
+
+
+def test_exact_duplicates_across_documents():
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    keep, stats = deduplicator.add("a", [BASE, "something else entirely"])
+    assert keep == [0, 1]
+    # 空白や大文字小文字の違いは正規化して完全一致とみなす
+    keep, stats = deduplicator.add("b", ["  " + BASE.upper(), "another unrelated chunk of text"])
+    assert keep == [1]
+    assert stats["dropped"] == {0: "exact"}
+    assert stats["exact"] == 1 and stats["kept"] == 1
+
+def test_near_duplicates():
+    deduplicator = ChunkDeduplicator(threshold=0.8)
+    deduplicator.add("a", [BASE])
+    keep, stats = deduplicator.add("b", [BASE.replace("lazy", "sleepy", 1)])
+    assert keep == []
+    assert stats["dropped"] == {0: "near"}
+
+def test_duplicates_within_a_document():
+    deduplicator = ChunkDeduplicator()
+    keep, stats = deduplicator.add("a", [BASE, BASE], indices=[4, 7])
+    assert keep == [4]
+    assert stats["dropped"] == {7: "exact"}
+
+def test_remove_restores_orphaned_duplicates():
+    deduplicator = ChunkDeduplicator()
+    deduplicator.add("a", [BASE])
+    deduplicator.add("b", [BASE])
+    deduplicator.add("c", [BASE])
+
+    # a の重複として除去した b と c のうち、b だけを戻す (c は戻した b の重複になる)
+    assert deduplicator.remove("a") == [("b", 0)]
+    keep, _ = deduplicator.add("d", [BASE])
+    assert keep == []
+
+    assert deduplicator.remove("b") == [("c", 0)]
+    assert deduplicator.remove("c") == [("d", 0)]
+    assert deduplicator.remove("d") == []
+    keep, _ = deduplicator.add("e", [BASE])
+    assert keep == [0]
+
+def test_remove_forgets_the_documents_own_dropped_chunks():
+    deduplicator = ChunkDeduplicator()
+    deduplicator.add("a", [BASE])
+    deduplicator.add("b", [BASE])
+    assert deduplicator.remove("b") == []
+    assert deduplicator.remove("a") == []
+
+
+def test_pdf_index_restores_chunks_when_the_original_is_deleted():
+    pytest.importorskip("faiss")
+    from langchain_community.embeddings import FakeEmbeddings
+
+    from common.bm25 import InvertedIndex
+    from pdf_index import add_document, delete_document, prepare_document
+
+    embeddings = FakeEmbeddings(size=8)
+    deduplicator = ChunkDeduplicator()
+    keyword_index = InvertedIndex()
+    documents = {}
+    vectorstore = None
+    rng = np.random.default_rng(0)
+    for doc_id, chunks in [("a", [BASE, "Installation steps for the printer driver"]),
+                           ("b", ["Warranty terms and support contacts", BASE])]:
+        indexed = {"chunks": chunks, "chunk_vectors": rng.random((len(chunks), 8)).tolist(),
+                   "summaries": [], "summary_vectors": []}
+        prepared = prepare_document(doc_id, doc_id, indexed, deduplicator)
+        vectorstore = add_document(vectorstore, prepared, embeddings)
+        keyword_index.add(prepared["ids"], prepared["texts"])
+        documents[doc_id] = {"name": doc_id, "ids": prepared["ids"], "chunks": prepared["chunks"],
+                             "summaries": 0, "dedup": prepared["dedup"], "dropped": prepared["dropped"]}
+    assert documents["b"]["ids"] == ["b-0"]
+    assert list(documents["b"]["dropped"]) == [1]
+
+    delete_document(vectorstore, documents, "a", deduplicator, keyword_index)
+
+    b = documents["b"]
+    assert b["ids"] == ["b-0", "b-1"]
+    assert b["chunks"] == 2 and b["dropped"] == {}
+    assert b["dedup"]["exact"] == 0 and b["dedup"]["kept"] == 2
+    assert set(vectorstore.index_to_docstore_id.values()) == {"b-0", "b-1"}
+    assert [id_ for id_, _ in keyword_index.search("lazy dog")] == ["b-1"]
@@ -0,0 +1,55 @@
+import time
+
+import pytest
+
+from common import jobs
+from common.jobs import DONE, FAILED, JobQueue
+
+
+@pytest.fixture
+def queue(tmp_path):
+    return JobQueue(workers=2, process_workers=1, cache_dir=tmp_path)
+
+def wait(job, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not job.done and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert job.done
+    return job
+
+def failing(job, calls):
+    calls.append(1)
+    raise ValueError("boom")
+
+def succeeding(job, value):
+    return value
+
+
+def test_result_is_cached_on_disk(queue):
+    job = wait(queue.submit("k", succeeding, {"a": 1}))
+    assert job.status == DONE
+    assert job.result == {"a": 1}
+    assert queue.submit("k", succeeding, "other") is job
+
+def test_failed_job_is_not_retried_immediately(queue):
+    calls = []
+    job = wait(queue.submit("k", failing, calls))
+    assert job.status == FAILED and "boom" in job.error
+
+    assert queue.submit("k", failing, calls) is job
+    assert calls == [1]
+
+def test_failed_job_is_retried_explicitly(queue):
+    calls = []
+    first = wait(queue.submit("k", failing, calls))
+    second = wait(queue.submit("k", failing, calls, retry=True))
+    assert second is not first
+    assert calls == [1, 1]
+
+def test_failed_job_is_retried_after_cooldown(queue, monkeypatch):
+    calls = []
+    first = wait(queue.submit("k", failing, calls))
+    monkeypatch.setattr(jobs, "FAILED_RETRY_AFTER", 0)
+    second = wait(queue.submit("k", succeeding, "ok"))
+    assert second is not first
+    assert second.result == "ok"
@@ -0,0 +1,81 @@
+import threading
+import time
+
+import pytest
+
+from common.rate_limit import RateLimitedChatModel, RateLimiter, TokenBucket, get_rate_limiter
+from stubs import RateLimitError, StubChatModel, unique_name
+
+
+def test_failed_attempt_is_settled_before_retry():
+    limiter = RateLimiter(unique_name(), requests_per_minute=600, tokens_per_minute=1000)
+    errors = [RateLimitError(retry_after=0)]
+
+    def func():
+        if errors:
+            raise errors.pop()
+        return "ok"
+
+    started = time.monotonic()
+    # 失敗した分を戻さないと、2回目の見積もりが空くまで30秒以上待つことになる
+    assert limiter.call(func, tokens=600) == "ok"
+    assert time.monotonic() - started < 1.0
+    assert limiter.stats["retries"] == 1
+    assert 390 <= limiter.tokens.level <= 410
+
+def test_failed_stream_attempt_is_settled_before_retry():
+    name = unique_name()
+    inner = StubChatModel(model_name=name, errors=[RateLimitError(retry_after=0)], chunks=["ok"])
+    model = RateLimitedChatModel(inner=inner, model_name=name, provider="test", max_retries=1)
+    limiter = get_rate_limiter("test", name)
+    limiter.tokens.capacity = limiter.tokens.level = model._estimate([], {}) * 1.5
+    limiter.tokens.rate = 1.0
+
+    started = time.monotonic()
+    assert "".join(chunk.content for chunk in model.stream("hi")) == "ok"
+    assert time.monotonic() - started < 1.0
+    assert inner.calls == 2
+
+
+def test_token_bucket_refill_and_give_back():
+    bucket = TokenBucket(rate=10, capacity=100)
+    bucket.take(100)
+    assert bucket.wait_time(10) == pytest.approx(1.0, abs=0.05)
+    bucket.give_back(50)
+    assert bucket.wait_time(10) == 0.0
+    # 容量を超えては貯まらず、負の値なら追加で差し引く
+    bucket.give_back(1000)
+    assert bucket.level == 100
+    bucket.give_back(-30)
+    assert bucket.level == pytest.approx(70, abs=1)
+
+def test_rate_limiter_serves_waiters_in_arrival_order():
+    limiter = RateLimiter(unique_name(), requests_per_minute=600, tokens_per_minute=600)
+    limiter.tokens.take(limiter.tokens.capacity)
+    order = []
+
+    def acquire(label, tokens):
+        limiter.acquire(tokens)
+        order.append(label)
+
+    threads = []
+    # 後から来た小さい呼び出しも、先に待っている大きい呼び出しを追い越さない
+    for label, tokens in [("first", 3), ("second", 1), ("third", 1)]:
+        thread = threading.Thread(target=acquire, args=(label, tokens), daemon=True)
+        thread.start()
+        threads.append(thread)
+        time.sleep(0.05)
+    assert limiter.queue_depth == 3
+    for thread in threads:
+        thread.join(timeout=5)
+
+    assert order == ["first", "second", "third"]
+    assert limiter.queue_depth == 0
+    assert limiter.stats["max_queue_depth"] == 3
+
+def test_acquire_larger_than_capacity_waits_for_full_bucket():
+    limiter = RateLimiter(unique_name(), requests_per_minute=600, tokens_per_minute=60)
+    started = time.monotonic()
+    limiter.acquire(tokens=1000)
+    assert time.monotonic() - started < 0.5
+    assert limiter.tokens.level <= 0.5
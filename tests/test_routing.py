@@ -0,0 +1,122 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from langchain_core.messages import AIMessageChunk
+
+from common.cancellation import GenerationCancelled
+from common.metering import CANCELLED, HEDGE_CANCELLED, UsageCallbackHandler, UsageStore
+from common.routing import EmptyStream, HedgedChatModel, get_latency_histogram
+from common.streaming import CancellableStream
+from stubs import RateLimitError, StubChatModel, unique_name
+
+
+@pytest.fixture
+def store(tmp_path):
+    return UsageStore(tmp_path / "usage.sqlite3")
+
+def stub(store=None, **kwargs):
+    callbacks = [UsageCallbackHandler("test", store=store)] if store is not None else None
+    return StubChatModel(model_name=unique_name(), callbacks=callbacks, **kwargs)
+
+def errors(store, count, timeout=2.0):
+    """ 計測の行が count 行になるまで待って、error 列を返す (ワーカーのスレッドが書き込む) """
+    deadline = time.monotonic() + timeout
+    while True:
+        with sqlite3.connect(store.path) as conn:
+            rows = [row[0] for row in conn.execute("SELECT error FROM usage ORDER BY id")]
+        if len(rows) >= count or time.monotonic() > deadline:
+            return rows
+        time.sleep(0.05)
+
+
+def test_faster_secondary_wins_after_hedge_delay(store):
+    primary = stub(store, first_delay=2.0, chunks=["slow"])
+    secondary = stub(store, chunks=["fast"])
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=0.1)
+
+    started = time.monotonic()
+    assert model.invoke("hi").content == "fast"
+    assert time.monotonic() - started < 1.0
+    assert get_latency_histogram(secondary.model_name).wins == 1
+    assert get_latency_histogram(primary.model_name).cancelled == 1
+    # 負けた側はユーザーの打ち切りではなく、ヘッジの中断として記録される
+    assert sorted(errors(store, 2), key=str) == sorted([None, HEDGE_CANCELLED], key=str)
+
+def test_primary_wins_without_hedging():
+    primary = stub(chunks=["a", "b"])
+    secondary = stub(chunks=["never"])
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=1.0)
+
+    assert model.invoke("hi").content == "ab"
+    assert secondary.calls == 0
+
+def test_failover_on_retryable_error():
+    primary = stub(errors=[RateLimitError()])
+    secondary = stub(chunks=["fallback"])
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=None)
+
+    assert model.invoke("hi").content == "fallback"
+    assert get_latency_histogram(primary.model_name).errors == 1
+
+def test_non_retryable_error_is_raised():
+    primary = stub(errors=[ValueError("bad request")])
+    model = HedgedChatModel(primary=primary, secondary=stub(), hedge_delay=None)
+
+    with pytest.raises(ValueError):
+        model.invoke("hi")
+
+def test_metadata_chunk_does_not_win():
+    # role だけの最初のチャンクはすぐに届くが、本文は遅い
+    primary = stub(chunks=[AIMessageChunk(content=""), "slow"], delay=2.0)
+    secondary = stub(first_delay=0.2, chunks=["fast"])
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=0.1)
+
+    assert model.invoke("hi").content == "fast"
+
+def test_buffered_metadata_chunks_are_returned_with_the_winner():
+    primary = stub(chunks=[AIMessageChunk(content="", id="run-1"), "text"])
+    model = HedgedChatModel(primary=primary, secondary=stub(), hedge_delay=1.0)
+
+    chunks = [chunk.content for chunk in model.stream("hi")]
+    assert chunks == ["", "text"]
+
+def test_empty_stream_fails_over():
+    primary = stub(chunks=[])
+    secondary = stub(chunks=["fallback"])
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=None)
+
+    assert model.invoke("hi").content == "fallback"
+
+def test_empty_streams_raise():
+    model = HedgedChatModel(primary=stub(chunks=[]), secondary=stub(chunks=[]), hedge_delay=None)
+
+    with pytest.raises(EmptyStream):
+        model.invoke("hi")
+
+def test_user_cancel_is_not_recorded_as_hedge_loss(store):
+    primary = stub(store, first_delay=30)
+    secondary = stub(store, first_delay=30)
+    model = HedgedChatModel(primary=primary, secondary=secondary, hedge_delay=0.1)
+    stream = CancellableStream(model, "hi")
+    result = {}
+
+    def consume():
+        try:
+            result["chunks"] = list(stream)
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=consume, daemon=True)
+    thread.start()
+    time.sleep(0.4)
+    started = time.monotonic()
+    stream.cancel()
+    thread.join(timeout=5)
+
+    assert not thread.is_alive()
+    assert time.monotonic() - started < 1.0
+    assert isinstance(result["error"], GenerationCancelled)
+    # 両方のモデルの呼び出しがユーザーの打ち切りとして記録される
+    assert errors(store, 2) == [CANCELLED, CANCELLED]
@@ -0,0 +1,28 @@
+from common.streaming import find_block_boundary
+
+
+def test_boundary_after_finished_paragraph():
+    text = "first paragraph\n\nsecond"
+    # 次の段落の行が書き終わっていないので、まだ確定しない
+    assert find_block_boundary(text) == 0
+    text = "first paragraph\n\nsecond\n"
+    assert find_block_boundary(text) == len("first paragraph\n\n")
+
+def test_no_boundary_inside_code_block():
+    text = "intro\n```python\nx = 1\n\ny = 2\n"
+    assert find_block_boundary(text) == 0
+    text += "```\n\nafter\n"
+    assert find_block_boundary(text) == len(text) - len("after\n")
+
+def test_closing_fence_must_match_opening():
+    text = "````\ncode\n```\n\nstill code\n"
+    assert find_block_boundary(text) == 0
+
+def test_list_items_continue_the_block():
+    text = "- one\n\n- two\n\n  continued\n"
+    assert find_block_boundary(text) == 0
+    text += "\nparagraph\n"
+    assert find_block_boundary(text) == len(text) - len("paragraph\n")
+
+def test_empty_text():
+    assert find_block_boundary("") == 0
@@ -0,0 +1,81 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("faiss")
+
+from langchain_community.embeddings import FakeEmbeddings
+
+from vector_compression import (
+    COMPRESSION_MODES, CompressedFAISS, compare_compression, convert_vector_store, create_vector_store,
+    pq_train_size, stored_vectors)
+
+DIM = 8
+
+
+def make_store(mode, n, seed=0):
+    vectors = np.random.default_rng(seed).random((n, DIM), dtype=np.float32)
+    store = create_vector_store(FakeEmbeddings(size=DIM), DIM, mode)
+    ids = [f"doc-{i}" for i in range(n)]
+    store.add_embeddings(
+        [(f"text {i}", vector.tolist()) for i, vector in enumerate(vectors)],
+        metadatas=[{"i": i} for i in range(n)], ids=ids)
+    return store, vectors, ids
+
+
+@pytest.mark.parametrize("mode", COMPRESSION_MODES)
+def test_search_returns_exact_match_first(mode):
+    # pq は学習に足りる数のベクトルを入れて、圧縮したインデックスで検索する
+    store, vectors, _ = make_store(mode, pq_train_size(DIM) + 20)
+    if mode == "pq":
+        assert not store.pq_pending
+    for i in (0, 17, 200):
+        doc, score = store.similarity_search_with_score_by_vector(vectors[i].tolist(), k=3)[0]
+        assert doc.metadata["i"] == i
+        assert score == pytest.approx(0.0, abs=1e-5)
+
+@pytest.mark.parametrize("mode", COMPRESSION_MODES)
+def test_delete_keeps_vectors_aligned(mode):
+    store, vectors, ids = make_store(mode, pq_train_size(DIM) + 20)
+    deleted = set(ids[:50:2])
+    store.delete(list(deleted))
+
+    assert store.index.ntotal == len(ids) - len(deleted)
+    assert not deleted & set(store.index_to_docstore_id.values())
+    # 削除の後も、残ったベクトルと文書の対応がずれていない
+    for i in (1, 51, 250):
+        doc, score = store.similarity_search_with_score_by_vector(vectors[i].tolist(), k=1)[0]
+        assert doc.metadata["i"] == i
+        assert score == pytest.approx(0.0, abs=1e-5)
+    np.testing.assert_allclose(
+        stored_vectors(store)[0], vectors[1], atol=1e-2 if mode in ("int8", "pq") else 1e-3)
+
+def test_search_with_filter():
+    store, vectors, _ = make_store("int8", 50)
+    results = store.similarity_search_with_score_by_vector(
+        vectors[3].tolist(), k=2, filter={"i": 7})
+    assert [doc.metadata["i"] for doc, _ in results] == [7]
+
+def test_pq_waits_for_enough_vectors():
+    store, vectors, _ = make_store("pq", 10)
+    assert isinstance(store, CompressedFAISS) and store.pq_pending
+    store.add_embeddings(
+        [(f"more {i}", vector.tolist()) for i, vector in
+         enumerate(np.random.default_rng(1).random((pq_train_size(DIM), DIM)))])
+    assert not store.pq_pending
+    doc, _ = store.similarity_search_with_score_by_vector(vectors[5].tolist(), k=1)[0]
+    assert doc.metadata["i"] == 5
+
+@pytest.mark.parametrize("mode", COMPRESSION_MODES)
+def test_convert_preserves_documents(mode):
+    store, vectors, ids = make_store("none", 40)
+    converted = convert_vector_store(store, mode)
+    assert getattr(converted, "compression", "none") == mode
+    assert [converted.index_to_docstore_id[i] for i in range(40)] == ids
+    doc, _ = converted.similarity_search_with_score_by_vector(vectors[9].tolist(), k=1)[0]
+    assert doc.metadata["i"] == 9
+
+def test_compare_compression_reports_each_mode():
+    vectors = np.random.default_rng(0).random((100, DIM), dtype=np.float32)
+    rows = compare_compression(vectors, k=5, n_queries=10)
+    assert [row["mode"] for row in rows] == COMPRESSION_MODES
+    assert rows[0]["recall@5"] == 1.0